@@ -0,0 +1,85 @@
+import argparse
+import logging
+import time
+import torch as th
+import torch.nn as nn
+
+from models.encoders import get_encoder
+from custom_op.register import register_ASI
+from custom_op.conv2d.conv_ASI import allocate_U_buffers
+from utils.util import get_all_conv_with_name
+
+logging.basicConfig(level=logging.INFO)
+
+# CPU benchmark of one training step (forward + backward + SGD step) with ASI layers: eager vs torch.compile
+# Example: python benchmark_compile.py --backbone mcunet --num_of_finetune 2 --rank 4 --batch_size 32
+
+class Classifier(nn.Module):
+    def __init__(self, backbone, num_classes):
+        super(Classifier, self).__init__()
+        self.backbone = get_encoder(backbone, "A", in_channels=3, output_stride=32, pretrained=False, weights_setupA=None)
+        self.pooling = nn.AdaptiveAvgPool2d((1, 1))
+        self.classifier = nn.Linear(self.backbone._out_channels[-1], num_classes)
+
+    def forward(self, x):
+        feat = self.backbone(x)[-1]
+        feat = self.pooling(feat)
+        feat = feat.flatten(start_dim=1)
+        return self.classifier(feat)
+
+def build_model(backbone, args):
+    model = Classifier(backbone, args.num_classes)
+    for param in model.parameters():
+        param.requires_grad = False
+
+    finetuned_layer = list(get_all_conv_with_name(model))[-args.num_of_finetune:]
+    cfgs = {"type": "conv", "finetuned_layer": finetuned_layer, "truncation_threshold": [args.rank] * len(finetuned_layer),
+            "no_reuse": False, "compile_friendly": True}
+    register_ASI(model, cfgs)
+    model.train()
+    return model
+
+def benchmark(model, x, y, steps, warmup):
+    optimizer = th.optim.SGD([param for param in model.parameters() if param.requires_grad], lr=1e-3)
+    loss_fn = nn.CrossEntropyLoss()
+
+    def step():
+        optimizer.zero_grad()
+        loss = loss_fn(model(x), y)
+        loss.backward()
+        optimizer.step()
+
+    for _ in range(warmup): # Compilation happens here
+        step()
+    start = time.perf_counter()
+    for _ in range(steps):
+        step()
+    return (time.perf_counter() - start) / steps
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--backbone", nargs='+', default=["mcunet", "resnet18"])
+    parser.add_argument("--num_of_finetune", type=int, default=2)
+    parser.add_argument("--rank", type=int, default=4)
+    parser.add_argument("--num_classes", type=int, default=10)
+    parser.add_argument("--batch_size", type=int, default=32)
+    parser.add_argument("--input_size", type=int, default=224)
+    parser.add_argument("--steps", type=int, default=20)
+    parser.add_argument("--warmup", type=int, default=3)
+    parser.add_argument("--threads", type=int, default=None)
+    args = parser.parse_args()
+
+    if args.threads is not None:
+        th.set_num_threads(args.threads)
+
+    x = th.randn(args.batch_size, 3, args.input_size, args.input_size)
+    y = th.randint(0, args.num_classes, (args.batch_size,))
+
+    for backbone in args.backbone:
+        th.manual_seed(233)
+        eager_time = benchmark(build_model(backbone, args), x, y, args.steps, args.warmup)
+        th.manual_seed(233)
+        model = build_model(backbone, args)
+        allocate_U_buffers(model, x) # No allocation inside the compiled graph
+        compiled_time = benchmark(th.compile(model), x, y, args.steps, args.warmup)
+        print(f"{backbone}: eager {eager_time*1000:.1f} ms/step, compiled {compiled_time*1000:.1f} ms/step, speedup {eager_time/compiled_time:.2f}x")
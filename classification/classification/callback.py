@@ -1,12 +1,18 @@
 from pytorch_lightning.callbacks import Callback
 import torch
+from functools import reduce
 from custom_op.register import register_measure_perplexity_HOSVD
 from pytorch_lightning import seed_everything
+from pytorch_lightning.utilities import rank_zero_info
+from torch.nn.parallel import DistributedDataParallel
+from subspace_sync import sync_subspaces, gather_decomposition_time
+from utils.ddp_comm_hook import register_ASI_comm_hook
+from utils.perplexity import RunningStats, update_spectra, rank_memory
 
 
 class LogActivationMemoryCallback(Callback):
 
-    def __init__(self, log_activation_mem=False, perplexity=None):
+    def __init__(self, log_activation_mem=False, perplexity=None, single_pass=False):
         self.log_activation_mem             = log_activation_mem    # if True: Log estimation of activation memory
         self.first_train_batch_start_logged = False
         self.first_train_batch_end_logged   = False                 # a flag indicating that training of the 1st batch of the 1st epoch is finish
@@ -20,6 +26,18 @@ class LogActivationMemoryCallback(Callback):
             self.total_layer = len(self.perplexity.perplexity)
             self.epsilon_idx = 0
             self.layer_idx = 0
+            self.single_pass = single_pass # All epsilons measured in one forward/backward (Conv2d_measure_perplexity_HOSVD_multi_op)
+            # Every training batch of the measurement is a sample: running mean and std of the perplexity of each (layer, epsilon).
+            # The ranks are the largest of the batches, the memory is the one of these ranks on the largest input of the layer
+            # (what training with them allocates), hence its std is 0
+            self.perplexity_stats = RunningStats(self.total_layer, self.total_epsilon)
+            self.input_shapes = [None for _ in range(self.total_layer)]
+            self.shape_hooks = []
+            self.filter_stats = RunningStats(self.total_layer, 1)
+            self.perplexity.perplexity_std = [[None for _ in range(self.total_epsilon)] for _ in range(self.total_layer)]
+            self.perplexity.layer_mems_std = [[None for _ in range(self.total_epsilon)] for _ in range(self.total_layer)]
+            self.perplexity.spectra = [None for _ in range(self.total_layer)]
+            self.spectra_count = [0 for _ in range(self.total_layer)]
 
     def on_train_epoch_start(self, trainer, model):
         if not self.training_begin:
@@ -31,14 +49,21 @@ class LogActivationMemoryCallback(Callback):
         
 
         if hasattr(model, 'measure_perplexity_HOSVD_var') and model.measure_perplexity_HOSVD_var:
-            model.filter_cfgs["explain_variance_threshold"] = self.perplexity.set_of_epsilons[self.epsilon_idx]
-            print(f"For epsilon is {self.perplexity.set_of_epsilons[self.epsilon_idx]}")
+            if self.single_pass:
+                model.filter_cfgs["explain_variance_threshold"] = list(self.perplexity.set_of_epsilons)
+                print(f"For epsilons {self.perplexity.set_of_epsilons}")
+            else:
+                model.filter_cfgs["explain_variance_threshold"] = self.perplexity.set_of_epsilons[self.epsilon_idx]
+                print(f"For epsilon is {self.perplexity.set_of_epsilons[self.epsilon_idx]}")
             seed_everything(233)
             register_measure_perplexity_HOSVD(model, model.filter_cfgs)
+            self.record_input_shapes(model)
 
             model.update_optimizer()
 
     def on_train_epoch_end(self, trainer, model):
+        if hasattr(model, 'measure_perplexity_HOSVD_var') and model.measure_perplexity_HOSVD_var and not self.single_pass:
+            self.epsilon_idx += 1 # One epoch (of num_train_batch batches) per epsilon
 
         if self.log_activation_mem:
             if hasattr(model, 'with_HOSVD_var') and model.with_HOSVD_var:
@@ -70,15 +95,97 @@ class LogActivationMemoryCallback(Callback):
             trainer.limit_val_batches = 0
 
         if hasattr(model, 'measure_perplexity_HOSVD_var') and model.measure_perplexity_HOSVD_var:
-            for i in range(self.total_layer):
-                self.perplexity.perplexity[i][self.epsilon_idx] = model.perplexity[i].item() if isinstance(model.perplexity[i], torch.Tensor) else model.perplexity[i]
-                self.perplexity.ranks[i][self.epsilon_idx]      = model.measured_rank[i]
-                self.perplexity.layer_mems[i][self.epsilon_idx] = model.layer_mem[i].item() if isinstance(model.layer_mem[i], torch.Tensor) else model.layer_mem[i]
+            self.update_perplexity(model)
+        
 
-            model.clear_measured_variables()
+    def update_perplexity(self, model):
+        to_float = lambda value: value.item() if isinstance(value, torch.Tensor) else value
+        # Single pass: the model has one value per epsilon, otherwise the value of the current epsilon
+        epsilons = range(self.total_epsilon) if self.single_pass else [self.epsilon_idx]
+        as_list = lambda value: value if self.single_pass else [value]
+        table = self.perplexity
+        for i in range(self.total_layer):
+            layer_flops = getattr(model, 'layer_flops', None)
+            layer_flops = as_list(layer_flops[i]) if layer_flops is not None and layer_flops[i] is not None else None
+            for j, epsilon_idx in enumerate(epsilons):
+                self.perplexity_stats.update(i, epsilon_idx, to_float(as_list(model.perplexity[i])[j]))
+                table.perplexity[i][epsilon_idx], table.perplexity_std[i][epsilon_idx] = self.perplexity_stats.get(i, epsilon_idx)
 
-            self.epsilon_idx += 1
-        
+                rank = as_list(model.measured_rank[i])[j]
+                if table.ranks[i][epsilon_idx] is not None and isinstance(rank, (list, tuple)): # Largest rank of the batches
+                    rank = [max(r, previous) for r, previous in zip(rank, table.ranks[i][epsilon_idx])]
+                table.ranks[i][epsilon_idx] = rank
+                if isinstance(rank, (list, tuple)) and self.input_shapes[i] is not None:
+                    table.layer_mems[i][epsilon_idx], table.layer_mems_std[i][epsilon_idx] = rank_memory({"input": self.input_shapes[i]}, rank), 0.
+                else: # Rank not given per mode: largest memory of the batches
+                    table.layer_mems[i][epsilon_idx], table.layer_mems_std[i][epsilon_idx] = max(to_float(as_list(model.layer_mem[i])[j]), table.layer_mems[i][epsilon_idx] or 0), 0.
+                if layer_flops is not None:
+                    flops, table.vanilla_flops[i] = layer_flops[j]
+                    table.layer_flops[i][epsilon_idx] = max(flops, table.layer_flops[i][epsilon_idx] or 0)
+
+            if getattr(model, 'filter_perplexity', None) is not None:
+                self.filter_stats.update(i, 0, to_float(model.filter_perplexity[i]))
+                table.filter_perplexity[i] = self.filter_stats.get(i, 0)[0]
+
+            if getattr(model, 'spectra', None) is not None and model.spectra[i] is not None:
+                table.spectra[i], self.spectra_count[i] = update_spectra(table.spectra[i], model.spectra[i], self.spectra_count[i])
+
+        table.num_batches = min(min(row) for row in self.perplexity_stats.count)
+        model.clear_measured_variables()
+
+    def record_input_shapes(self, model):
+        # Largest input of each measured layer (the layers are wrapped again at each epoch)
+        for handle in self.shape_hooks:
+            handle.remove()
+        def hook(i):
+            def record(module, input, output):
+                if module.training:
+                    shape = list(input[0].shape)
+                    self.input_shapes[i] = shape if self.input_shapes[i] is None else [max(a, b) for a, b in zip(shape, self.input_shapes[i])]
+            return record
+        self.shape_hooks = [reduce(getattr, name.split('.'), model).register_forward_hook(hook(i))
+                            for i, name in enumerate(model.filter_cfgs["finetuned_layer"])]
 
     def on_validation_batch_end(self, trainer, model, outputs, batch, batch_idx, dataloader_idx):
-        self.num_val_batches = batch_idx + 1
\ No newline at end of file
+        self.num_val_batches = batch_idx + 1
+
+
+class SyncSubspaceCallback(Callback):
+    """
+    Data parallel training (DDP) with ASI layers:
+    - every every_n_steps training batches, the warm-start subspaces of the replicas are synchronized (see shared/subspace_sync.py)
+      and the decomposition time of each rank is logged (decomposition_time/rank{i}, seconds per batch)
+    - if comm_hook, the gradients of Conv2d_ASI are all-reduced in low-rank form (see utils/ddp_comm_hook.py)
+    """
+    def __init__(self, every_n_steps=50, mode="broadcast", comm_hook=False):
+        self.every_n_steps = every_n_steps
+        self.mode = mode
+        self.comm_hook = comm_hook
+        self.comm_state = None
+        self.num_batches = 0
+        self.total_decomposition_time = None # Per rank
+
+    def on_fit_start(self, trainer, model):
+        # The model is already wrapped by the strategy here. Lightning only registers comm hooks on CUDA, so it is done by hand
+        if self.comm_hook and isinstance(trainer.strategy.model, DistributedDataParallel):
+            self.comm_state = register_ASI_comm_hook(trainer.strategy.model)
+
+    def on_train_batch_end(self, trainer, model, outputs, batch, batch_idx, dataloader_idx):
+        self.num_batches += 1
+        if self.num_batches % self.every_n_steps != 0:
+            return
+        sync_subspaces(model, self.mode)
+
+        times = gather_decomposition_time(model, reset=True)
+        if self.total_decomposition_time is None:
+            self.total_decomposition_time = [0.] * len(times)
+        for rank, t in enumerate(times):
+            self.total_decomposition_time[rank] += t
+            model.log(f"decomposition_time/rank{rank}", t / self.every_n_steps)
+        if self.comm_state is not None and self.comm_state.num_element_dense > 0:
+            model.log("comm_hook/sent_ratio", self.comm_state.num_element_sent / self.comm_state.num_element_dense)
+
+    def on_train_end(self, trainer, model):
+        if self.total_decomposition_time is not None:
+            for rank, t in enumerate(self.total_decomposition_time):
+                rank_zero_info(f"Rank {rank}: {t:.2f} s of decomposition")
@@ -4,10 +4,13 @@ import torch as th
 import torch.nn as nn
 from pytorch_lightning import LightningModule
 from torchmetrics import Accuracy
-from custom_op.register import register_grad_filter, register_normal_conv, register_ASI, register_measure_perplexity_HOSVD, register_HOSVD_var_filter
+from custom_op.register import register_grad_filter, register_normal_conv, register_ASI, register_measure_perplexity_HOSVD, register_HOSVD_var_filter, register_mixed, register_offload
 
 from custom_op.conv2d.conv_avg import Conv2dAvg
 from custom_op.conv2d.conv_ASI import Conv2d_ASI
+from custom_op.recompute import Recompute
+from custom_op.offload import Offloader
+from custom_op.conv2d.conv_offload import Conv2d_offload
 
 
 from tqdm import tqdm
@@ -18,7 +21,10 @@ from models.encoders import get_encoder
 from functools import reduce
 import logging
 
-from utils.perplexity import Perplexity
+from utils.perplexity import Perplexity, PerplexityCache, weights_fingerprint
+from utils.planner import get_layer_shapes, plan_strategies, recompute_cost
+from utils.low_rank_optimizer import LowRankOptimizer
+from torch.ao.quantization import get_default_qat_qconfig
 
 
 import inspect
@@ -31,9 +37,18 @@ class ClassificationModel(LightningModule):
 
                 num_of_finetune=None, 
                 ##### which kind of filter will be used
-                with_HOSVD_var=False, with_grad_filter=False, with_ASI=False, force_use_base = False, measure_perplexity_HOSVD_var=False,
-
-                no_reuse = False, truncation_threshold=None, filt_radius=None, budget = None, perplexity_pkl=None,
+                with_HOSVD_var=False, with_grad_filter=False, with_ASI=False, with_planner=False, with_offload=False, force_use_base = False, measure_perplexity_HOSVD_var=False,
+
+                no_reuse = False, async_decomposition = False, async_workers = 1, compile_friendly = False, qat_backend = None,
+                factored_grad = False, update_proj_gap = 200, truncation_threshold=None, filt_radius=None, budget = None, perplexity_pkl=None,
+                flops_budget=None, flops_weight=None, # with_ASI or with_planner: budget of forward + backward FLOPs; with_ASI: budget is on memory (MB) + flops_weight * FLOPs if flops_weight is given
+                perplexity_kappa=None, memory_kappa=None, # with_ASI: select the ranks on mean + kappa * spread over the measured batches (see Perplexity.confidence_bounds)
+                per_mode_ranks=False, # with_ASI: choose the rank of each mode separately within budget (memory only), needs the spectra of a single pass measurement (see Perplexity.mode_options)
+                perplexity_cache=None, # with_ASI without perplexity_pkl: directory of the measured tables (see PerplexityCache), measure_perplexity_HOSVD_var: stores the table there
+                perplexity_epsilons=None, perplexity_dataset=None, perplexity_input_size=None, # Provenance of the tables in perplexity_cache, linked to the data by trainer_cls.py
+                plan_input_size=None, # only used with with_planner, plan_input_size is (B, C, H, W)
+                plan_perplexity_bound=None, # with_planner: the cheapest plan whose total perplexity is within this bound (see plan_strategies)
+                offload_storage="host", offload_dir=None, # only used with with_offload, storage is "host" or "disk"
 
                 just_log = False, # only log activation size, flops ... no training
 
@@ -71,6 +86,7 @@ class ClassificationModel(LightningModule):
 
         ##
         self.all_conv_layers, self.name_conv_layers_with_relu, _, _ = get_all_conv_with_name_and_previous_non_linearity(self) # A dictionary contains all conv2d layers (value) and their names (key)
+        self.conv_layer_names = list(self.all_conv_layers) # Rows of the perplexity table measured by measure_perplexity_HOSVD_var
         if num_of_finetune == "all" or num_of_finetune > len(self.all_conv_layers):
             logging.info("[Warning] Finetuning all layers")
             self.num_of_finetune = len(self.all_conv_layers)
@@ -83,9 +99,17 @@ class ClassificationModel(LightningModule):
         self.with_ASI = with_ASI
         self.with_HOSVD_var = with_HOSVD_var
         self.with_grad_filter = with_grad_filter
-        self.with_base = not (self.with_HOSVD_var or self.with_grad_filter or self.with_ASI)
+        self.with_planner = with_planner
+        self.with_offload = with_offload
+        self.with_base = not (self.with_HOSVD_var or self.with_grad_filter or self.with_ASI or self.with_planner or self.with_offload)
 
         self.no_reuse = no_reuse
+        self.async_decomposition = async_decomposition # Decompose the input of ASI layers on a worker thread
+        self.async_workers = async_workers # Number of worker threads of async_decomposition, shared by the ASI layers
+        self.compile_friendly = compile_friendly # Formulation of the ASI layers without graph breaks under torch.compile
+        self.factored_grad = factored_grad # Keep the weight gradients of ASI layers in factored form, used with LowRankOptimizer
+        self.update_proj_gap = update_proj_gap
+        self.qconfig = get_default_qat_qconfig(qat_backend) if qat_backend is not None else None # Fake-quantized weights, e.g. "fbgemm" or "qnnpack"
         self.truncation_threshold = truncation_threshold
         self.filt_radius = filt_radius
 
@@ -93,13 +117,37 @@ class ClassificationModel(LightningModule):
             self.perplexity     = [None for layer_idx in range(len(self.all_conv_layers))]
             self.measured_rank  = [None for layer_idx in range(len(self.all_conv_layers))]
             self.layer_mem      = [None for layer_idx in range(len(self.all_conv_layers))]
+            # Gap of the gradient filter, measured in the same pass if a radius is given
+            self.filter_perplexity = [None for layer_idx in range(len(self.all_conv_layers))] if self.filt_radius is not None else None
+            self.layer_flops    = [None for layer_idx in range(len(self.all_conv_layers))] # (ASI FLOPs, vanilla FLOPs)
+            self.spectra        = [None for layer_idx in range(len(self.all_conv_layers))] # Cumulative explained variance of each mode
+
 
+        self.perplexity_cache = PerplexityCache(perplexity_cache) if perplexity_cache is not None else None
+        self.perplexity_provenance = {"backbone": backbone, "setup": setup, "layer_names": self.conv_layer_names, "dataset": perplexity_dataset,
+                                      "input_size": perplexity_input_size, "set_of_epsilons": perplexity_epsilons} # Completed with the weights once they are loaded
 
         if self.with_ASI:
             self.perplexity_pkl = perplexity_pkl
-            perplexity = Perplexity()
-            perplexity.load(self.perplexity_pkl)
-            best_memory, best_perplexity, best_indices, self.suitable_ranks = perplexity.find_best_combination(budget=budget, num_of_finetuned=self.num_of_finetune)
+            self.rank_selection = {"budget": budget, "flops_budget": flops_budget, "flops_weight": flops_weight,
+                                   "perplexity_kappa": perplexity_kappa, "memory_kappa": memory_kappa}
+            self.per_mode_ranks = per_mode_ranks
+            self.suitable_ranks = None
+            if self.perplexity_pkl is not None:
+                self.select_ranks()
+            elif self.perplexity_cache is None:
+                raise ValueError("with_ASI needs perplexity_pkl or perplexity_cache")
+
+        if self.with_planner:
+            self.perplexity_pkl = perplexity_pkl
+            self.budget = budget
+            self.flops_budget = flops_budget
+            self.plan_input_size = plan_input_size
+            self.plan_perplexity_bound = plan_perplexity_bound
+            self.plan = None
+
+        if self.with_offload: # Tensors saved for the backward pass of the finetuned layers go to host memory or disk
+            self.offloader = Offloader(storage=offload_storage, directory=offload_dir)
         
         ##
         self.use_sgd = use_sgd
@@ -119,6 +167,17 @@ class ClassificationModel(LightningModule):
         if load != None and (self.measure_perplexity_HOSVD_var == False):
             state_dict = th.load(load)['state_dict']
             self.load_state_dict(state_dict)
+
+        if self.perplexity_cache is not None:
+            self.perplexity_provenance["weights"] = weights_fingerprint(self.backbone.state_dict()) # Same weights as the measurement, before any update
+            if self.with_ASI and self.perplexity_pkl is None:
+                self.perplexity_pkl = self.perplexity_cache.lookup(self.perplexity_provenance)
+                if self.perplexity_pkl is not None:
+                    logging.info(f"Perplexity table found in the cache: {self.perplexity_pkl}")
+                    self.select_ranks()
+                    self.filter_cfgs["truncation_threshold"] = self.suitable_ranks
+                else: # trainer_cls.py measures it before training
+                    logging.info("No perplexity table in the cache for this model, dataset and epsilons, it has to be measured")
         
         if self.force_use_base: #Bắt buộc dùng bản base
             register_normal_conv(self, self.filter_cfgs)
@@ -126,14 +185,42 @@ class ClassificationModel(LightningModule):
             register_measure_perplexity_HOSVD(self, self.filter_cfgs)
              
         elif self.with_ASI:
-            register_ASI(self, self.filter_cfgs)
+            if self.suitable_ranks is not None:
+                register_ASI(self, self.filter_cfgs)
         elif self.with_HOSVD_var:
             register_HOSVD_var_filter(self, self.filter_cfgs)
         elif self.with_grad_filter:
             register_grad_filter(self, self.filter_cfgs)
+        elif self.with_planner:
+            register_mixed(self, self.filter_cfgs)
+        elif self.with_offload:
+            register_offload(self, self.filter_cfgs)
         
         self.acc.reset()
     
+    def select_ranks(self):
+        """ Ranks of the finetuned layers chosen in the perplexity table perplexity_pkl, within the budgets of rank_selection """
+        perplexity = Perplexity()
+        perplexity.load(self.perplexity_pkl)
+        selection = self.rank_selection
+        on_means = selection["flops_budget"] is None and selection["flops_weight"] is None and not selection["perplexity_kappa"] and not selection["memory_kappa"]
+        input_size = self.perplexity_provenance["input_size"]
+        retarget = perplexity.shapes and input_size is not None and list(input_size) != list(perplexity.input_size)
+        if retarget:
+            # Measured with another batch size or resolution: memory and FLOPs of the measured ranks at the training size
+            logging.info(f"Perplexity measured with input size {perplexity.input_size}, memory and FLOPs are computed for {list(input_size)}")
+            shapes = get_layer_shapes(self, perplexity.layer_names, input_size)
+            perplexity = perplexity.for_shapes([shapes[name] for name in perplexity.layer_names], list(input_size))
+        if self.per_mode_ranks:
+            if selection["flops_budget"] is not None or selection["flops_weight"] is not None or selection["perplexity_kappa"] or selection["memory_kappa"]:
+                print("[Perplexity class] Warning, per_mode_ranks only uses the memory budget, the FLOPs budget and kappas are ignored")
+            best_memory, best_perplexity, self.suitable_ranks = perplexity.find_best_mode_ranks(selection["budget"], num_of_finetuned=self.num_of_finetune)
+            return
+        if on_means and not retarget and not perplexity.has_frontier(self.num_of_finetune): # Computed once, the next runs answer any budget by binary search
+            perplexity.get_frontier(self.num_of_finetune)
+            perplexity.save(self.perplexity_pkl)
+        best_memory, best_perplexity, best_indices, self.suitable_ranks = perplexity.find_best_combination(num_of_finetuned=self.num_of_finetune, **selection)
+
     def attach_memory_list(self):
         self.k0_hosvd = []
         self.k1_hosvd = []
@@ -157,6 +244,10 @@ class ClassificationModel(LightningModule):
             self.perplexity[i]     = None
             self.measured_rank[i]  = None
             self.layer_mem[i]      = None
+            if self.filter_perplexity is not None:
+                self.filter_perplexity[i] = None
+            self.layer_flops[i]    = None
+            self.spectra[i]        = None
             
     def reset(self):
         # Reset the model to its initial state
@@ -177,20 +268,49 @@ class ClassificationModel(LightningModule):
         else:
             self.filter_cfgs["finetuned_layer"] = finetuned_layer
             if self.measure_perplexity_HOSVD_var:
-                new_items = {"explain_variance_threshold": self.truncation_threshold, "perplexity": self.perplexity, "measured_rank": self.measured_rank, "layer_mem": self.layer_mem}
+                new_items = {"explain_variance_threshold": self.truncation_threshold, "perplexity": self.perplexity, "measured_rank": self.measured_rank, "layer_mem": self.layer_mem,
+                             "radius": self.filt_radius, "filter_perplexity": self.filter_perplexity, "layer_flops": self.layer_flops, "spectra": self.spectra}
 
             elif self.with_ASI:
-                new_items = {"truncation_threshold": self.suitable_ranks, "no_reuse": self.no_reuse}
+                new_items = {"truncation_threshold": self.suitable_ranks, "no_reuse": self.no_reuse, "async_decomposition": self.async_decomposition,
+                             "async_workers": self.async_workers, "compile_friendly": self.compile_friendly, "qconfig": self.qconfig,
+                             "factored_grad": self.factored_grad}
 
             elif self.with_HOSVD_var:
                 new_items = {"explained_variance_threshold": self.truncation_threshold, "k_hosvd": None}
 
             elif self.with_grad_filter:
                 new_items = {"radius": self.filt_radius}
+
+            elif self.with_planner:
+                new_items = self.get_plan_configs(finetuned_layer)
+
+            elif self.with_offload:
+                new_items = {"offloader": self.offloader}
             else:
                 new_items = {}
             self.filter_cfgs.update(new_items)
         
+    def get_plan_configs(self, finetuned_layer):
+        """ Helper function to choose the strategy (vanilla, gradient filter, ASI or recomputation) of each finetuned layer """
+        assert self.plan_input_size is not None, "[Warning] plan_input_size (B, C, H, W) is needed to plan the strategies !!"
+        perplexity = Perplexity()
+        perplexity.load(self.perplexity_pkl)
+
+        shapes = get_layer_shapes(self, finetuned_layer, self.plan_input_size)
+        start_layer = len(perplexity.layer_mems) - len(finetuned_layer) # Finetuned layers are the last layers of the table
+        best_memory, best_flops, best_perplexity, self.plan = plan_strategies(shapes, perplexity, start_layer, self.budget, flops_budget=self.flops_budget,
+                                                                                   perplexity_bound=self.plan_perplexity_bound, radius=self.filt_radius)
+
+        logging.info(f"Plan: memory {best_memory} MB, FLOPs {best_flops}, perplexity {best_perplexity}")
+        for name, layer_plan in zip(finetuned_layer, self.plan):
+            logging.info(f"{name}: {layer_plan['strategy']} (rank {layer_plan['rank']})")
+
+        return {"strategy": [layer_plan["strategy"] for layer_plan in self.plan],
+                "truncation_threshold": [layer_plan["rank"] for layer_plan in self.plan],
+                "radius": self.filt_radius, "no_reuse": self.no_reuse, "async_decomposition": self.async_decomposition,
+                "async_workers": self.async_workers}
+
     def freeze_layers(self):
         """ Helper function to freeze layers that are not being finetuned """
         if self.num_of_finetune != 0 and self.num_of_finetune != None:
@@ -282,7 +402,13 @@ class ClassificationModel(LightningModule):
                 _, C_prime, H_prime, W_prime = self.hook[name].output_size
                 K_H, K_W = self.hook[name].module.kernel_size
 
-                if isinstance(self.hook[name].module, Conv2dAvg):
+                if getattr(self.hook[name].module, 'recompute', False): # Its parent only keeps its input, counted below
+                    _, fw, bw = recompute_cost({"input": input_size, "output": self.hook[name].output_size, "kernel_size": (K_H, K_W)})
+
+                    num_flops_fw += fw
+                    num_flops_bw += bw
+
+                elif isinstance(self.hook[name].module, Conv2dAvg):
                     stride = self.hook[name].module.stride
                     x_h, x_w = input_size[-2:]
                     h, w = self.hook[name].output_size[-2:] 
@@ -310,7 +436,7 @@ class ClassificationModel(LightningModule):
 
                 elif isinstance(self.hook[name].module, Conv2d_ASI):
                     from custom_op.compression.hosvd_subspace_iteration import hosvd_subspace_iteration
-                    S, u_list = hosvd_subspace_iteration(self.hook[name].inputs[0], previous_Ulist=None, reuse_U=False, rank=self.suitable_ranks[layer_index])
+                    S, u_list = hosvd_subspace_iteration(self.hook[name].inputs[0], previous_Ulist=None, reuse_U=False, rank=self.hook[name].module.rank)
 
                     K0, K1, K2, K3 = S.shape
 
@@ -326,7 +452,11 @@ class ClassificationModel(LightningModule):
                     num_flops_fw += fw_overhead + vanilla_fw
                     num_flops_bw += bw
                     
-                elif isinstance(self.hook[name].module, nn.modules.conv.Conv2d) and self.with_base:
+                elif isinstance(self.hook[name].module, Conv2d_offload): # Its input is not in the device memory, see Offload/* in the logs
+                    num_flops_fw += (K_H*K_W*C_prime*C*H*W)*B
+                    num_flops_bw += (K_H*K_W*C*C_prime*H_prime*W_prime)*B
+
+                elif isinstance(self.hook[name].module, nn.modules.conv.Conv2d) and (self.with_base or self.with_planner):
                     num_element += int(input_size[1] * input_size[2] * input_size[3] * input_size[0])
 
                     vanilla_fw = (K_H*K_W*C_prime*C*H*W)*B
@@ -335,7 +465,9 @@ class ClassificationModel(LightningModule):
                     num_flops_fw += vanilla_fw
                     num_flops_bw += vanilla_bw
 
-
+            for mod in self.modules():
+                if isinstance(mod, Recompute) and mod.activate:
+                    num_element += mod.input_numel
 
             self.remove_hooks()
 
@@ -440,9 +572,13 @@ class ClassificationModel(LightningModule):
             file.write(str(self.current_epoch) + "\t" + str((self.num_flops_fw + num_flops_bw)) + "\n")
 
     def configure_optimizers(self):
-        if self.use_sgd:
+        if self.use_sgd and self.factored_grad: # Optimizer state of ASI weights in the projected subspace
+            optimizer = LowRankOptimizer(filter(lambda p: p.requires_grad, self.parameters()),
+                                         lr=self.learning_rate, weight_decay=self.weight_decay, momentum=self.momentum, use_sgd=True, update_proj_gap=self.update_proj_gap)
+        elif self.use_sgd:
             optimizer = th.optim.SGD(filter(lambda p: p.requires_grad, self.parameters()),
                                      lr=self.learning_rate, weight_decay=self.weight_decay, momentum=self.momentum)
+        if self.use_sgd:
             if self.lr_warmup == 0:
                 scheduler = th.optim.lr_scheduler.CosineAnnealingLR(
                     optimizer, self.anneling_steps, eta_min=0.1 * self.learning_rate)
@@ -462,6 +598,10 @@ class ClassificationModel(LightningModule):
                 'frequency': 1
             }
             return [optimizer], [sch]
+        if self.factored_grad:
+            optimizer = LowRankOptimizer(filter(lambda p: p.requires_grad, self.parameters()),
+                                         lr=self.learning_rate, weight_decay=self.weight_decay, betas=(0.8, 0.9), update_proj_gap=self.update_proj_gap)
+            return [optimizer]
         optimizer = th.optim.Adam(filter(lambda p: p.requires_grad, self.parameters()),
                                   lr=self.learning_rate, weight_decay=self.weight_decay, betas=(0.8, 0.9))
         return [optimizer]
@@ -536,6 +676,18 @@ class ClassificationModel(LightningModule):
 
         return {'loss': loss, 'acc': acc}
 
+    def on_train_batch_start(self, batch, batch_idx, unused=0):
+        if self.with_offload:
+            self.offloader.clear()
+            self.offloader.reset_stats()
+
+    def on_train_batch_end(self, outputs, batch, batch_idx, unused=0):
+        if self.with_offload: # Forward and backward of the batch are done
+            stats = self.offloader.stats()
+            self.log("Offload/MB", stats["bytes_offloaded"] / (1024*1024))
+            self.log("Offload/Stalls", float(stats["num_stalls"]))
+            self.log("Offload/Stall_time", stats["stall_time"])
+
     def training_epoch_end(self, outputs):
         with open(os.path.join(self.logger.log_dir, 'train_loss.log'), 'a') as f:
             mean_loss = th.stack([o['loss'] for o in outputs]).mean()
@@ -5,7 +5,7 @@ import torch.nn as nn
 from pytorch_lightning import LightningModule
 from torchmetrics import Accuracy
 from custom_op.register import register_HOSVD_var_filter, register_ASI, register_measure_perplexity_HOSVD
-from utils.util import get_all_linear_with_name, get_active_linear_with_name, Hook, calculate_flops_SVD
+from utils.util import get_all_linear_with_name, get_active_linear_with_name, get_active_attention_with_name, is_attention, Hook, calculate_flops_SVD
 from models.encoders import get_encoder
 from functools import reduce
 import logging
@@ -14,6 +14,7 @@ import inspect
 from utils.perplexity_dp import Perplexity
 
 from custom_op.linear.linear_ASI import Linear_ASI
+from torch.ao.quantization import get_default_qat_qconfig
 
 class ClassificationModel(LightningModule):
     def __init__(self, backbone: str, backbone_args, num_classes,
@@ -23,7 +24,9 @@ class ClassificationModel(LightningModule):
 
                  with_HOSVD_var = False, with_ASI=False, truncation_threshold=None, measure_perplexity_HOSVD_var=False,
 
-                 no_reuse = False, just_log = False, budget=None, perplexity_pkl=None,
+                 no_reuse = False, qat_backend = None, just_log = False, budget=None, perplexity_pkl=None,
+
+                 with_attention_ASI=False, attention_rank=None, attention_matmul_rank=None,
                  checkpoint=None,
                  
                  use_sgd=False, momentum=0.9, anneling_steps=8008, scheduler_interval='step',
@@ -79,8 +82,14 @@ class ClassificationModel(LightningModule):
         self.with_base = not (self.with_HOSVD_var or self.with_ASI)
         
         self.no_reuse = no_reuse
+        self.qconfig = get_default_qat_qconfig(qat_backend) if qat_backend is not None else None # Fake-quantized weights, e.g. "fbgemm" or "qnnpack"
         self.truncation_threshold = truncation_threshold
 
+        # Attention layers (qkv/out projections and optionally the operands of Q·K^T and attn·V) are compressed with a fixed rank
+        self.with_attention_ASI = with_attention_ASI
+        self.attention_rank = attention_rank
+        self.attention_matmul_rank = attention_matmul_rank
+
         if self.with_ASI:
             self.perplexity_pkl = perplexity_pkl
             perplexity = Perplexity()
@@ -101,6 +110,7 @@ class ClassificationModel(LightningModule):
         ###################################### Create configuration to modify model #########################################
         self.filter_cfgs = {"type": "linear", "backbone": backbone}
         self.handle_finetune()
+        self.set_attention_configs()
         #######################################################################
         
 
@@ -115,6 +125,9 @@ class ClassificationModel(LightningModule):
         elif self.with_ASI:
             register_ASI(self, self.filter_cfgs)
 
+        if self.with_attention_ASI and not self.measure_perplexity_HOSVD_var:
+            register_ASI(self, self.attention_cfgs)
+
 
         self.acc.reset()
     
@@ -160,7 +173,7 @@ class ClassificationModel(LightningModule):
                 new_items = {"explain_variance_threshold": self.truncation_threshold, "perplexity": self.perplexity, "measured_rank": self.measured_rank, "layer_mem": self.layer_mem}
 
             elif self.with_ASI:
-                new_items = {"truncation_threshold": self.suitable_ranks, "no_reuse": self.no_reuse}
+                new_items = {"truncation_threshold": self.suitable_ranks, "no_reuse": self.no_reuse, "qconfig": self.qconfig}
             
             elif self.with_HOSVD_var:
                 new_items = {"explained_variance_threshold": self.truncation_threshold, "k_hosvd": None}
@@ -168,6 +181,22 @@ class ClassificationModel(LightningModule):
             else:
                 new_items = {}
             self.filter_cfgs.update(new_items)
+
+    def set_attention_configs(self):
+        """ Helper function to set the configuration of attention layers that are trained (i.e. placed after the first finetuned linear) """
+        if not self.with_attention_ASI:
+            self.attention_cfgs = -1
+            return
+        assert self.attention_rank is not None, "[Warning] attention_rank must be given to compress attention layers"
+
+        attention_layers = get_active_attention_with_name(self)
+        if attention_layers == -1:
+            logging.info("[Warning] No attention layer is finetuned => Nothing to compress !!")
+            self.attention_cfgs = -1
+        else:
+            self.attention_cfgs = {"type": "attention", "backbone": self.backbone_name, "finetuned_layer": list(attention_layers),
+                                   "truncation_threshold": [self.attention_rank] * len(attention_layers),
+                                   "matmul_rank": self.attention_matmul_rank, "no_reuse": self.no_reuse}
     
     def freeze_layers(self):
         """ Helper function to freeze layers that are not being finetuned """
@@ -183,6 +212,9 @@ class ClassificationModel(LightningModule):
                             param.requires_grad = False  # Freeze layer
                     elif name in self.all_linear_layers:
                         break
+                elif self.with_attention_ASI and is_attention(mod): # in_proj_weight of nn.MultiheadAttention, relative_position_bias_table of SwinT
+                    for param in mod.parameters(recurse=False):
+                        param.requires_grad = False
             return self.all_linear_layers
         else:
             for name, mod in self.named_modules():
@@ -191,6 +223,9 @@ class ClassificationModel(LightningModule):
                         mod.eval()
                         for param in mod.parameters():
                             param.requires_grad = False  # Freeze layer
+                elif self.with_attention_ASI and is_attention(mod):
+                    for param in mod.parameters(recurse=False):
+                        param.requires_grad = False
             return None
     
     def handle_finetune(self):
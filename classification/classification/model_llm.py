@@ -9,7 +9,7 @@ from utils.util import get_all_linear_with_name, get_active_linear_with_name, Ho
 from functools import reduce
 import logging
 import inspect
-from custom_op.linear.linear_ASI import Linear_ASI
+from custom_op.linear.linear_ASI import Linear_ASI, set_attention_mask, mask_padding_tokens
 
 from transformers import AutoModelForSequenceClassification, AutoTokenizer
 
@@ -22,6 +22,7 @@ class ClassificationModel(LightningModule):
                  with_HOSVD_var = False, with_ASI=False,
                  truncation_threshold=None,
                  no_reuse = False, just_log = False,
+                 with_attention_proj=False, mask_padding=True, # with_attention_proj: also finetune the q/k/v/o projections (opt in, changes which layers num_of_finetune selects)
 
                  measure_perplexity_HOSVD_var=False,
                  
@@ -65,7 +66,12 @@ class ClassificationModel(LightningModule):
         self.set_bn_eval = set_bn_eval
         self.acc = Accuracy(num_classes=num_classes)
 
-        self.all_linear_layers = get_all_linear_with_name(self) # A dictionary contains all linear layers (value) and their names (key)
+        # q/k/v/o projections (self_attn) are candidates as well as the mlp ones
+        self.linear_keywords = ['self_attn', 'mlp'] if with_attention_proj else ['mlp']
+        self.mask_padding = mask_padding # Padded tokens are excluded from the decomposition of Linear_ASI
+        self.attention_mask = None
+
+        self.all_linear_layers = get_all_linear_with_name(self, self.linear_keywords) # A dictionary contains all linear layers (value) and their names (key)
 
         if num_of_finetune == "all" or num_of_finetune > len(self.all_linear_layers):
             logging.info("[Warning] Finetuning all layers")
@@ -222,9 +228,9 @@ class ClassificationModel(LightningModule):
 
     def attach_hooks_for_linear(self, consider_active_only=False):
         if not consider_active_only:
-            linear_layers = get_all_linear_with_name(self)
+            linear_layers = get_all_linear_with_name(self, self.linear_keywords)
         else:
-            linear_layers = get_active_linear_with_name(self)
+            linear_layers = get_active_linear_with_name(self, self.linear_keywords)
         assert linear_layers != -1, "[Warning] Consider activate linear only but no linear is finetuned => No hook is attached !!"
 
         for name, mod in  linear_layers.items():
@@ -255,7 +261,12 @@ class ClassificationModel(LightningModule):
 
                 if isinstance(self.hook[name].module, Linear_ASI):
                     from custom_op.compression.hosvd_subspace_iteration import hosvd_subspace_iteration
-                    S, u_list = hosvd_subspace_iteration(self.hook[name].inputs[0], previous_Ulist=None, reuse_U=False, rank=self.suitable_ranks[layer_index])
+                    input = self.hook[name].inputs[0]
+                    L = N
+                    if self.mask_padding and self.attention_mask is not None: # Only the non-padded tokens are decomposed
+                        input, _, _ = mask_padding_tokens(input, self.attention_mask.to(input.device))
+                        L = input.shape[1]
+                    S, u_list = hosvd_subspace_iteration(input, previous_Ulist=None, reuse_U=False, rank=self.suitable_ranks[layer_index])
                     num_element_activation += S.numel() + sum(u.numel() for u in u_list)
 
 
@@ -264,11 +275,11 @@ class ClassificationModel(LightningModule):
                     
                     fw_overhead = 0
                     for K in S.shape:
-                        fw_overhead += 2*B*N*I*K + K**3
+                        fw_overhead += 2*B*L*I*K + K**3
                         
                     vanilla_fw = (B*I*O*(2*N-1))
 
-                    bw = (B*N*O*K1 + K1*K2*K3*N + K1*K3*I*N + K1*I*N*K3 + I*O*N*K1)
+                    bw = (B*L*O*K1 + K1*K2*K3*L + K1*K3*I*L + K1*I*L*K3 + I*O*L*K1)
 
                     self.num_flops_fw += fw_overhead + vanilla_fw
                     num_flops_bw += bw
@@ -446,6 +457,9 @@ class ClassificationModel(LightningModule):
         self.apply(f)
 
     def forward(self, input_ids, attention_mask):
+        if self.mask_padding:
+            self.attention_mask = attention_mask
+            set_attention_mask(self, attention_mask)
         logit = self.backbone(
                 input_ids=input_ids,
                 attention_mask=attention_mask
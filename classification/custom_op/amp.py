@@ -0,0 +1,78 @@
+import functools
+import torch as th
+
+###### Autocast for the custom autograd functions (CPU and CUDA) #############
+# torch.cuda.amp.custom_fwd/custom_bwd only know about CUDA autocast, these two also follow CPU autocast (bf16).
+# Rules:
+#   - forward: floating inputs (activations, weight, bias, S and U factors) are cast to the autocast dtype and the op runs
+#     with autocast disabled, so the convolution / projections and the saved factors are in bf16/fp16. Lists are only cast
+#     when they are declared as U factors (custom_fwd(factors=...)), the others (k_hosvd) must stay the same object
+#   - backward: runs in the same dtype as the forward, with autocast disabled (backward contractions stay in bf16/fp16)
+#   - QR and SVD always run in fp32 (see Gram_Schmidt and truncated_svd_var)
+
+def get_autocast_dtype(device_type):
+    if device_type == 'cpu':
+        return th.get_autocast_cpu_dtype() if th.is_autocast_cpu_enabled() else None
+    return th.get_autocast_gpu_dtype() if th.is_autocast_enabled() else None
+
+def cast(value, dtype):
+    if isinstance(value, th.Tensor) and value.is_floating_point():
+        return value.to(dtype=dtype)
+    return value
+
+def cast_args(args, dtype, factors=()):
+    # Only the tensors and the lists of U factors at positions factors are cast, the other containers (e.g. k_hosvd, which
+    # the op appends to) are passed as they are
+    return tuple([cast(v, dtype) for v in arg] if idx in factors and arg is not None else cast(arg, dtype)
+                 for idx, arg in enumerate(args))
+
+def custom_fwd(forward=None, *, factors=()):
+    # factors: positions of the arguments that are lists of U factors (e.g. U_list of Linear_ASI4_op)
+    if forward is None:
+        return functools.partial(custom_fwd, factors=factors)
+
+    @functools.wraps(forward)
+    def decorate_fwd(ctx, *args):
+        device_type = next(arg.device.type for arg in args if isinstance(arg, th.Tensor))
+        ctx.autocast_device = device_type
+        ctx.autocast_dtype = get_autocast_dtype(device_type)
+        if ctx.autocast_dtype is None:
+            return forward(ctx, *args)
+
+        with th.autocast(device_type=device_type, enabled=False):
+            return forward(ctx, *cast_args(args, ctx.autocast_dtype, factors))
+    return decorate_fwd
+
+def custom_bwd(backward):
+    @functools.wraps(backward)
+    def decorate_bwd(ctx, *grad_outputs):
+        if ctx.autocast_dtype is None:
+            return backward(ctx, *grad_outputs)
+
+        with th.autocast(device_type=ctx.autocast_device, enabled=False):
+            return backward(ctx, *cast_args(grad_outputs, ctx.autocast_dtype))
+    return decorate_bwd
+
+########################## Check: python -m custom_op.amp ##########################
+if __name__ == "__main__":
+    import torch.nn as nn
+    from custom_op.conv2d.conv_hosvd_var import wrap_convHOSVD_var
+    from custom_op.linear.linear_hosvd_var import Linear_HOSVD_var_op
+
+    th.manual_seed(233)
+    k_hosvd = [[], [], [], [], [], []]
+    conv = wrap_convHOSVD_var(nn.Conv2d(3, 8, 3, padding=1), True, 0.8, k_hosvd)
+    x = th.randn(4, 3, 16, 16)
+    with th.autocast(device_type='cpu', dtype=th.bfloat16):
+        y = conv(x)
+    y.float().square().mean().backward()
+    assert y.dtype == th.bfloat16 and conv.weight.grad is not None
+    assert all(len(k) == 1 for k in k_hosvd), f"k_hosvd not filled under autocast: {k_hosvd}"
+
+    k_hosvd = [[], [], [], [], []]
+    linear = nn.Linear(8, 4)
+    with th.autocast(device_type='cpu', dtype=th.bfloat16):
+        y = Linear_HOSVD_var_op.apply(th.randn(2, 5, 8), linear.weight, linear.bias, 0.8, k_hosvd)
+    y.float().sum().backward()
+    assert all(len(k) == 1 for k in k_hosvd), f"k_hosvd not filled under autocast: {k_hosvd}"
+    print("k_hosvd filled under CPU bf16 autocast:", k_hosvd[:3])
@@ -0,0 +1,288 @@
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+from torch.autograd import Function
+from torchvision.models.swin_transformer import ShiftedWindowAttention
+
+from ..compression.hosvd_subspace_iteration import hosvd_subspace_iteration, restore_hosvd
+from ..linear.linear_ASI import Linear_ASI3_op, wrap_linearASI
+
+###### HOSVD_power for the operands of attention matmuls (Q·K^T and attn·V) #############
+class Matmul_ASI_op(Function):
+    @staticmethod
+    def forward(ctx, *args):
+        a, b, S_a, U_a, S_b, U_b = args
+
+        # Infer output
+        output = torch.matmul(a, b)
+
+        # An operand without core is saved as it is (e.g. the attention probabilities, which softmax keeps anyway)
+        saved_a = [S_a] + U_a if S_a is not None else [a]
+        saved_b = [S_b] + U_b if S_b is not None else [b]
+        ctx.num_saved_a = len(saved_a)
+        ctx.save_for_backward(*saved_a, *saved_b)
+
+        return output
+
+    @staticmethod
+    def backward(ctx, grad_output):
+        # Load the information that is saved from forwardpass
+        saved_tensors = ctx.saved_tensors
+        saved_a, saved_b = saved_tensors[:ctx.num_saved_a], saved_tensors[ctx.num_saved_a:]
+
+        a = restore_hosvd(saved_a[0], list(saved_a[1:])) if len(saved_a) > 1 else saved_a[0] # Shape: (B, heads, N, D)
+        b = restore_hosvd(saved_b[0], list(saved_b[1:])) if len(saved_b) > 1 else saved_b[0] # Shape: (B, heads, D, N')
+
+        grad_a = grad_b = None
+
+        if ctx.needs_input_grad[0]:
+            grad_a = torch.matmul(grad_output, b.transpose(-2, -1)) # Shape: (B, heads, N, N') and (B, heads, N', D) -> (B, heads, N, D)
+
+        if ctx.needs_input_grad[1]:
+            grad_b = torch.matmul(a.transpose(-2, -1), grad_output) # Shape: (B, heads, D, N) and (B, heads, N, N') -> (B, heads, D, N')
+
+        return grad_a, grad_b, None, None, None, None
+
+class Matmul_ASI(nn.Module):
+    def __init__(self, activate=False, rank=None, compress_a=True, compress_b=True, no_reuse=False):
+        super(Matmul_ASI, self).__init__()
+        self.activate = activate
+        self.rank = rank
+        self.compress = [compress_a, compress_b]
+        self.reuse_U = [False, False]
+        self.u_list = [None, None]
+        self.no_reuse = no_reuse
+
+    def compress_operand(self, idx, x):
+        if not self.compress[idx]:
+            return None, None
+        S, self.u_list[idx] = hosvd_subspace_iteration(x.detach(), previous_Ulist=self.u_list[idx], reuse_U=self.reuse_U[idx], rank=self.rank)
+        if self.no_reuse == False:
+            self.reuse_U[idx] = True
+        return S, self.u_list[idx]
+
+    def forward(self, a, b):
+        if self.activate and self.rank is not None and torch.is_grad_enabled(): # Training mode
+            S_a, U_a = self.compress_operand(0, a)
+            S_b, U_b = self.compress_operand(1, b)
+            output = Matmul_ASI_op.apply(a, b, S_a, U_a, S_b, U_b)
+        else: # activate is False, no compression required or Validation mode
+            output = torch.matmul(a, b)
+        return output
+
+class MultiheadAttention_ASI(nn.MultiheadAttention):
+    """
+    nn.MultiheadAttention (self-attention, as in ViT) whose in_proj and out_proj only keep the HOSVD_power factors of their input.
+    The saved operands of Q·K^T and attn·V are also compressed when matmul_rank is given.
+    """
+    def __init__(
+            self,
+            embed_dim,
+            num_heads,
+            dropout=0.,
+            bias=True,
+            batch_first=False,
+            device=None,
+            dtype=None,
+            activate=False,
+            rank=1,
+            matmul_rank=None,
+            no_reuse=False):
+        super(MultiheadAttention_ASI, self).__init__(
+            embed_dim=embed_dim,
+            num_heads=num_heads,
+            dropout=dropout,
+            bias=bias,
+            batch_first=batch_first,
+            device=device,
+            dtype=dtype
+        )
+        self.activate = activate
+        self.rank = rank
+        self.reuse_U = False
+        self.u_list = None
+        self.no_reuse = no_reuse
+
+        self.qk_matmul = Matmul_ASI(activate=activate, rank=matmul_rank, no_reuse=no_reuse)
+        self.av_matmul = Matmul_ASI(activate=activate, rank=matmul_rank, compress_a=False, no_reuse=no_reuse)
+
+    def forward(self, query, key, value, key_padding_mask=None, need_weights=True, attn_mask=None, average_attn_weights=True):
+        is_self_attention = query is key and key is value and key_padding_mask is None and attn_mask is None
+        if not (self.activate and torch.is_grad_enabled() and is_self_attention): # activate is False, masked/cross attention or Validation mode
+            return super().forward(query, key, value, key_padding_mask=key_padding_mask, need_weights=need_weights, attn_mask=attn_mask, average_attn_weights=average_attn_weights)
+
+        x = query if self.batch_first else query.transpose(0, 1) # Shape: (B, N, E)
+        B, N, E = x.shape
+
+        S, self.u_list = hosvd_subspace_iteration(x.detach(), previous_Ulist=self.u_list, reuse_U=self.reuse_U, rank=self.rank)
+        if self.no_reuse == False:
+            self.reuse_U = True
+        qkv = Linear_ASI3_op.apply(x, self.in_proj_weight, self.in_proj_bias, S, self.u_list) # Shape: (B, N, 3E)
+
+        qkv = qkv.reshape(B, N, 3, self.num_heads, self.head_dim).permute(2, 0, 3, 1, 4) # Shape: (3, B, heads, N, D)
+        q, k, v = qkv[0], qkv[1], qkv[2]
+        q = q * self.head_dim ** -0.5
+
+        attn = self.qk_matmul(q, k.transpose(-2, -1)) # Shape: (B, heads, N, N)
+        attn = F.softmax(attn, dim=-1)
+        attn = F.dropout(attn, p=self.dropout, training=self.training)
+
+        output = self.av_matmul(attn, v).transpose(1, 2).reshape(B, N, E) # Shape: (B, heads, N, D) -> (B, N, E)
+        output = self.out_proj(output)
+
+        if not self.batch_first:
+            output = output.transpose(0, 1)
+
+        attn_weights = None
+        if need_weights:
+            attn_weights = attn.mean(dim=1) if average_attn_weights else attn
+        return output, attn_weights
+
+class ShiftedWindowAttention_ASI(nn.Module):
+    """
+    Shifted window attention of SwinT (torchvision) in which qkv and proj are Linear_ASI.
+    Both projections are applied on the (B, H, W, C) feature map instead of the partitioned windows:
+    they act token-wise, so the result is the same and the 4-mode HOSVD_power of Linear_ASI can be reused.
+    """
+    def __init__(self, attn, activate=False, rank=1, matmul_rank=None, no_reuse=False):
+        super(ShiftedWindowAttention_ASI, self).__init__()
+        self.window_size = list(attn.window_size)
+        self.shift_size = list(attn.shift_size)
+        self.num_heads = attn.num_heads
+        self.attention_dropout = attn.attention_dropout
+        self.dropout = attn.dropout
+
+        self.qkv = wrap_linearASI(attn.qkv, activate, rank, no_reuse)
+        self.proj = wrap_linearASI(attn.proj, activate, rank, no_reuse)
+        self.relative_position_bias_table = nn.Parameter(attn.relative_position_bias_table.data) # Trained: register_ASI froze the one of attn
+        self.register_buffer("relative_position_index", attn.relative_position_index)
+
+        self.qk_matmul = Matmul_ASI(activate=activate, rank=matmul_rank, no_reuse=no_reuse)
+        self.av_matmul = Matmul_ASI(activate=activate, rank=matmul_rank, compress_a=False, no_reuse=no_reuse)
+
+    def get_relative_position_bias(self):
+        N = self.window_size[0] * self.window_size[1]
+        relative_position_bias = self.relative_position_bias_table[self.relative_position_index]
+        relative_position_bias = relative_position_bias.view(N, N, -1).permute(2, 0, 1).contiguous().unsqueeze(0) # Shape: (1, heads, N, N)
+        return relative_position_bias
+
+    def get_attention_mask(self, x, pad_H, pad_W, shift_size):
+        window_size = self.window_size
+        num_windows = (pad_H // window_size[0]) * (pad_W // window_size[1])
+        attn_mask = x.new_zeros((pad_H, pad_W))
+        h_slices = ((0, -window_size[0]), (-window_size[0], -shift_size[0]), (-shift_size[0], None))
+        w_slices = ((0, -window_size[1]), (-window_size[1], -shift_size[1]), (-shift_size[1], None))
+        count = 0
+        for h in h_slices:
+            for w in w_slices:
+                attn_mask[h[0] : h[1], w[0] : w[1]] = count
+                count += 1
+        attn_mask = attn_mask.view(pad_H // window_size[0], window_size[0], pad_W // window_size[1], window_size[1])
+        attn_mask = attn_mask.permute(0, 2, 1, 3).reshape(num_windows, window_size[0] * window_size[1])
+        attn_mask = attn_mask.unsqueeze(1) - attn_mask.unsqueeze(2)
+        attn_mask = attn_mask.masked_fill(attn_mask != 0, float(-100.0)).masked_fill(attn_mask == 0, float(0.0))
+        return attn_mask # Shape: (nW, N, N)
+
+    def forward(self, x):
+        B, H, W, C = x.shape
+        window_size = self.window_size
+        shift_size = self.shift_size.copy()
+
+        # Pad feature maps to multiples of window size
+        pad_r = (window_size[1] - W % window_size[1]) % window_size[1]
+        pad_b = (window_size[0] - H % window_size[0]) % window_size[0]
+        x = F.pad(x, (0, 0, 0, pad_r, 0, pad_b))
+        _, pad_H, pad_W, _ = x.shape
+
+        # If window size is larger than feature size, there is no need to shift window
+        if window_size[0] >= pad_H:
+            shift_size[0] = 0
+        if window_size[1] >= pad_W:
+            shift_size[1] = 0
+
+        qkv = self.qkv(x) # Shape: (B, pad_H, pad_W, 3C)
+
+        # Cyclic shift
+        if sum(shift_size) > 0:
+            qkv = torch.roll(qkv, shifts=(-shift_size[0], -shift_size[1]), dims=(1, 2))
+
+        # Partition windows
+        num_windows = (pad_H // window_size[0]) * (pad_W // window_size[1])
+        N = window_size[0] * window_size[1]
+        qkv = qkv.view(B, pad_H // window_size[0], window_size[0], pad_W // window_size[1], window_size[1], 3 * C)
+        qkv = qkv.permute(0, 1, 3, 2, 4, 5).reshape(B * num_windows, N, 3, self.num_heads, C // self.num_heads)
+        qkv = qkv.permute(2, 0, 3, 1, 4) # Shape: (3, B*nW, heads, N, D)
+        q, k, v = qkv[0], qkv[1], qkv[2]
+        q = q * (C // self.num_heads) ** -0.5
+
+        attn = self.qk_matmul(q, k.transpose(-2, -1)) # Shape: (B*nW, heads, N, N)
+        attn = attn + self.get_relative_position_bias()
+
+        if sum(shift_size) > 0:
+            attn_mask = self.get_attention_mask(x, pad_H, pad_W, shift_size)
+            attn = attn.view(B, num_windows, self.num_heads, N, N)
+            attn = attn + attn_mask.unsqueeze(1).unsqueeze(0)
+            attn = attn.view(-1, self.num_heads, N, N)
+
+        attn = F.softmax(attn, dim=-1)
+        attn = F.dropout(attn, p=self.attention_dropout, training=self.training)
+
+        x = self.av_matmul(attn, v).transpose(1, 2).reshape(B * num_windows, N, C)
+
+        # Reverse windows
+        x = x.view(B, pad_H // window_size[0], pad_W // window_size[1], window_size[0], window_size[1], C)
+        x = x.permute(0, 1, 3, 2, 4, 5).reshape(B, pad_H, pad_W, C)
+
+        # Reverse cyclic shift
+        if sum(shift_size) > 0:
+            x = torch.roll(x, shifts=(shift_size[0], shift_size[1]), dims=(1, 2))
+
+        # Unpad features
+        x = x[:, :H, :W, :].contiguous()
+
+        x = self.proj(x) # Shape: (B, H, W, C)
+        x = F.dropout(x, p=self.dropout, training=self.training)
+        return x
+
+def wrap_multihead_attentionASI(mha, active, rank, matmul_rank, no_reuse):
+    has_bias = (mha.in_proj_bias is not None)
+    new_mha = MultiheadAttention_ASI(embed_dim=mha.embed_dim,
+                        num_heads=mha.num_heads,
+                        dropout=mha.dropout,
+                        bias=has_bias,
+                        batch_first=mha.batch_first,
+                        activate=active,
+                        rank=rank,
+                        matmul_rank=matmul_rank,
+                        no_reuse=no_reuse
+                        )
+    # The new in_proj is trained like out_proj (register_ASI froze the parameters of mha)
+    new_mha.in_proj_weight.data = mha.in_proj_weight.data
+    if has_bias:
+        new_mha.in_proj_bias.data = mha.in_proj_bias.data
+    new_mha.out_proj = wrap_linearASI(mha.out_proj, active, rank, no_reuse)
+    return new_mha
+
+def wrap_attentionASI(attn, active, rank, matmul_rank=None, no_reuse=False):
+    if type(attn) is nn.MultiheadAttention:
+        assert attn._qkv_same_embed_dim and attn.bias_k is None, "[Warning] Only self-attention with a packed in_proj is supported"
+        return wrap_multihead_attentionASI(attn, active, rank, matmul_rank, no_reuse)
+    elif type(attn) is ShiftedWindowAttention: # SwinT
+        return ShiftedWindowAttention_ASI(attn, activate=active, rank=rank, matmul_rank=matmul_rank, no_reuse=no_reuse)
+    else: # e.g. ShiftedWindowAttentionV2, its logit_scale and cpb_mlp would be lost
+        raise ValueError(f"Attention layer {type(attn).__name__} is not supported by ASI")
+
+########################## Check: python -m custom_op.attention.attention_ASI ##########################
+if __name__ == "__main__":
+    from custom_op.register import register_ASI
+
+    torch.manual_seed(233)
+    model = nn.Module()
+    model.attn = nn.MultiheadAttention(16, 4, batch_first=True)
+    register_ASI(model, {"type": "attention", "finetuned_layer": ["attn"], "truncation_threshold": [2], "matmul_rank": None, "no_reuse": False})
+    x = torch.randn(2, 5, 16)
+    output, _ = model.attn(x, x, x)
+    output.square().mean().backward()
+    assert model.attn.in_proj_weight.grad is not None and model.attn.in_proj_bias.grad is not None, "in_proj of the ASI attention is not trained"
+    assert model.attn.out_proj.weight.grad is not None
+    print("in_proj and out_proj of the ASI attention get gradients")
@@ -1,18 +1,24 @@
 import torch as th
 import numpy as np
+from math import prod
 
 def Gram_Schmidt(matrix):
     new_matrix = matrix.clone()
 
-    original_type = new_matrix.dtype #th.linalg.qr doesn't support helf precision types such as th.bfloat16
+    original_type = new_matrix.dtype #th.linalg.qr doesn't support half precision types such as th.bfloat16 and th.float16 => QR in fp32
     new_matrix, _ = th.linalg.qr(new_matrix.to(dtype=th.float32))
     new_matrix = new_matrix.to(dtype=original_type)
 
     return new_matrix
 
-def set_random(shape, random_seed=233, device='cuda'):
-    th.manual_seed(np.random.RandomState(random_seed).randint(1_000_000_000))
-    random_tensor = th.randn(shape, device=device)
+def set_random(shape, random_seed=233, device='cuda', generator=None):
+    # With a generator (decomposition on a worker thread), the global RNG (dropout, augmentation) is not reseeded
+    seed = np.random.RandomState(random_seed).randint(1_000_000_000)
+    if generator is None:
+        th.manual_seed(seed)
+    else:
+        generator.manual_seed(seed)
+    random_tensor = th.randn(shape, device=device, generator=generator)
     return random_tensor
 
 def unfolding(n, A):
@@ -38,34 +44,63 @@ def unfolding(n, A):
     # Reshape after permuting to get unfolded matrix
     return A.permute(sizelist).reshape(shape[n], -1)
 
-def find_U(unfolded_tensor, previous_U, reuse_U=False, rank=1, device='cuda'):
+def find_U(unfolded_tensor, previous_U, reuse_U=False, rank=1, device='cuda', generator=None):
     n, m = unfolded_tensor.shape
     rank = min(m, n, rank)
 
+    # Projections stay in the dtype of the activation (bf16/fp16 under autocast)
     if reuse_U:
-        V = th.matmul(unfolded_tensor.t(), previous_U)
+        V = th.matmul(unfolded_tensor.t(), previous_U.to(dtype=unfolded_tensor.dtype))
     else:
-        V = set_random((m, rank))
+        V = set_random((m, rank), device=unfolded_tensor.device, generator=generator).to(dtype=unfolded_tensor.dtype)
 
     U = th.matmul(unfolded_tensor, V)
     U = Gram_Schmidt(U)
 
-    return U.detach()
+    return U.to(dtype=unfolded_tensor.dtype).detach() # Autocast may have changed the dtype of the matmul
 
-def find_U_mode_n(n, A, rank, reuse_U, previous_U):
+def find_U_mode_n(n, A, rank, reuse_U, previous_U, generator=None):
     unfolded_A = unfolding(n, A)
-    return find_U(unfolded_A, previous_U, reuse_U=reuse_U, rank=rank, device='cuda')
+    return find_U(unfolded_A, previous_U, reuse_U=reuse_U, rank=rank, device='cuda', generator=generator)
 
-def hosvd_subspace_iteration(A, previous_Ulist, reuse_U, rank):
+def hosvd_subspace_iteration(A, previous_Ulist, reuse_U, rank, generator=None):
     S = A.clone()
     u_list = []
 
     if type(rank) != list: rank = [rank] * A.dim()
     # Loop over each mode of the tensor
     for i in range(A.dim()):
-        if reuse_U: previous_U = previous_Ulist[i]
+        # The size of a mode can change between iterations (smaller last batch, micro-batches of different sizes):
+        # such a mode cannot be warm started and is re-sketched from a random start
+        reuse = reuse_U and previous_Ulist[i].shape[0] == A.shape[i]
+        if reuse: previous_U = previous_Ulist[i]
         else: previous_U = None
-        u = find_U_mode_n(n=i, A=A, rank=rank[i], reuse_U=reuse_U, previous_U=previous_U)
+        u = find_U_mode_n(n=i, A=A, rank=rank[i], reuse_U=reuse, previous_U=previous_U, generator=generator)
+        # Perform tensor contraction along the ith mode
+        S = th.tensordot(S, u, dims=([0], [0]))
+        u_list.append(u)
+    return S, u_list
+
+########################## torch.compile friendly version ##########################
+def get_static_ranks(shape, rank):
+    # Rank of each mode clipped once from the shape (as in find_U), so that the shapes of the factors never change
+    if type(rank) != list: rank = [rank] * len(shape)
+    return [min(r, n, prod(shape) // n) for r, n in zip(rank, shape)]
+
+def init_U_list(shape, ranks, device, dtype, generator=None):
+    # Random orthonormal factors, without numpy and without touching the global seed
+    return [Gram_Schmidt(th.randn((n, k), device=device, generator=generator)).to(dtype=dtype) for n, k in zip(shape, ranks)]
+
+def hosvd_subspace_iteration_static(A, U_list):
+    """
+    Same as hosvd_subspace_iteration with reuse_U=True: one subspace iteration per mode, always started from U_list.
+    There is no branch and no data-dependent shape, so it can be traced by torch.compile together with the convolution.
+    """
+    S = A
+    u_list = []
+    for i in range(A.dim()):
+        unfolded_A = unfolding(i, A)
+        u = Gram_Schmidt(th.matmul(unfolded_A, th.matmul(unfolded_A.t(), U_list[i]))).to(dtype=A.dtype)
         # Perform tensor contraction along the ith mode
         S = th.tensordot(S, u, dims=([0], [0]))
         u_list.append(u)
@@ -36,8 +36,10 @@ def truncated_svd_var(X, var=0.9, return_rank=False, return_full_rank=False):
         S (torch.Tensor): Singular values (truncated).
         Vt (torch.Tensor): Right singular vectors (truncated).
     """
-    # Compute full SVD
-    U, S, Vt = th.linalg.svd(X, full_matrices=False)
+    # Compute full SVD (th.linalg.svd doesn't support half precision types => SVD in fp32)
+    original_type = X.dtype
+    U, S, Vt = th.linalg.svd(X.to(dtype=th.float32), full_matrices=False)
+    U, Vt = U.to(dtype=original_type), Vt.to(dtype=original_type)
     # Compute explained variance
     total_variance = th.sum(S**2)
     explained_variance = th.cumsum(S**2, dim=0) / total_variance
@@ -110,6 +112,35 @@ def hosvd_var(A, var=0.9, return_rank=False, return_full_rank=False):
             ex_var_list.append(r)
         return S, u_list, ex_var_list
 
+def hosvd_var_multi(A, vars, return_spectra=False):
+    """
+    HOSVD of tensor A for several explained variance thresholds, with one SVD per mode.
+    Truncating the factors commutes with the contractions, so the core of each threshold is a slice of the full core.
+
+    Args:
+        A (torch.Tensor): The tensor to be decomposed.
+        vars (list): Explained variance thresholds.
+
+    Returns:
+        S (torch.Tensor): Full core tensor, S[:K0, :K1, :K2, :K3] is the core of a threshold.
+        u_list (list): Full factor matrices, u_list[n][:, :Kn] are the factors of a threshold.
+        rank_lists (list): [K0, K1, K2, K3] of each threshold.
+        ex_var_list (list): if return_spectra, cumulative explained variance of each mode (spectrum used for the per-mode ranks).
+    """
+    S = A.clone()
+    u_list = []
+    ex_var_list = []
+    for i in range(A.dim()):
+        u, _, _, ex_var = svd_mode_n(i, A, return_full_rank=True)
+        S = th.tensordot(S, u, dims=([0], [0]))
+        u_list.append(u)
+        ex_var_list.append(th.cumsum(ex_var, dim=0))
+    # Same truncation point as truncated_svd_var
+    rank_lists = [[min(th.searchsorted(ex_var, var).item() + 1, ex_var.numel()) for ex_var in ex_var_list] for var in vars]
+    if return_spectra:
+        return S, u_list, rank_lists, ex_var_list
+    return S, u_list, rank_lists
+
 def restore_hosvd(S, u_list):
     """
     Restore the original tensor from the core tensor and factor matrices.
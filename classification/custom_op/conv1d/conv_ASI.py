@@ -0,0 +1,144 @@
+import torch as th
+from torch.autograd import Function
+from typing import Any
+from torch.nn.functional import conv1d, pad
+import torch.nn as nn
+from ..compression.hosvd_subspace_iteration import hosvd_subspace_iteration
+
+###### HOSVD_power for 3-mode activations (B, C, L) #############
+class Conv1d_ASI_op(Function):
+    @staticmethod
+    def forward(ctx: Any, *args: Any, **kwargs: Any) -> Any:
+        input, weight, bias, stride, dilation, padding, groups, S, u0, u1, u2 = args
+
+        # Perform convolution
+        output = conv1d(input, weight, bias, stride, padding, dilation=dilation, groups=groups)
+
+        # Save tensors for backward pass
+        ctx.save_for_backward(S, u0, u1, u2, weight, bias)
+        ctx.stride = stride
+        ctx.padding = padding
+        ctx.dilation = dilation
+        ctx.groups = groups
+
+        return output
+
+    @staticmethod
+    def backward(ctx: Any, *grad_outputs: Any) -> Any:
+        """
+        Backward pass for HOSVD_power Conv1d operation, computing gradients for input, weights, and bias.
+        """
+        # Retrieve saved tensors
+        S, u0, u1, u2, weight, bias = ctx.saved_tensors
+        B, C, L = u0.shape[0], u1.shape[0], u2.shape[0]
+        stride = ctx.stride
+        padding = ctx.padding
+        dilation = ctx.dilation
+        groups = ctx.groups
+
+        grad_input = grad_weight = grad_bias = None
+        grad_output, = grad_outputs
+
+        # Compute gradient with respect to the input
+        if ctx.needs_input_grad[0]:
+            grad_input = nn.grad.conv1d_input((B, C, L), weight, grad_output, stride, padding, dilation, groups)
+
+        # Compute gradient with respect to the weights
+        if ctx.needs_input_grad[1]:
+            _, _, K_L = weight.shape # Shape: (C', C, K_L)
+            _, C_prime, L_prime = grad_output.shape # Shape: (B, C', L')
+
+            # Pad the input
+            u2_padded = pad(u2, (0, 0, padding[0], padding[0])) # Shape: (L_padded, K2)
+            # Calculate Z1: (conv1d 1x1):
+            Z1 = th.einsum("bk,bcl->kcl", u0, grad_output) # Shape: (B, K0) einsum with (B, C', L') -> (K0, C', L')
+            #______________________________________________________________________________________________________________
+            # Calculate Z2: (conv1d 1x1):
+            Z2 = th.einsum("abc,lc->abl", S, u2_padded) # Shape: (K0, K1, K2) einsum with (L_padded, K2) -> (K0, K1, L_padded)
+            # ______________________________________________________________________________________________________________
+            # Calculate Z3: (conv1d L'):
+            if stride[0] == dilation[0] == 1:
+                Z3 = conv1d(Z2.permute(1, 0, 2), Z1.permute(1, 0, 2)).permute(1, 0, 2) # Shape: (K1, K0, L_padded) conv with (C', K0, L') --> (K1, C', K_L) -> (C', K1, K_L)
+            else:
+                Z3 = nn.grad.conv1d_weight(Z2, (C_prime, u1.shape[1], K_L), Z1, stride=stride, dilation=dilation, groups=1) # Shape (C', K1, K_L)
+            #______________________________________________________________________________________________________________
+            # calculate grad_weight
+            if groups == C == C_prime: # Depthwise
+                grad_weight = th.einsum("ckl,ck->ckl", Z3, u1).sum(dim=1, keepdim=True) # Shape: (C', 1, K_L)
+            elif groups == 1:
+                grad_weight = conv1d(Z3, u1.unsqueeze(-1)) # Shape: (C', K1, K_L) conv with (C, K1, 1) -> (C', C, K_L)
+            else:
+                pass
+
+        if bias is not None and ctx.needs_input_grad[2]:
+            grad_bias = grad_output.sum((0, 2)).squeeze(0)
+
+        return grad_input, grad_weight, grad_bias, None, None, None, None, None, None, None, None
+
+class Conv1d_ASI(nn.Conv1d):
+    """
+    Custom Conv1D layer with HOSVD_power-based decomposition.
+    """
+    def __init__(
+            self,
+            in_channels: int,
+            out_channels: int,
+            kernel_size,
+            stride=1,
+            dilation=1,
+            groups=1,
+            bias=True,
+            padding=0,
+            device=None,
+            dtype=None,
+            activate=False,
+            rank=1,
+            no_reuse=False
+    ) -> None:
+        super(Conv1d_ASI, self).__init__(in_channels=in_channels,
+                                        out_channels=out_channels,
+                                        kernel_size=kernel_size,
+                                        stride=stride,
+                                        dilation=dilation,
+                                        groups=groups,
+                                        bias=bias,
+                                        padding=padding,
+                                        padding_mode='zeros',
+                                        device=device,
+                                        dtype=dtype)
+        self.activate = activate
+        self.rank = rank
+        self.reuse_U = False
+        self.u_list = None
+        self.no_reuse=no_reuse
+
+    def forward(self, x: th.Tensor) -> th.Tensor:
+        if self.activate and th.is_grad_enabled(): # Training mode
+            S, self.u_list = hosvd_subspace_iteration(x, previous_Ulist=self.u_list, reuse_U=self.reuse_U, rank=self.rank)
+            if self.no_reuse == False:
+                self.reuse_U = True
+
+            u0, u1, u2 = self.u_list # B, C, L
+            y = Conv1d_ASI_op.apply(x, self.weight, self.bias, self.stride, self.dilation, self.padding, self.groups, S, u0, u1, u2)
+
+        else: # activate is False or Inference mode
+            y = super().forward(x)
+        return y
+
+def wrap_conv1dASI(conv, active, rank, no_reuse=False):
+    new_conv = Conv1d_ASI(in_channels=conv.in_channels,
+                         out_channels=conv.out_channels,
+                         kernel_size=conv.kernel_size,
+                         stride=conv.stride,
+                         dilation=conv.dilation,
+                         bias=conv.bias is not None,
+                         groups=conv.groups,
+                         padding=conv.padding,
+                         activate=active,
+                         rank=rank,
+                         no_reuse=no_reuse
+                         )
+    new_conv.weight.data = conv.weight.data
+    if new_conv.bias is not None:
+        new_conv.bias.data = conv.bias.data
+    return new_conv
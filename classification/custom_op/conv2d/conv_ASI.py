@@ -3,13 +3,61 @@ from torch.autograd import Function
 from typing import Any
 from torch.nn.functional import conv2d, pad
 import torch.nn as nn
-from ..compression.hosvd_subspace_iteration import hosvd_subspace_iteration
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from ..compression.hosvd_subspace_iteration import hosvd_subspace_iteration, hosvd_subspace_iteration_static, get_static_ranks, init_U_list
+from ..amp import custom_fwd, custom_bwd
+try:
+    from torch._dynamo import disable as dynamo_disable
+except ImportError: # No torch.compile
+    dynamo_disable = lambda fn: fn
+
+_executor = None
+_num_workers = 1
+_inflight = deque() # Decompositions submitted and not finished, in submission order
+
+def get_executor(num_workers=1):
+    # One pool shared by all Conv2d_ASI layers, created at the first asynchronous decomposition (num_workers of the first call)
+    global _executor, _num_workers
+    if _executor is None:
+        _executor = ThreadPoolExecutor(max_workers=num_workers)
+        _num_workers = num_workers
+    return _executor
+
+def submit_decomposition(num_workers, *args):
+    # A pending decomposition keeps its input alive: at most num_workers of them are in flight, the forward pass waits for
+    # the oldest one beyond that, so async mode holds at most num_workers more inputs than the synchronous mode
+    executor = get_executor(num_workers)
+    while len(_inflight) > 0 and _inflight[0].done():
+        _inflight.popleft()
+    while len(_inflight) >= _num_workers:
+        _inflight.popleft().result()
+    future = executor.submit(decompose, *args)
+    _inflight.append(future)
+    return future
+
+class GradFactors:
+    """
+    Weight gradient of a Conv2d_ASI kept in factored form: a list of (Z4, u1) with Z4 (C', K1, K_H, K_W) and u1 (C, K1),
+    the full gradient being the sum of conv2d(Z4, u1) over the list (one item per backward pass since the last zero_grad).
+    """
+    def __init__(self):
+        self.factors = []
+
+    def clear(self):
+        self.factors.clear()
+
+def decompose(x, previous_Ulist, reuse_U, rank, generator):
+    with th.no_grad(): # Grad mode is per thread
+        return hosvd_subspace_iteration(x, previous_Ulist=previous_Ulist, reuse_U=reuse_U, rank=rank, generator=generator)
 
 ###### HOSVD_power base on variance #############
 class Conv2d_ASI_op(Function):
     @staticmethod
+    @custom_fwd
     def forward(ctx: Any, *args: Any, **kwargs: Any) -> Any:
-        input, weight, bias, stride, dilation, padding, groups, S, u0, u1, u2, u3= args
+        input, weight, bias, stride, dilation, padding, groups, S, u0, u1, u2, u3, grad_factors = args
 
         # Perform convolution
         output = conv2d(input, weight, bias, stride, padding, dilation=dilation, groups=groups)
@@ -20,64 +68,112 @@ class Conv2d_ASI_op(Function):
         ctx.padding = padding
         ctx.dilation = dilation
         ctx.groups = groups
+        ctx.grad_factors = grad_factors
 
         return output
 
     @staticmethod
+    @custom_bwd
     def backward(ctx: Any, *grad_outputs: Any) -> Any:
         """
         Backward pass for HOSVD_power Conv2d operation, computing gradients for input, weights, and bias.
         """
         # Retrieve saved tensors
         S, u0, u1, u2, u3, weight, bias  = ctx.saved_tensors
-        B, C, H, W = u0.shape[0], u1.shape[0], u2.shape[0], u3.shape[0]
-        stride = ctx.stride
-        padding = ctx.padding 
-        dilation = ctx.dilation
-        groups = ctx.groups
+        grad_output, = grad_outputs
+
+        grad_input, grad_weight, grad_bias = conv2d_ASI_backward(ctx, grad_output, S, u0, u1, u2, u3, weight, bias)
+
+        return grad_input, grad_weight, grad_bias, None, None, None, None, None, None, None, None, None, None
+
+def conv2d_ASI_backward(ctx, grad_output, S, u0, u1, u2, u3, weight, bias):
+    # Shared by Conv2d_ASI_op and Conv2d_ASI_async_op
+    B, C, H, W = u0.shape[0], u1.shape[0], u2.shape[0], u3.shape[0]
+    stride = ctx.stride
+    padding = ctx.padding 
+    dilation = ctx.dilation
+    groups = ctx.groups
+
+    grad_input = grad_weight = grad_bias = None
+
+    # Compute gradient with respect to the input
+    if ctx.needs_input_grad[0]:
+        grad_input = nn.grad.conv2d_input((B,C,H,W), weight, grad_output, stride, padding, dilation, groups)
+
+    # Compute gradient with respect to the weights
+    if ctx.needs_input_grad[1]:
+        _, _, K_H, K_W = weight.shape # Shape: (C', C, K_H, K_W)
+        _, C_prime, H_prime, W_prime = grad_output.shape # Shape: (B, C', H', W')
+
+        # Pad the input
+        u2_padded = pad(u2, (0, 0, padding[0], padding[0])) # Shape: (H_padded, K2)
+        u3_padded = pad(u3, (0, 0, padding[0], padding[0])) # Shape: (W_padded, K3)
+        # Calculate Z1: (conv2d 1x1):
+        Z1 = th.einsum("bk,bchw->kchw", u0, grad_output) # Shape: (B, K0) einsum with (B, C', H', W') -> (B, K0, C', H', W') -> (K0, C', H', W')
+        #______________________________________________________________________________________________________________
+        # Calculate Z2: (conv2d 1x1):
+        Z2 = th.einsum("abcd,hc->abhd", S, u2_padded) # Shape: (K0, K1, K2, K3) einsum with (H_padded, K2) -> (K0, K1, H_padded, K2, K3) -> (K0, K1, H_padded, K3)
+        #______________________________________________________________________________________________________________
+        # Calculate Z3: (conv2d 1x1):
+        Z3 = th.einsum("abhd,wd->abhw", Z2, u3_padded) # Shape: (K0, K1, H_padded, K3) einsum with (W_padded, K3) -> (K0, K1, H_padded, W_padded, K3) -> (K0, K1, H_padded, W_padded)
+        # ______________________________________________________________________________________________________________
+        # Calculate Z4: (conv2d H'xW'):
+        if stride == dilation:
+            Z4 = conv2d(Z3.permute(1, 0, 2, 3), Z1.permute(1, 0, 2, 3)).permute(1, 0, 2, 3) # Shape: (K1, K0, H_padded, W_padded) conv with (C', K0, H', W') --> (K1, C', K_H, K_W) -> (C', K1, K_H, K_W)
+        else:
+            Z4 = nn.grad.conv2d_weight(Z3, (C_prime, u1.shape[1], K_H, K_W), Z1, stride=stride, dilation=dilation, groups=1) # Shape (C', K1, K_H, K_W)
+        #______________________________________________________________________________________________________________
+        # calculate grad_weight
+        if groups == C == C_prime: # Depthwise
+            grad_weight = th.einsum("ckhw,ck->ckhw", Z4, u1).sum(dim=1, keepdim=True) # Shape: (C', 1, K_H, K_W)
+        elif groups == 1 and ctx.grad_factors is not None: # Factored gradient: the optimizer works with (Z4, u1) directly
+            ctx.grad_factors.factors.append((Z4, u1))
+        elif groups == 1:
+            grad_weight = conv2d(Z4, u1.unsqueeze(-1).unsqueeze(-1)) # Shape: (C', K1, K_H, K_W) conv with (C, K1, 1, 1) -> (C', C, K_H, K_W)
+        else:
+            pass
+
+    if bias is not None and ctx.needs_input_grad[2]:
+        grad_bias = grad_output.sum((0, 2, 3)).squeeze(0)
+
+    return grad_input, grad_weight, grad_bias
 
-        grad_input = grad_weight = grad_bias = None
+class Conv2d_ASI_async_op(Function):
+    """
+    Same as Conv2d_ASI_op, but the factors are given as a Future: the decomposition runs on a worker thread
+    while the next layers are computed, and the backward pass waits for it if it is not finished yet.
+    """
+    @staticmethod
+    @custom_fwd
+    def forward(ctx: Any, *args: Any, **kwargs: Any) -> Any:
+        input, weight, bias, stride, dilation, padding, groups, future, grad_factors = args
+
+        # Perform convolution
+        output = conv2d(input, weight, bias, stride, padding, dilation=dilation, groups=groups)
+
+        # Save tensors for backward pass (the input is only referenced by the worker until its factors are ready)
+        ctx.save_for_backward(weight, bias)
+        ctx.future = future
+        ctx.stride = stride
+        ctx.padding = padding
+        ctx.dilation = dilation
+        ctx.groups = groups
+        ctx.grad_factors = grad_factors
+
+        return output
+
+    @staticmethod
+    @custom_bwd
+    def backward(ctx: Any, *grad_outputs: Any) -> Any:
+        weight, bias = ctx.saved_tensors
+        S, (u0, u1, u2, u3) = ctx.future.result() # Block if the decomposition is still pending
+        S, u0, u1, u2, u3 = [t.to(dtype=weight.dtype) for t in [S, u0, u1, u2, u3]] # The worker does not see the autocast state
+        ctx.future = None
         grad_output, = grad_outputs
 
-        # Compute gradient with respect to the input
-        if ctx.needs_input_grad[0]:
-            grad_input = nn.grad.conv2d_input((B,C,H,W), weight, grad_output, stride, padding, dilation, groups)
-
-        # Compute gradient with respect to the weights
-        if ctx.needs_input_grad[1]:
-            _, _, K_H, K_W = weight.shape # Shape: (C', C, K_H, K_W)
-            _, C_prime, H_prime, W_prime = grad_output.shape # Shape: (B, C', H', W')
-
-            # Pad the input
-            u2_padded = pad(u2, (0, 0, padding[0], padding[0])) # Shape: (H_padded, K2)
-            u3_padded = pad(u3, (0, 0, padding[0], padding[0])) # Shape: (W_padded, K3)
-            # Calculate Z1: (conv2d 1x1):
-            Z1 = th.einsum("bk,bchw->kchw", u0, grad_output) # Shape: (B, K0) einsum with (B, C', H', W') -> (B, K0, C', H', W') -> (K0, C', H', W')
-            #______________________________________________________________________________________________________________
-            # Calculate Z2: (conv2d 1x1):
-            Z2 = th.einsum("abcd,hc->abhd", S, u2_padded) # Shape: (K0, K1, K2, K3) einsum with (H_padded, K2) -> (K0, K1, H_padded, K2, K3) -> (K0, K1, H_padded, K3)
-            #______________________________________________________________________________________________________________
-            # Calculate Z3: (conv2d 1x1):
-            Z3 = th.einsum("abhd,wd->abhw", Z2, u3_padded) # Shape: (K0, K1, H_padded, K3) einsum with (W_padded, K3) -> (K0, K1, H_padded, W_padded, K3) -> (K0, K1, H_padded, W_padded)
-            # ______________________________________________________________________________________________________________
-            # Calculate Z4: (conv2d H'xW'):
-            if stride == dilation:
-                Z4 = conv2d(Z3.permute(1, 0, 2, 3), Z1.permute(1, 0, 2, 3)).permute(1, 0, 2, 3) # Shape: (K1, K0, H_padded, W_padded) conv with (C', K0, H', W') --> (K1, C', K_H, K_W) -> (C', K1, K_H, K_W)
-            else:
-                Z4 = nn.grad.conv2d_weight(Z3, (C_prime, u1.shape[1], K_H, K_W), Z1, stride=stride, dilation=dilation, groups=1) # Shape (C', K1, K_H, K_W)
-            #______________________________________________________________________________________________________________
-            # calculate grad_weight
-            if groups == C == C_prime: # Depthwise
-                grad_weight = th.einsum("ckhw,ck->ckhw", Z4, u1).sum(dim=1, keepdim=True) # Shape: (C', 1, K_H, K_W)
-            elif groups == 1:
-                grad_weight = conv2d(Z4, u1.unsqueeze(-1).unsqueeze(-1)) # Shape: (C', K1, K_H, K_W) conv with (C, K1, 1, 1) -> (C', C, K_H, K_W)
-            else:
-                pass
-
-        if bias is not None and ctx.needs_input_grad[2]:
-            grad_bias = grad_output.sum((0, 2, 3)).squeeze(0)
-
-        return grad_input, grad_weight, grad_bias, None, None, None, None, None, None, None, None, None
+        grad_input, grad_weight, grad_bias = conv2d_ASI_backward(ctx, grad_output, S, u0, u1, u2, u3, weight, bias)
+
+        return grad_input, grad_weight, grad_bias, None, None, None, None, None, None
 
 class Conv2d_ASI(nn.Conv2d):
     """
@@ -97,7 +193,11 @@ class Conv2d_ASI(nn.Conv2d):
             dtype=None,
             activate=False,
             rank=1,
-            no_reuse=False
+            no_reuse=False,
+            async_decomposition=False,
+            compile_friendly=False,
+            factored_grad=False,
+            async_workers=1
     ) -> None:
         if kernel_size is int:
             kernel_size = [kernel_size, kernel_size]
@@ -121,23 +221,104 @@ class Conv2d_ASI(nn.Conv2d):
         self.reuse_U = False
         self.u_list = None
         self.no_reuse=no_reuse
+        self.async_decomposition = async_decomposition
+        self.pending = None # Future of the last asynchronous decomposition
+        self.async_workers = async_workers # Threads of the pool shared by the layers (the first layer to submit creates it)
+        self.generator = None # RNG of the asynchronous decompositions of this layer, the global one is left to the main thread
+        self.compile_friendly = compile_friendly
+        self.decomposition_time = 0. # Seconds spent in the decomposition (only the blocking part with async_decomposition)
+        if factored_grad: # The weight gets no .grad, its gradient is kept in self.weight.grad_factors (see utils/low_rank_optimizer.py)
+            self.weight.grad_factors = GradFactors()
+        if self.compile_friendly: # Factors for warm start are kept in buffers with static shapes (not saved in the checkpoint)
+            for i in range(4):
+                self.register_buffer(f'u{i}', None, persistent=False)
+
+    def get_grad_factors(self):
+        return getattr(self.weight, 'grad_factors', None)
+
+    @dynamo_disable
+    def init_U_buffers(self, shape, device, dtype):
+        # Allocation of the buffers for an input of this shape, kept out of the compiled graph: call allocate_U_buffers
+        # before th.compile, afterwards it only runs (with a graph break) when the input shape changes.
+        # Only the batch mode is re-sketched when the batch size changes (smaller last batch, micro-batches) unless the
+        # ranks of the other modes change as well
+        ranks = get_static_ranks(shape, self.rank)
+        generator = th.Generator(device=device).manual_seed(233)
+        if self.u0 is None or [tuple(u.shape) for u in [self.u1, self.u2, self.u3]] != [(n, k) for n, k in zip(shape[1:], ranks[1:])]:
+            for i, u in enumerate(init_U_list(shape, ranks, device, dtype, generator=generator)):
+                setattr(self, f'u{i}', u)
+        else:
+            self.u0 = init_U_list(shape[:1], ranks[:1], device, dtype, generator=generator)[0]
+
+    def get_U_buffers(self, x):
+        # Only depends on the shape of x
+        ranks = get_static_ranks(list(x.shape), self.rank)
+        if self.u0 is None or [tuple(u.shape) for u in [self.u0, self.u1, self.u2, self.u3]] != [(n, k) for n, k in zip(x.shape, ranks)]:
+            self.init_U_buffers(list(x.shape), x.device, x.dtype)
+        elif self.no_reuse:
+            with th.no_grad():
+                for u in [self.u0, self.u1, self.u2, self.u3]:
+                    u.copy_(th.linalg.qr(th.randn(u.shape, device=u.device))[0])
+        return [self.u0, self.u1, self.u2, self.u3]
 
     def forward(self, x: th.Tensor) -> th.Tensor:
-        if self.activate and th.is_grad_enabled(): # Training mode
+        return self.ASI_forward(x, self.weight)
+
+    def ASI_forward(self, x, weight):
+        # The weight is given so that Conv2d_ASI_QAT can pass its fake-quantized weight
+        start = time.perf_counter()
+        if self.activate and th.is_grad_enabled() and self.async_decomposition: # Training mode, decomposition overlapped with the next layers
+            if self.pending is not None: # Factors of the previous iteration are needed for warm start
+                _, self.u_list = self.pending.result()
+                self.pending = None
+
+            if self.generator is None:
+                self.generator = th.Generator(device=x.device)
+            self.pending = submit_decomposition(self.async_workers, x.detach(), self.u_list, self.reuse_U, self.rank, self.generator)
+            if self.no_reuse == False:
+                self.reuse_U = True
+            self.decomposition_time += time.perf_counter() - start
+
+            y = Conv2d_ASI_async_op.apply(x, weight, self.bias, self.stride, self.dilation, self.padding, self.groups, self.pending, self.get_grad_factors())
+
+        elif self.activate and th.is_grad_enabled() and self.compile_friendly: # Training mode, no graph break between decomposition and convolution
+            S, u_list = hosvd_subspace_iteration_static(x.detach(), self.get_U_buffers(x))
+            with th.no_grad():
+                for u_buffer, u in zip([self.u0, self.u1, self.u2, self.u3], u_list):
+                    u_buffer.copy_(u)
+            self.decomposition_time += time.perf_counter() - start
+
+            u0, u1, u2, u3 = u_list # B, C, H, W
+            y = Conv2d_ASI_op.apply(x, weight, self.bias, self.stride, self.dilation, self.padding, self.groups, S, u0, u1, u2, u3, self.get_grad_factors())
+
+        elif self.activate and th.is_grad_enabled(): # Training mode
             S, self.u_list = hosvd_subspace_iteration(x, previous_Ulist=self.u_list, reuse_U=self.reuse_U, rank=self.rank)
             if self.no_reuse == False:
                 self.reuse_U = True
+            self.decomposition_time += time.perf_counter() - start
 
             u_list = self.u_list
             u0, u1, u2, u3 = u_list # B, C, H, W
-            y = Conv2d_ASI_op.apply(x, self.weight, self.bias, self.stride, self.dilation, self.padding, self.groups, S, u0, u1, u2, u3)
+            y = Conv2d_ASI_op.apply(x, weight, self.bias, self.stride, self.dilation, self.padding, self.groups, S, u0, u1, u2, u3, self.get_grad_factors())
         
 
         else: # activate is False or Inference mode
-            y = super().forward(x)
+            y = self._conv_forward(x, weight, self.bias)
         return y
 
-def wrap_convASI(conv, active, rank, no_reuse=False):
+def allocate_U_buffers(model, x):
+    # Allocate the buffers of the compile_friendly Conv2d_ASI of model for the input x of the model, before th.compile
+    def pre_hook(module, args):
+        module.init_U_buffers(list(args[0].shape), args[0].device, args[0].dtype)
+    handles = [mod.register_forward_pre_hook(pre_hook) for mod in model.modules() if isinstance(mod, Conv2d_ASI) and mod.compile_friendly]
+    try:
+        with th.no_grad():
+            model(x)
+    finally:
+        for handle in handles:
+            handle.remove()
+
+def wrap_convASI(conv, active, rank, no_reuse=False, async_decomposition=False, compile_friendly=False, factored_grad=False, async_workers=1):
     new_conv = Conv2d_ASI(in_channels=conv.in_channels,
                          out_channels=conv.out_channels,
                          kernel_size=conv.kernel_size,
@@ -148,9 +329,107 @@ def wrap_convASI(conv, active, rank, no_reuse=False):
                          padding=conv.padding,
                          activate=active,
                          rank=rank,
-                         no_reuse=no_reuse
+                         no_reuse=no_reuse,
+                         async_decomposition=async_decomposition,
+                         compile_friendly=compile_friendly,
+                         factored_grad=factored_grad,
+                         async_workers=async_workers
+                         )
+    new_conv.weight.data = conv.weight.data
+    if new_conv.bias is not None:
+        new_conv.bias.data = conv.bias.data
+    return new_conv
+
+class Conv2d_ASI_QAT(Conv2d_ASI):
+    """
+    Conv2d_ASI with fake-quantized weight (quantization-aware fine-tuning): the forward uses the fake-quantized weight,
+    the weight gradient is still computed from the low-rank factors of the input.
+    """
+    _FLOAT_MODULE = Conv2d_ASI
+
+    def __init__(self,
+                 in_channels: int,
+                 out_channels: int,
+                 kernel_size,
+                 stride=1,
+                 dilation=1,
+                 groups=1,
+                 bias=True,
+                 padding=0,
+                 device=None,
+                 dtype=None,
+                 activate=False,
+                 rank=1,
+                 no_reuse=False,
+                 qconfig=None) -> None:
+        super().__init__(in_channels, out_channels, kernel_size,
+                         stride=stride, dilation=dilation, groups=groups, bias=bias, padding=padding,
+                         device=device, dtype=dtype, activate=activate, rank=rank, no_reuse=no_reuse)
+        assert qconfig, 'qconfig must be provided for QAT module'
+        factory_kwargs = {'device': device, 'dtype': dtype}
+        self.qconfig = qconfig
+        self.weight_fake_quant = qconfig.weight(factory_kwargs=factory_kwargs)
+
+    def forward(self, x: th.Tensor) -> th.Tensor:
+        return self.ASI_forward(x, self.weight_fake_quant(self.weight))
+
+    @classmethod
+    def from_float(cls, mod, use_precomputed_fake_quant=False):
+        r"""Create a qat module from a float module, either produced by torch.ao.quantization utilities or directly from user
+        """
+        assert type(mod) == cls._FLOAT_MODULE, 'qat.' + cls.__name__ + '.from_float only works for ' + \
+            cls._FLOAT_MODULE.__name__
+        assert hasattr(
+            mod, 'qconfig'), 'Input float module must have qconfig defined'
+        assert mod.qconfig, 'Input float module must have a valid qconfig'
+        qat_conv = cls(mod.in_channels, mod.out_channels, mod.kernel_size,
+                       stride=mod.stride, dilation=mod.dilation, groups=mod.groups, bias=mod.bias is not None,
+                       padding=mod.padding, activate=mod.activate, rank=mod.rank, no_reuse=mod.no_reuse, qconfig=mod.qconfig)
+        qat_conv.weight = mod.weight
+        qat_conv.bias = mod.bias
+        # Keep the warm start
+        qat_conv.u_list = mod.u_list
+        qat_conv.reuse_U = mod.reuse_U
+        return qat_conv
+
+    def to_float(self):
+        conv = Conv2d_ASI(
+            self.in_channels,
+            self.out_channels,
+            self.kernel_size,
+            stride=self.stride,
+            dilation=self.dilation,
+            groups=self.groups,
+            bias=self.bias is not None,
+            padding=self.padding,
+            device=self.weight.device,
+            dtype=self.weight.dtype,
+            activate=self.activate,
+            rank=self.rank,
+            no_reuse=self.no_reuse
+        )
+        conv.weight = nn.Parameter(self.weight.detach())
+        if self.bias is not None:
+            conv.bias = nn.Parameter(self.bias.detach())
+        conv.u_list = self.u_list
+        conv.reuse_U = self.reuse_U
+        return conv
+
+def wrap_convASI_QAT(conv, active, rank, qconfig, no_reuse=False):
+    new_conv = Conv2d_ASI_QAT(in_channels=conv.in_channels,
+                         out_channels=conv.out_channels,
+                         kernel_size=conv.kernel_size,
+                         stride=conv.stride,
+                         dilation=conv.dilation,
+                         bias=conv.bias is not None,
+                         groups=conv.groups,
+                         padding=conv.padding,
+                         activate=active,
+                         rank=rank,
+                         no_reuse=no_reuse,
+                         qconfig=qconfig
                          )
     new_conv.weight.data = conv.weight.data
     if new_conv.bias is not None:
         new_conv.bias.data = conv.bias.data
-    return new_conv
\ No newline at end of file
+    return new_conv
@@ -209,6 +209,7 @@ class Conv2dAvgQAT(Conv2dAvg):
                  kernel_size,
                  order=4,
                  stride=1,
+                 dilation=1,
                  groups=1,
                  bias=True,
                  padding=0,
@@ -217,8 +218,8 @@ class Conv2dAvgQAT(Conv2dAvg):
                  activate=False,
                  qconfig=None) -> None:
         super().__init__(in_channels, out_channels, kernel_size,
-                         order, stride, groups, bias, padding,
-                         device, dtype, activate)
+                         order=order, stride=stride, dilation=dilation, groups=groups, bias=bias, padding=padding,
+                         device=device, dtype=dtype, activate=activate)
         factory_kwargs = {'device': device, 'dtype': dtype}
         self.qconfig = qconfig
         self.weight_fake_quant = qconfig.weight(factory_kwargs=factory_kwargs)
@@ -226,15 +227,19 @@ class Conv2dAvgQAT(Conv2dAvg):
 
     def forward(self, x: th.Tensor):
         weight = self.weight_fake_quant(self.weight)
-        if self.activate:
-            y = Conv2dAvgOp.apply(x, weight, self.bias, self.stride,
-                                  self.padding, self.order, self.groups)
+        if self.activate and th.is_grad_enabled():
+            if self.dilation[0] == 1 or self.dilation[0] < self.order:
+                y = Conv2dAvgOp.apply(x, weight, self.bias, self.stride, self.dilation,
+                                      self.padding, self.order, self.groups)
+            else:
+                y = Conv2dDilatedOp.apply(x, weight, self.bias, self.stride, self.dilation,
+                                          self.padding, self.order, self.groups)
         else:
-            y = conv2d(x, weight, self.bias, self.stride, self.padding)
+            y = conv2d(x, weight, self.bias, self.stride, self.padding, self.dilation, self.groups)
         return y
 
     @classmethod
-    def from_float(cls, mod):
+    def from_float(cls, mod, use_precomputed_fake_quant=False):
         r"""Create a qat module from a float module or qparams_dict
 
             Args: `mod` a float module, either produced by torch.ao.quantization utilities
@@ -247,8 +252,8 @@ class Conv2dAvgQAT(Conv2dAvg):
         assert mod.qconfig, 'Input float module must have a valid qconfig'
         qconfig = mod.qconfig
         qat_conv = cls(mod.in_channels, mod.out_channels, mod.kernel_size,
-                       mod.order, mod.stride, mod.groups, mod.bias is not None,
-                       mod.padding, activate=mod.activate, qconfig=qconfig)
+                       order=mod.order, stride=mod.stride, dilation=mod.dilation, groups=mod.groups, bias=mod.bias is not None,
+                       padding=mod.padding, activate=mod.activate, qconfig=qconfig)
         qat_conv.weight = mod.weight
         qat_conv.bias = mod.bias
         return qat_conv
@@ -258,14 +263,15 @@ class Conv2dAvgQAT(Conv2dAvg):
             self.in_channels,
             self.out_channels,
             self.kernel_size,  # type: ignore[arg-type]
-            self.order,
-            self.stride,  # type: ignore[arg-type]
-            self.groups,
-            self.bias is not None,
-            self.padding,  # type: ignore[arg-type]
-            self.device,
-            self.dtype,
-            self.activate
+            order=self.order,
+            stride=self.stride,  # type: ignore[arg-type]
+            dilation=self.dilation,
+            groups=self.groups,
+            bias=self.bias is not None,
+            padding=self.padding,  # type: ignore[arg-type]
+            device=self.weight.device,
+            dtype=self.weight.dtype,
+            activate=self.activate
         )
         conv.weight = nn.Parameter(self.weight.detach())
         if self.bias is not None:
@@ -4,10 +4,12 @@ from typing import Any
 from torch.nn.functional import conv2d, pad
 import torch.nn as nn
 from ..compression.hosvd_var import hosvd_var
+from ..amp import custom_fwd, custom_bwd
 
 ###### HOSVD base on explained variance threshold #############
 class Conv2d_HOSVD_var_op(Function):
     @staticmethod
+    @custom_fwd
     def forward(ctx: Any, *args: Any, **kwargs: Any) -> Any:
         input, weight, bias, stride, dilation, padding, groups, var, k_hosvd = args
 
@@ -34,6 +36,7 @@ class Conv2d_HOSVD_var_op(Function):
         return output
 
     @staticmethod
+    @custom_bwd
     def backward(ctx: Any, *grad_outputs: Any) -> Any:
         # Retrieve saved tensors
         S, u0, u1, u2, u3, weight, bias  = ctx.saved_tensors
@@ -3,14 +3,56 @@ from torch.autograd import Function
 from typing import Any
 from torch.nn.functional import conv2d, pad
 import torch.nn as nn
-from ..compression.hosvd_var import hosvd_var
+from ..compression.hosvd_var import hosvd_var, hosvd_var_multi
+from .conv_avg import Conv2dAvgOp, Conv2dDilatedOp
+from utils.planner import ASI_cost, vanilla_cost
+
+def low_rank_grad_weight(Z1, S, u1, u2, u3, weight_shape, stride, dilation, padding, groups):
+    """
+    Weight gradient from the HOSVD of the input (core S, factors u1, u2, u3) and Z1 = u0^T grad_output, same steps as Conv2d_ASI.
+    """
+    C_prime, _, K_H, K_W = weight_shape # Shape: (C', C, K_H, K_W)
+    C = u1.shape[0]
+
+    # Pad the input
+    u2_padded = pad(u2, (0, 0, padding[0], padding[0])) # Shape: (H_padded, K2)
+    u3_padded = pad(u3, (0, 0, padding[0], padding[0])) # Shape: (W_padded, K3)
+    #______________________________________________________________________________________________________________
+    # Calculate Z2: (conv2d 1x1):
+    Z2 = th.einsum("abcd,hc->abhd", S, u2_padded) # Shape: (K0, K1, K2, K3) einsum with (H_padded, K2) -> (K0, K1, H_padded, K2, K3) -> (K0, K1, H_padded, K3)
+    #______________________________________________________________________________________________________________
+    # Calculate Z3: (conv2d 1x1):
+    Z3 = th.einsum("abhd,wd->abhw", Z2, u3_padded) # Shape: (K0, K1, H_padded, K3) einsum with (W_padded, K3) -> (K0, K1, H_padded, W_padded, K3) -> (K0, K1, H_padded, W_padded)
+    # ______________________________________________________________________________________________________________
+    # Calculate Z4: (conv2d H'xW'):
+    if stride == dilation:
+        Z4 = conv2d(Z3.permute(1, 0, 2, 3), Z1.permute(1, 0, 2, 3)).permute(1, 0, 2, 3) # Shape: (K1, K0, H_padded, W_padded) conv with (C', K0, H', W') --> (K1, C', K_H, K_W) -> (C', K1, K_H, K_W)
+    else:
+        Z4 = nn.grad.conv2d_weight(Z3, (C_prime, u1.shape[1], K_H, K_W), Z1, stride=stride, dilation=dilation, groups=1) # Shape (C', K1, K_H, K_W)
+    #______________________________________________________________________________________________________________
+    # calculate grad_weight
+    if groups == C == C_prime: # Depthwise
+        return th.einsum("ckhw,ck->ckhw", Z4, u1).sum(dim=1, keepdim=True) # Shape: (C', 1, K_H, K_W)
+    elif groups == 1:
+        return conv2d(Z4, u1.unsqueeze(-1).unsqueeze(-1)) # Shape: (C', K1, K_H, K_W) conv with (C, K1, 1, 1) -> (C', C, K_H, K_W)
+    else:
+        raise NotImplementedError("Grouped convolutions (other than depthwise) are not supported")
+
+def filter_gap(input, weight, grad_output, grad_weight, stride, dilation, padding, groups, filt_radius):
+    # Same measure for the gradient filter (Conv2dAvg) with the given radius
+    with th.enable_grad():
+        weight_ = weight.detach().requires_grad_(True)
+        Conv2dFilterOp = Conv2dAvgOp if (dilation[0] == 1 or dilation[0] < filt_radius) else Conv2dDilatedOp
+        output_filter = Conv2dFilterOp.apply(input.detach(), weight_, None, stride, dilation, padding, filt_radius, groups)
+        grad_weight_filter, = th.autograd.grad(output_filter, weight_, grad_output)
+    return th.norm(grad_weight_filter - grad_weight)
 
 class Conv2d_measure_perplexity_HOSVD_op(Function):
 
 
     @staticmethod
     def forward(ctx: Any, *args: Any, **kwargs: Any) -> Any:
-        input, weight, bias, stride, dilation, padding, groups, explain_variance_threshold, perplexity, measured_rank_hosvd, layer_mem, layer_idx = args
+        input, weight, bias, stride, dilation, padding, groups, explain_variance_threshold, perplexity, measured_rank_hosvd, layer_mem, layer_idx, filt_radius, filter_perplexity, layer_flops, spectra = args
 
         # Perform convolution
         output = conv2d(input, weight, bias, stride, padding, dilation=dilation, groups=groups)
@@ -19,6 +61,9 @@ class Conv2d_measure_perplexity_HOSVD_op(Function):
 
         layer_mem[layer_idx] = ((S.numel() + u_list[0].numel() + u_list[1].numel() + u_list[2].numel() + u_list[3].numel())*4/(1024*1024)) # MB
         measured_rank_hosvd[layer_idx] = rank_list
+        if layer_flops is not None: # Forward + backward FLOPs of ASI with these ranks, and of vanilla training
+            shape = {"input": list(input.shape), "output": list(output.shape), "kernel_size": list(weight.shape[2:])}
+            layer_flops[layer_idx] = (sum(ASI_cost(shape, [int(k) for k in rank_list])[1:]), sum(vanilla_cost(shape)[1:]))
 
         # Save tensors for backward pass
         ctx.save_for_backward(input, S, u_list[0], u_list[1], u_list[2], u_list[3], weight, bias)
@@ -28,6 +73,8 @@ class Conv2d_measure_perplexity_HOSVD_op(Function):
         ctx.groups = groups
         ctx.perplexity = perplexity
         ctx.layer_idx = layer_idx
+        ctx.filt_radius = filt_radius
+        ctx.filter_perplexity = filter_perplexity
 
         return output
 
@@ -55,43 +102,89 @@ class Conv2d_measure_perplexity_HOSVD_op(Function):
         # Compute gradient with respect to the weights
         if ctx.needs_input_grad[1]:
 
-            _, _, K_H, K_W = weight.shape # Shape: (C', C, K_H, K_W)
-            _, C_prime, H_prime, W_prime = grad_output.shape # Shape: (B, C', H', W')
-            
-            # Pad the input
-            u2_padded = pad(u2, (0, 0, padding[0], padding[0])) # Shape: (H_padded, K2)
-            u3_padded = pad(u3, (0, 0, padding[0], padding[0])) # Shape: (W_padded, K3)
             # Calculate Z1: (conv2d 1x1):
             Z1 = th.einsum("bk,bchw->kchw", u0, grad_output) # Shape: (B, K0) einsum with (B, C', H', W') -> (B, K0, C', H', W') -> (K0, C', H', W')
-            #______________________________________________________________________________________________________________
-            # Calculate Z2: (conv2d 1x1):
-            Z2 = th.einsum("abcd,hc->abhd", S, u2_padded) # Shape: (K0, K1, K2, K3) einsum with (H_padded, K2) -> (K0, K1, H_padded, K2, K3) -> (K0, K1, H_padded, K3)
-            #______________________________________________________________________________________________________________
-            # Calculate Z3: (conv2d 1x1):
-            Z3 = th.einsum("abhd,wd->abhw", Z2, u3_padded) # Shape: (K0, K1, H_padded, K3) einsum with (W_padded, K3) -> (K0, K1, H_padded, W_padded, K3) -> (K0, K1, H_padded, W_padded)
-            # ______________________________________________________________________________________________________________
-            # Calculate Z4: (conv2d H'xW'):
-            if stride == dilation:
-                Z4 = conv2d(Z3.permute(1, 0, 2, 3), Z1.permute(1, 0, 2, 3)).permute(1, 0, 2, 3) # Shape: (K1, K0, H_padded, W_padded) conv with (C', K0, H', W') --> (K1, C', K_H, K_W) -> (C', K1, K_H, K_W)
-            else:
-                Z4 = nn.grad.conv2d_weight(Z3, (C_prime, u1.shape[1], K_H, K_W), Z1, stride=stride, dilation=dilation, groups=1) # Shape (C', K1, K_H, K_W)
-            #______________________________________________________________________________________________________________
-            # calculate grad_weight
-            if groups == C == C_prime: # Depthwise
-                grad_weight_low_rank = th.einsum("ckhw,ck->ckhw", Z4, u1).sum(dim=1, keepdim=True) # Shape: (C', 1, K_H, K_W)
-            elif groups == 1:
-                grad_weight_low_rank = conv2d(Z4, u1.unsqueeze(-1).unsqueeze(-1)) # Shape: (C', K1, K_H, K_W) conv with (C, K1, 1, 1) -> (C', C, K_H, K_W)
-            else:
-                pass
+            grad_weight_low_rank = low_rank_grad_weight(Z1, S, u1, u2, u3, weight.shape, stride, dilation, padding, groups)
 
             grad_weight = nn.grad.conv2d_weight(input, weight.shape, grad_output, stride, padding, dilation, groups)
 
             perplexity[layer_idx] = th.norm(grad_weight_low_rank - grad_weight)
 
+            if ctx.filt_radius is not None:
+                ctx.filter_perplexity[layer_idx] = filter_gap(input, weight, grad_output, grad_weight, stride, dilation, padding, groups, ctx.filt_radius)
+
         # if bias is not None and ctx.needs_input_grad[2]:
         #     grad_bias = grad_output.sum((0, 2, 3)).squeeze(0)
 
-        return grad_input, None, None, None, None, None, None, None, None, None, None, None
+        return grad_input, None, None, None, None, None, None, None, None, None, None, None, None, None, None, None
+
+class Conv2d_measure_perplexity_HOSVD_multi_op(Function):
+    """
+    Same measure for a list of epsilons in one forward/backward: the input is decomposed once (hosvd_var_multi) and
+    the exact weight gradient is computed once, only the truncation changes. perplexity, measured_rank_hosvd, layer_mem
+    and layer_flops of the layer get one value per epsilon.
+    """
+
+    @staticmethod
+    def forward(ctx: Any, *args: Any, **kwargs: Any) -> Any:
+        input, weight, bias, stride, dilation, padding, groups, explain_variance_thresholds, perplexity, measured_rank_hosvd, layer_mem, layer_idx, filt_radius, filter_perplexity, layer_flops, spectra = args
+
+        # Perform convolution
+        output = conv2d(input, weight, bias, stride, padding, dilation=dilation, groups=groups)
+
+        S, u_list, rank_lists, ex_var_list = hosvd_var_multi(input, explain_variance_thresholds, return_spectra=True)
+        B, C, H, W = input.shape
+        if spectra is not None: # Spectrum of each mode, to choose the rank of each mode separately (Perplexity.find_best_mode_ranks)
+            spectra[layer_idx] = [ex_var.tolist() for ex_var in ex_var_list]
+
+        layer_mem[layer_idx] = [(K0*K1*K2*K3 + B*K0 + C*K1 + H*K2 + W*K3)*4/(1024*1024) for K0, K1, K2, K3 in rank_lists] # MB
+        measured_rank_hosvd[layer_idx] = rank_lists
+        if layer_flops is not None:
+            shape = {"input": list(input.shape), "output": list(output.shape), "kernel_size": list(weight.shape[2:])}
+            vanilla_flops = sum(vanilla_cost(shape)[1:])
+            layer_flops[layer_idx] = [(sum(ASI_cost(shape, rank_list)[1:]), vanilla_flops) for rank_list in rank_lists]
+
+        # Save tensors for backward pass
+        ctx.save_for_backward(input, S, u_list[0], u_list[1], u_list[2], u_list[3], weight, bias)
+        ctx.stride = stride
+        ctx.padding = padding
+        ctx.dilation = dilation
+        ctx.groups = groups
+        ctx.perplexity = perplexity
+        ctx.rank_lists = rank_lists
+        ctx.layer_idx = layer_idx
+        ctx.filt_radius = filt_radius
+        ctx.filter_perplexity = filter_perplexity
+
+        return output
+
+    @staticmethod
+    def backward(ctx: Any, *grad_outputs: Any) -> Any:
+        input, S, u0, u1, u2, u3, weight, bias  = ctx.saved_tensors
+        stride, padding, dilation, groups = ctx.stride, ctx.padding, ctx.dilation, ctx.groups
+        layer_idx = ctx.layer_idx
+
+        grad_input = None
+        grad_output, = grad_outputs
+
+        if ctx.needs_input_grad[0]:
+            grad_input = nn.grad.conv2d_input(input.shape, weight, grad_output, stride, padding, dilation, groups)
+
+        if ctx.needs_input_grad[1]:
+            grad_weight = nn.grad.conv2d_weight(input, weight.shape, grad_output, stride, padding, dilation, groups)
+
+            # Z1 only contracts over the batch: the one of each epsilon is a slice of the full one
+            Z1 = th.einsum("bk,bchw->kchw", u0, grad_output) # Shape: (B, K0) einsum with (B, C', H', W') -> (B, K0, C', H', W') -> (K0, C', H', W')
+            ctx.perplexity[layer_idx] = []
+            for K0, K1, K2, K3 in ctx.rank_lists:
+                grad_weight_low_rank = low_rank_grad_weight(Z1[:K0], S[:K0, :K1, :K2, :K3], u1[:, :K1], u2[:, :K2], u3[:, :K3],
+                                                            weight.shape, stride, dilation, padding, groups)
+                ctx.perplexity[layer_idx].append(th.norm(grad_weight_low_rank - grad_weight))
+
+            if ctx.filt_radius is not None:
+                ctx.filter_perplexity[layer_idx] = filter_gap(input, weight, grad_output, grad_weight, stride, dilation, padding, groups, ctx.filt_radius)
+
+        return grad_input, None, None, None, None, None, None, None, None, None, None, None, None, None, None, None
 
 class Conv2d_measure_perplexity_HOSVD(nn.Conv2d):
     """
@@ -114,7 +207,11 @@ class Conv2d_measure_perplexity_HOSVD(nn.Conv2d):
             perplexity=None,
             measured_rank_svd=None,
             layer_mem=None,
-            layer_idx=None
+            layer_idx=None,
+            filt_radius=None,
+            filter_perplexity=None,
+            layer_flops=None,
+            spectra=None
     ) -> None:
         if kernel_size is int:
             kernel_size = [kernel_size, kernel_size]
@@ -139,16 +236,23 @@ class Conv2d_measure_perplexity_HOSVD(nn.Conv2d):
         self.measured_rank_svd = measured_rank_svd
         self.layer_mem = layer_mem
         self.layer_idx=layer_idx
+        self.filt_radius = filt_radius
+        self.filter_perplexity = filter_perplexity
+        self.layer_flops = layer_flops
+        self.spectra = spectra # Only recorded by the single pass measurement
 
     def forward(self, x: th.Tensor) -> th.Tensor:
         if self.activate and th.is_grad_enabled(): # Training mode
-            y = Conv2d_measure_perplexity_HOSVD_op.apply(x, self.weight, self.bias, self.stride, self.dilation, self.padding, self.groups, \
-                                                       self.explain_variance_threshold, self.perplexity, self.measured_rank_svd, self.layer_mem, self.layer_idx)
+            # A list of epsilons is measured in a single pass
+            op = Conv2d_measure_perplexity_HOSVD_multi_op if isinstance(self.explain_variance_threshold, (list, tuple)) else Conv2d_measure_perplexity_HOSVD_op
+            y = op.apply(x, self.weight, self.bias, self.stride, self.dilation, self.padding, self.groups, \
+                                                       self.explain_variance_threshold, self.perplexity, self.measured_rank_svd, self.layer_mem, self.layer_idx, \
+                                                       self.filt_radius, self.filter_perplexity, self.layer_flops, self.spectra)
         else: # activate is False or Inference mode
             y = super().forward(x)
         return y
 
-def wrap_conv_measure_perplexity_HOSVD(conv, active, explain_variance_threshold, perplexity, measured_rank_svd, layer_mem, layer_idx):
+def wrap_conv_measure_perplexity_HOSVD(conv, active, explain_variance_threshold, perplexity, measured_rank_svd, layer_mem, layer_idx, filt_radius=None, filter_perplexity=None, layer_flops=None, spectra=None):
     new_conv = Conv2d_measure_perplexity_HOSVD(in_channels=conv.in_channels,
                          out_channels=conv.out_channels,
                          kernel_size=conv.kernel_size,
@@ -162,7 +266,11 @@ def wrap_conv_measure_perplexity_HOSVD(conv, active, explain_variance_threshold,
                          perplexity = perplexity,
                          measured_rank_svd=measured_rank_svd,
                          layer_mem = layer_mem,
-                         layer_idx=layer_idx
+                         layer_idx=layer_idx,
+                         filt_radius=filt_radius,
+                         filter_perplexity=filter_perplexity,
+                         layer_flops=layer_flops,
+                         spectra=spectra
                          )
     new_conv.weight.data = conv.weight.data
     if new_conv.bias is not None:
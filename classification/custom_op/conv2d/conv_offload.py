@@ -0,0 +1,79 @@
+import torch as th
+import torch.nn as nn
+
+###### Vanilla convolution whose saved tensors are offloaded (see custom_op/offload.py) #############
+class Conv2d_offload(nn.Conv2d):
+    """
+    Conv2D layer keeping nothing in device memory for its backward pass: the input saved by autograd is offloaded
+    to host memory or disk and prefetched back during the backward pass.
+    """
+    def __init__(
+            self,
+            in_channels: int,
+            out_channels: int,
+            kernel_size,
+            stride=1,
+            dilation=1,
+            groups=1,
+            bias=True,
+            padding=0,
+            device=None,
+            dtype=None,
+            activate=False,
+            offloader=None,
+            layer_idx=0
+    ) -> None:
+        if kernel_size is int:
+            kernel_size = [kernel_size, kernel_size]
+        if padding is int:
+            padding = [padding, padding]
+        if dilation is int:
+            dilation = [dilation, dilation]
+        super(Conv2d_offload, self).__init__(in_channels=in_channels,
+                                        out_channels=out_channels,
+                                        kernel_size=kernel_size,
+                                        stride=stride,
+                                        dilation=dilation,
+                                        groups=groups,
+                                        bias=bias,
+                                        padding=padding,
+                                        padding_mode='zeros',
+                                        device=device,
+                                        dtype=dtype)
+        self.activate = activate
+        self.offloader = offloader
+        self.layer_idx = layer_idx # Position among the offloaded layers, in forward order
+
+    def prefetch(self, grad):
+        # Called when the gradient of the output is ready, i.e. just before the backward of this layer
+        self.offloader.prefetch(self.layer_idx) # Only needed for the last layer, the others have already been prefetched
+        self.offloader.prefetch(self.layer_idx - 1) # Overlapped with the backward of this layer
+
+    def forward(self, x: th.Tensor) -> th.Tensor:
+        if self.activate and th.is_grad_enabled(): # Training mode
+            keep = set(param.data_ptr() for param in self.parameters())
+            with self.offloader.saved_tensors_hooks(self.layer_idx, keep):
+                y = super().forward(x)
+            if y.requires_grad:
+                y.register_hook(self.prefetch)
+        else: # activate is False or Inference mode
+            y = super().forward(x)
+        return y
+
+def wrap_conv_offload(conv, active, offloader, layer_idx):
+    new_conv = Conv2d_offload(in_channels=conv.in_channels,
+                         out_channels=conv.out_channels,
+                         kernel_size=conv.kernel_size,
+                         stride=conv.stride,
+                         dilation=conv.dilation,
+                         bias=conv.bias is not None,
+                         groups=conv.groups,
+                         padding=conv.padding,
+                         activate=active,
+                         offloader=offloader,
+                         layer_idx=layer_idx
+                         )
+    new_conv.weight.data = conv.weight.data
+    if new_conv.bias is not None:
+        new_conv.bias.data = conv.bias.data
+    return new_conv
@@ -0,0 +1,152 @@
+import torch as th
+from torch.autograd import Function
+from typing import Any
+from torch.nn.functional import conv3d, pad
+import torch.nn as nn
+from ..compression.hosvd_subspace_iteration import hosvd_subspace_iteration
+
+###### HOSVD_power for 5-mode activations (B, C, D, H, W) #############
+class Conv3d_ASI_op(Function):
+    @staticmethod
+    def forward(ctx: Any, *args: Any, **kwargs: Any) -> Any:
+        input, weight, bias, stride, dilation, padding, groups, S, u0, u1, u2, u3, u4 = args
+
+        # Perform convolution
+        output = conv3d(input, weight, bias, stride, padding, dilation=dilation, groups=groups)
+
+        # Save tensors for backward pass
+        ctx.save_for_backward(S, u0, u1, u2, u3, u4, weight, bias)
+        ctx.stride = stride
+        ctx.padding = padding
+        ctx.dilation = dilation
+        ctx.groups = groups
+
+        return output
+
+    @staticmethod
+    def backward(ctx: Any, *grad_outputs: Any) -> Any:
+        """
+        Backward pass for HOSVD_power Conv3d operation, computing gradients for input, weights, and bias.
+        """
+        # Retrieve saved tensors
+        S, u0, u1, u2, u3, u4, weight, bias = ctx.saved_tensors
+        B, C, D, H, W = u0.shape[0], u1.shape[0], u2.shape[0], u3.shape[0], u4.shape[0]
+        stride = ctx.stride
+        padding = ctx.padding
+        dilation = ctx.dilation
+        groups = ctx.groups
+
+        grad_input = grad_weight = grad_bias = None
+        grad_output, = grad_outputs
+
+        # Compute gradient with respect to the input
+        if ctx.needs_input_grad[0]:
+            grad_input = nn.grad.conv3d_input((B, C, D, H, W), weight, grad_output, stride, padding, dilation, groups)
+
+        # Compute gradient with respect to the weights
+        if ctx.needs_input_grad[1]:
+            _, _, K_D, K_H, K_W = weight.shape # Shape: (C', C, K_D, K_H, K_W)
+            _, C_prime, D_prime, H_prime, W_prime = grad_output.shape # Shape: (B, C', D', H', W')
+
+            # Pad the input
+            u2_padded = pad(u2, (0, 0, padding[0], padding[0])) # Shape: (D_padded, K2)
+            u3_padded = pad(u3, (0, 0, padding[1], padding[1])) # Shape: (H_padded, K3)
+            u4_padded = pad(u4, (0, 0, padding[2], padding[2])) # Shape: (W_padded, K4)
+            # Calculate Z1: (conv3d 1x1x1):
+            Z1 = th.einsum("bk,bcdhw->kcdhw", u0, grad_output) # Shape: (B, K0) einsum with (B, C', D', H', W') -> (K0, C', D', H', W')
+            #______________________________________________________________________________________________________________
+            # Calculate Z2: (conv3d 1x1x1):
+            Z2 = th.einsum("abcde,xc->abxde", S, u2_padded) # Shape: (K0, K1, K2, K3, K4) einsum with (D_padded, K2) -> (K0, K1, D_padded, K3, K4)
+            #______________________________________________________________________________________________________________
+            # Calculate Z3: (conv3d 1x1x1):
+            Z3 = th.einsum("abxde,yd->abxye", Z2, u3_padded) # Shape: (K0, K1, D_padded, K3, K4) einsum with (H_padded, K3) -> (K0, K1, D_padded, H_padded, K4)
+            #______________________________________________________________________________________________________________
+            # Calculate Z4: (conv3d 1x1x1):
+            Z4 = th.einsum("abxye,ze->abxyz", Z3, u4_padded) # Shape: (K0, K1, D_padded, H_padded, K4) einsum with (W_padded, K4) -> (K0, K1, D_padded, H_padded, W_padded)
+            # ______________________________________________________________________________________________________________
+            # Calculate Z5: (conv3d D'xH'xW'):
+            if all(s == 1 for s in stride) and all(d == 1 for d in dilation):
+                Z5 = conv3d(Z4.permute(1, 0, 2, 3, 4), Z1.permute(1, 0, 2, 3, 4)).permute(1, 0, 2, 3, 4) # Shape: (K1, K0, D_padded, H_padded, W_padded) conv with (C', K0, D', H', W') --> (K1, C', K_D, K_H, K_W) -> (C', K1, K_D, K_H, K_W)
+            else:
+                Z5 = nn.grad.conv3d_weight(Z4, (C_prime, u1.shape[1], K_D, K_H, K_W), Z1, stride=stride, dilation=dilation, groups=1) # Shape (C', K1, K_D, K_H, K_W)
+            #______________________________________________________________________________________________________________
+            # calculate grad_weight
+            if groups == C == C_prime: # Depthwise
+                grad_weight = th.einsum("ckdhw,ck->ckdhw", Z5, u1).sum(dim=1, keepdim=True) # Shape: (C', 1, K_D, K_H, K_W)
+            elif groups == 1:
+                grad_weight = conv3d(Z5, u1.unsqueeze(-1).unsqueeze(-1).unsqueeze(-1)) # Shape: (C', K1, K_D, K_H, K_W) conv with (C, K1, 1, 1, 1) -> (C', C, K_D, K_H, K_W)
+            else:
+                pass
+
+        if bias is not None and ctx.needs_input_grad[2]:
+            grad_bias = grad_output.sum((0, 2, 3, 4)).squeeze(0)
+
+        return grad_input, grad_weight, grad_bias, None, None, None, None, None, None, None, None, None, None
+
+class Conv3d_ASI(nn.Conv3d):
+    """
+    Custom Conv3D layer with HOSVD_power-based decomposition.
+    """
+    def __init__(
+            self,
+            in_channels: int,
+            out_channels: int,
+            kernel_size,
+            stride=1,
+            dilation=1,
+            groups=1,
+            bias=True,
+            padding=0,
+            device=None,
+            dtype=None,
+            activate=False,
+            rank=1,
+            no_reuse=False
+    ) -> None:
+        super(Conv3d_ASI, self).__init__(in_channels=in_channels,
+                                        out_channels=out_channels,
+                                        kernel_size=kernel_size,
+                                        stride=stride,
+                                        dilation=dilation,
+                                        groups=groups,
+                                        bias=bias,
+                                        padding=padding,
+                                        padding_mode='zeros',
+                                        device=device,
+                                        dtype=dtype)
+        self.activate = activate
+        self.rank = rank
+        self.reuse_U = False
+        self.u_list = None
+        self.no_reuse=no_reuse
+
+    def forward(self, x: th.Tensor) -> th.Tensor:
+        if self.activate and th.is_grad_enabled(): # Training mode
+            S, self.u_list = hosvd_subspace_iteration(x, previous_Ulist=self.u_list, reuse_U=self.reuse_U, rank=self.rank)
+            if self.no_reuse == False:
+                self.reuse_U = True
+
+            u0, u1, u2, u3, u4 = self.u_list # B, C, D, H, W
+            y = Conv3d_ASI_op.apply(x, self.weight, self.bias, self.stride, self.dilation, self.padding, self.groups, S, u0, u1, u2, u3, u4)
+
+        else: # activate is False or Inference mode
+            y = super().forward(x)
+        return y
+
+def wrap_conv3dASI(conv, active, rank, no_reuse=False):
+    new_conv = Conv3d_ASI(in_channels=conv.in_channels,
+                         out_channels=conv.out_channels,
+                         kernel_size=conv.kernel_size,
+                         stride=conv.stride,
+                         dilation=conv.dilation,
+                         bias=conv.bias is not None,
+                         groups=conv.groups,
+                         padding=conv.padding,
+                         activate=active,
+                         rank=rank,
+                         no_reuse=no_reuse
+                         )
+    new_conv.weight.data = conv.weight.data
+    if new_conv.bias is not None:
+        new_conv.bias.data = conv.bias.data
+    return new_conv
@@ -1,11 +1,15 @@
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
+import time
 from torch.autograd import Function
 
 from ..compression.hosvd_subspace_iteration import hosvd_subspace_iteration
+from ..amp import custom_fwd, custom_bwd
 
 class Linear_ASI4_op(Function):
     @staticmethod
+    @custom_fwd(factors=(4,))
     def forward(ctx, *args):
         input, weight, bias, S, U_list = args
 
@@ -19,6 +23,7 @@ class Linear_ASI4_op(Function):
         return output
 
     @staticmethod
+    @custom_bwd
     def backward(ctx, grad_output):
         # Load the information that is saved from forwardpass
         S, U1, U2, U3, U4, weight, bias = ctx.saved_tensors
@@ -42,6 +47,7 @@ class Linear_ASI4_op(Function):
     
 class Linear_ASI3_op(Function):
     @staticmethod
+    @custom_fwd(factors=(4,))
     def forward(ctx, *args):
         input, weight, bias, S, U_list = args
 
@@ -55,6 +61,7 @@ class Linear_ASI3_op(Function):
         return output
 
     @staticmethod
+    @custom_bwd
     def backward(ctx, grad_output):
         # Load the information that is saved from forwardpass
         S, U1, U2, U3, weight, bias = ctx.saved_tensors
@@ -75,6 +82,69 @@ class Linear_ASI3_op(Function):
 
         return grad_input, grad_weight, grad_bias, None, None
 
+class Linear_ASI3_masked_op(Function):
+    """
+    Same as Linear_ASI3_op, but S and U_list only describe the kept (non-padded) positions of the sequence.
+    Padded tokens do not contribute to the weight gradient.
+    """
+    @staticmethod
+    @custom_fwd(factors=(4,))
+    def forward(ctx, *args):
+        input, weight, bias, S, U_list, keep, mask = args
+
+        # Infer output
+        output = torch.matmul(input, weight.t())
+        if bias is not None:
+            output += bias.unsqueeze(0).expand_as(output)
+
+        ctx.save_for_backward(S, U_list[0], U_list[1], U_list[2], weight, bias, keep, mask)
+        
+        return output
+
+    @staticmethod
+    @custom_bwd
+    def backward(ctx, grad_output):
+        # Load the information that is saved from forwardpass
+        S, U1, U2, U3, weight, bias, keep, mask = ctx.saved_tensors
+    
+        grad_input = grad_weight = grad_bias = None
+
+        if ctx.needs_input_grad[0]:
+            grad_input = torch.matmul(grad_output, weight)
+
+        if ctx.needs_input_grad[1]:
+            grad_output_kept = grad_output[:, keep] * mask # Shape: B, N, O -> B, L, O
+            Z1 = torch.einsum('blo,bk->lok', grad_output_kept, U1) # Shape: B, L, O and B, K1 -> L, O, K1
+            Z2 = torch.einsum('abc,lb->acl', S, U2) # Shape: K1, K2, K3 and L, K2 -> K1, K3, L
+            Z3 = torch.einsum('acl,ic->ail', Z2, U3) # Shape: K1, K3, L and I, K3 -> K1, I, L
+            grad_weight = torch.einsum('lok,kil->oi', Z1, Z3) # Shape: L, O, K1 and K1, I, L -> O, I
+
+        if bias is not None and ctx.needs_input_grad[2]:
+            grad_bias = grad_output.sum(0).squeeze(0)
+
+        return grad_input, grad_weight, grad_bias, None, None, None, None
+
+def mask_padding_tokens(input, attention_mask):
+    """
+    Drop the positions that are padded in every sample of the batch and zero the remaining padded tokens.
+    Returns the masked input (B, L, I), the kept positions (N,) and the mask of the kept positions (B, L, 1).
+    """
+    keep = attention_mask.bool().any(dim=0)
+    mask = attention_mask[:, keep].unsqueeze(-1).to(dtype=input.dtype)
+    return input[:, keep] * mask, keep, mask
+
+def resize_U(U, n):
+    # The number of kept tokens changes between batches: crop or zero-pad the previous U so that it can still warm start
+    if U.shape[0] >= n:
+        return U[:n]
+    return F.pad(U, (0, 0, 0, n - U.shape[0]))
+
+def set_attention_mask(module, attention_mask):
+    # Give the attention mask of the current batch to every Linear_ASI of the model
+    for mod in module.modules():
+        if isinstance(mod, Linear_ASI):
+            mod.attention_mask = attention_mask
+
 class Linear_ASI(nn.Linear):
     def __init__(
             self,
@@ -98,21 +168,39 @@ class Linear_ASI(nn.Linear):
         self.reuse_U = False
         self.u_list = None
         self.no_reuse=no_reuse
+        self.attention_mask = None # Set by set_attention_mask, only used for (B, N, I) inputs
+        self.decomposition_time = 0. # Seconds spent in the decomposition
 
     def forward(self, input):
-        if self.activate and torch.is_grad_enabled(): # Training mode
+        return self.ASI_forward(input, self.weight)
+
+    def ASI_forward(self, input, weight):
+        # The weight is given so that Linear_ASI_QAT can pass its fake-quantized weight
+        start = time.perf_counter()
+        if self.activate and torch.is_grad_enabled() and self.attention_mask is not None and input.dim() == 3: # Training mode, padded sequences
+            masked_input, keep, mask = mask_padding_tokens(input.detach(), self.attention_mask)
+            if self.reuse_U:
+                self.u_list = [resize_U(u, n) for u, n in zip(self.u_list, masked_input.shape)]
+            S, self.u_list = hosvd_subspace_iteration(masked_input, previous_Ulist=self.u_list, reuse_U=self.reuse_U, rank=self.rank)
+            if self.no_reuse == False:
+                self.reuse_U = True
+            self.decomposition_time += time.perf_counter() - start
+            output = Linear_ASI3_masked_op.apply(input, weight, self.bias, S, self.u_list, keep, mask)
+
+        elif self.activate and torch.is_grad_enabled(): # Training mode
             S, self.u_list = hosvd_subspace_iteration(input, previous_Ulist=self.u_list, reuse_U=self.reuse_U, rank=self.rank)
             if self.no_reuse == False:
                 self.reuse_U = True
+            self.decomposition_time += time.perf_counter() - start
             if input.dim() == 4:
-                output = Linear_ASI4_op.apply(input, self.weight, self.bias, S, self.u_list)
+                output = Linear_ASI4_op.apply(input, weight, self.bias, S, self.u_list)
             elif input.dim() == 3:
-                output = Linear_ASI3_op.apply(input, self.weight, self.bias, S, self.u_list)
+                output = Linear_ASI3_op.apply(input, weight, self.bias, S, self.u_list)
             else:
                 raise ValueError("Not implemented for input with {} dimensions".format(input.dim()))
             
         else: # activate is False or Validation mode
-            output = super().forward(input)
+            output = F.linear(input, weight, self.bias)
         return output
     
 
@@ -128,4 +216,84 @@ def wrap_linearASI(linear, active, rank, no_reuse):
     new_linear.weight.data = linear.weight.data
     if new_linear.bias is not None:
         new_linear.bias.data = linear.bias.data
-    return new_linear
\ No newline at end of file
+    return new_linear
+
+class Linear_ASI_QAT(Linear_ASI):
+    """
+    Linear_ASI with fake-quantized weight (quantization-aware fine-tuning): the forward uses the fake-quantized weight,
+    the weight gradient is still computed from the low-rank factors of the input.
+    """
+    _FLOAT_MODULE = Linear_ASI
+
+    def __init__(
+            self,
+            in_features,
+            out_features,
+            bias=True,
+            device=None,
+            dtype=None,
+            activate=False,
+            rank=1,
+            no_reuse = False,
+            qconfig=None):
+        super().__init__(in_features, out_features, bias=bias, device=device, dtype=dtype, activate=activate, rank=rank, no_reuse=no_reuse)
+        assert qconfig, 'qconfig must be provided for QAT module'
+        factory_kwargs = {'device': device, 'dtype': dtype}
+        self.qconfig = qconfig
+        self.weight_fake_quant = qconfig.weight(factory_kwargs=factory_kwargs)
+
+    def forward(self, input):
+        return self.ASI_forward(input, self.weight_fake_quant(self.weight))
+
+    @classmethod
+    def from_float(cls, mod, use_precomputed_fake_quant=False):
+        r"""Create a qat module from a float module, either produced by torch.ao.quantization utilities or directly from user
+        """
+        assert type(mod) == cls._FLOAT_MODULE, 'qat.' + cls.__name__ + '.from_float only works for ' + \
+            cls._FLOAT_MODULE.__name__
+        assert hasattr(
+            mod, 'qconfig'), 'Input float module must have qconfig defined'
+        assert mod.qconfig, 'Input float module must have a valid qconfig'
+        qat_linear = cls(mod.in_features, mod.out_features, bias=mod.bias is not None,
+                         activate=mod.activate, rank=mod.rank, no_reuse=mod.no_reuse, qconfig=mod.qconfig)
+        qat_linear.weight = mod.weight
+        qat_linear.bias = mod.bias
+        # Keep the warm start and the padding mask
+        qat_linear.u_list = mod.u_list
+        qat_linear.reuse_U = mod.reuse_U
+        qat_linear.attention_mask = mod.attention_mask
+        return qat_linear
+
+    def to_float(self):
+        linear = Linear_ASI(
+            self.in_features,
+            self.out_features,
+            bias=self.bias is not None,
+            device=self.weight.device,
+            dtype=self.weight.dtype,
+            activate=self.activate,
+            rank=self.rank,
+            no_reuse=self.no_reuse
+        )
+        linear.weight = nn.Parameter(self.weight.detach())
+        if self.bias is not None:
+            linear.bias = nn.Parameter(self.bias.detach())
+        linear.u_list = self.u_list
+        linear.reuse_U = self.reuse_U
+        linear.attention_mask = self.attention_mask
+        return linear
+
+def wrap_linearASI_QAT(linear, active, rank, qconfig, no_reuse=False):
+    has_bias = (linear.bias is not None)
+    new_linear = Linear_ASI_QAT(in_features=linear.in_features,
+                        out_features=linear.out_features,
+                        bias=has_bias,
+                        activate=active,
+                        rank=rank,
+                        no_reuse= no_reuse,
+                        qconfig=qconfig
+                        )
+    new_linear.weight.data = linear.weight.data
+    if new_linear.bias is not None:
+        new_linear.bias.data = linear.bias.data
+    return new_linear
@@ -3,9 +3,11 @@ import torch.nn as nn
 from torch.autograd import Function
 
 from ..compression.hosvd_var import hosvd_var
+from ..amp import custom_fwd, custom_bwd
 ###### HOSVD based on explained variance threshold #############
 class Linear_HOSVD_var_op(Function):
     @staticmethod
+    @custom_fwd
     def forward(ctx, *args):
         input, weight, bias, var, k_hosvd = args
 
@@ -30,6 +32,7 @@ class Linear_HOSVD_var_op(Function):
         return output
 
     @staticmethod
+    @custom_bwd
     def backward(ctx, grad_output):
         # Load the information that is saved from forwardpass
         S, weight, bias = ctx.saved_tensors
@@ -0,0 +1,231 @@
+import os
+import time
+import logging
+import tempfile
+import threading
+from math import prod
+from concurrent.futures import ThreadPoolExecutor
+import torch as th
+import torch.nn as nn
+from torch.multiprocessing.reductions import StorageWeakRef
+from .recompute import strip_module_keys, add_module_keys
+
+###### Offloading of the tensors saved by autograd #############
+# The tensors saved for the backward pass of the offloaded layers (through th.autograd.graph.saved_tensors_hooks) are moved to:
+#   - "host": host buffers (pinned if the activation is on the GPU)
+#   - "disk": memory-mapped scratch files, one per tensor, in directory
+# During the backward pass, a worker thread brings them back in reverse layer order: when the backward of layer i starts,
+# the tensors of layer i - 1 are prefetched. An unpack that has to wait for its tensor is counted as a stall.
+# retain_graph is not supported: a tensor is released as soon as all its saves have been unpacked.
+# A tensor saved by several layers (e.g. the output of a BatchNorm saved by the ReLU and by the next conv) is offloaded once.
+# The hooks are installed around whole blocks (OffloadBlock): the input of a conv is also saved by the layers before it,
+# offloading it alone would only add a copy and free nothing.
+
+class Offloader:
+    def __init__(self, storage="host", directory=None, min_numel=1024):
+        if storage not in ["host", "disk"]:
+            raise ValueError(f"Unknown offload storage {storage}, it must be 'host' or 'disk'")
+        self.storage = storage
+        self.directory = directory
+        if self.storage == "disk":
+            if self.directory is None:
+                self.directory = tempfile.mkdtemp(prefix="offload_")
+            os.makedirs(self.directory, exist_ok=True)
+        self.min_numel = min_numel # Smaller tensors are not worth offloading
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.lock = threading.Lock()
+
+        self.saved = {} # Handle -> (layer index, stored tensor or path, shape, dtype, device)
+        self.layers = {} # Layer index -> handles not prefetched yet
+        self.prefetched = {} # Handle -> future of the loaded tensor
+        self.aliases = {} # (data_ptr, shape, stride, dtype, version) -> (weak reference to the storage, handle)
+        self.refs = {} # Handle -> number of saves not unpacked yet
+        self.loaded = {} # Handle -> tensor already unpacked, kept for its other saves
+        self.next_handle = 0
+        self.warned = False
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.bytes_offloaded = 0
+        self.num_unpacked = 0
+        self.num_stalls = 0
+        self.stall_time = 0.
+
+    def stats(self):
+        return {"bytes_offloaded": self.bytes_offloaded, "num_unpacked": self.num_unpacked,
+                "num_stalls": self.num_stalls, "stall_time": self.stall_time}
+
+    def store(self, tensor, handle):
+        if self.storage == "host":
+            if tensor.device.type == 'cpu' and not self.warned:
+                logging.warning("Offloading to host memory while training on CPU does not save memory, use storage='disk'")
+                self.warned = True
+            buffer = th.empty(tensor.shape, dtype=tensor.dtype, pin_memory=tensor.is_cuda)
+            buffer.copy_(tensor)
+            return buffer
+
+        path = os.path.join(self.directory, f"{handle}.bin")
+        with open(path, "wb") as f:
+            f.truncate(tensor.numel() * tensor.element_size())
+        mapped = th.from_file(path, shared=True, size=tensor.numel(), dtype=tensor.dtype)
+        mapped.copy_(tensor.detach().reshape(-1))
+        return path
+
+    def load(self, handle):
+        with self.lock:
+            _, stored, shape, dtype, device = self.saved[handle]
+        if self.storage == "host":
+            return stored.to(device)
+
+        mapped = th.from_file(stored, shared=False, size=prod(shape), dtype=dtype)
+        tensor = mapped.view(shape).to(device, copy=True) # Read the whole file now, not lazily in the backward pass
+        os.remove(stored)
+        return tensor
+
+    def pack(self, tensor, layer_idx, keep):
+        # keep: data pointers of the parameters, they are already in memory
+        if tensor.numel() < self.min_numel or tensor.data_ptr() in keep:
+            return tensor
+        key = (tensor.data_ptr(), tuple(tensor.shape), tensor.stride(), tensor.dtype, tensor._version)
+        with self.lock:
+            alias = self.aliases.get(key)
+            if alias is not None and not alias[0].expired() and alias[1] in self.refs: # Already offloaded by another layer
+                self.refs[alias[1]] += 1
+                return alias[1]
+            handle = self.next_handle
+            self.next_handle += 1
+        stored = self.store(tensor, handle)
+        with self.lock:
+            self.saved[handle] = (layer_idx, stored, tensor.shape, tensor.dtype, tensor.device)
+            self.layers.setdefault(layer_idx, []).append(handle)
+            self.refs[handle] = 1
+            self.aliases[key] = (StorageWeakRef(tensor.storage()), handle)
+        self.bytes_offloaded += tensor.numel() * tensor.element_size()
+        return handle
+
+    def unpack(self, packed):
+        if isinstance(packed, th.Tensor): # Not offloaded
+            return packed
+        self.num_unpacked += 1
+        with self.lock:
+            if packed in self.loaded: # Other save of a tensor already brought back
+                tensor = self.loaded[packed]
+                self.release(packed)
+                return tensor
+        future = self.prefetched.pop(packed, None)
+        if future is not None and future.done():
+            tensor = future.result()
+        else: # Stall: the prefetch is late or the tensor has not been prefetched
+            self.num_stalls += 1
+            start = time.perf_counter()
+            if future is not None:
+                tensor = future.result()
+            else:
+                with self.lock:
+                    layer_handles = self.layers.get(self.saved[packed][0], [])
+                    if packed in layer_handles:
+                        layer_handles.remove(packed)
+                tensor = self.load(packed)
+            self.stall_time += time.perf_counter() - start
+        with self.lock:
+            self.loaded[packed] = tensor
+            self.release(packed)
+        return tensor
+
+    def release(self, handle):
+        # One save of handle has been unpacked, called with the lock held
+        self.refs[handle] -= 1
+        if self.refs[handle] == 0:
+            self.refs.pop(handle)
+            self.loaded.pop(handle, None)
+            self.saved.pop(handle, None)
+
+    def prefetch(self, layer_idx):
+        with self.lock:
+            handles = self.layers.pop(layer_idx, [])
+        for handle in handles:
+            self.prefetched[handle] = self.executor.submit(self.load, handle)
+
+    def saved_tensors_hooks(self, layer_idx, keep):
+        return th.autograd.graph.saved_tensors_hooks(lambda tensor: self.pack(tensor, layer_idx, keep), self.unpack)
+
+    def clear(self):
+        # Drop what has not been unpacked (e.g. a forward pass without backward)
+        for future in self.prefetched.values():
+            future.result()
+        self.prefetched.clear()
+        with self.lock:
+            for _, stored, _, _, _ in self.saved.values():
+                if self.storage == "disk" and os.path.exists(stored):
+                    os.remove(stored)
+            self.saved.clear()
+            self.layers.clear()
+            self.aliases.clear()
+            self.refs.clear()
+            self.loaded.clear()
+
+class OffloadBlock(nn.Module):
+    """
+    Block (e.g. a conv + BatchNorm + activation, or a residual block) whose saved tensors are all offloaded: when its
+    output gradient is ready, the tensors of the block and of the previous one (layer_idx - 1) are prefetched.
+    """
+    def __init__(self, module, activate=False, offloader=None, layer_idx=0):
+        super(OffloadBlock, self).__init__()
+        self.module = module
+        self.activate = activate
+        self.offloader = offloader
+        self.layer_idx = layer_idx # Position among the offloaded blocks, in forward order
+        # Checkpoints keep the keys of the unwrapped model (no ".module.")
+        self._register_state_dict_hook(strip_module_keys)
+        self._register_load_state_dict_pre_hook(add_module_keys)
+
+    def prefetch(self, grad):
+        self.offloader.prefetch(self.layer_idx) # Only needed for the last block, the others have already been prefetched
+        self.offloader.prefetch(self.layer_idx - 1) # Overlapped with the backward of this block
+
+    def forward(self, *args):
+        if self.activate and th.is_grad_enabled(): # Training mode
+            keep = set(param.data_ptr() for param in self.module.parameters())
+            with self.offloader.saved_tensors_hooks(self.layer_idx, keep):
+                y = self.module(*args)
+            if isinstance(y, th.Tensor) and y.requires_grad:
+                y.register_hook(self.prefetch)
+            return y
+        else: # activate is False or Validation mode
+            return self.module(*args)
+
+def wrap_offload_block(module, active, offloader, layer_idx):
+    return OffloadBlock(module, active, offloader, layer_idx)
+
+########################## Check: python -m custom_op.offload --storage disk ##########################
+if __name__ == "__main__":
+    import argparse
+    import copy
+    from custom_op.conv2d.conv_offload import wrap_conv_offload
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--storage", default="disk")
+    args = parser.parse_args()
+
+    th.manual_seed(233)
+    model = nn.Sequential(nn.Sequential(nn.Conv2d(3, 16, 3, padding=1), nn.BatchNorm2d(16), nn.ReLU()),
+                          nn.Sequential(nn.Conv2d(16, 32, 3, padding=1), nn.BatchNorm2d(32), nn.ReLU()),
+                          nn.Conv2d(32, 32, 3, padding=1))
+    offloader = Offloader(storage=args.storage)
+    offloaded_model = copy.deepcopy(model)
+    for idx in range(2): # Blocks, their conv stays a plain convolution
+        offloaded_model[idx][0] = wrap_conv_offload(offloaded_model[idx][0], False, offloader, idx)
+        offloaded_model[idx] = wrap_offload_block(offloaded_model[idx], True, offloader, idx)
+    offloaded_model[2] = wrap_conv_offload(offloaded_model[2], True, offloader, 2) # Layer alone
+    x = th.randn(4, 3, 32, 32)
+    for net in [model, offloaded_model]:
+        net.zero_grad()
+        net(x).square().mean().backward()
+    for name, mod in model.named_modules():
+        offloaded_mod = dict(offloaded_model.named_modules())[name if name == '2' else name.replace('.', '.module.', 1)]
+        if isinstance(mod, nn.Conv2d):
+            print(f"{name}: max gradient difference {(mod.weight.grad - offloaded_mod.weight.grad).abs().max().item():.2e}")
+    # Each activation once: x (saved by the first conv), conv outputs (saved by BatchNorm), BatchNorm outputs (saved by ReLU),
+    # ReLU outputs (saved by ReLU and by the next conv)
+    print(offloader.stats(), "expected bytes", 4*4*32*32*(3 + 16*3 + 32*3))
+    assert offloaded_model.state_dict().keys() == model.state_dict().keys()
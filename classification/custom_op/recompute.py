@@ -0,0 +1,58 @@
+import torch as th
+import torch.nn as nn
+from torch.utils.checkpoint import checkpoint
+
+###### Activation recomputation #############
+class Recompute(nn.Module):
+    """
+    Run the wrapped module under torch.utils.checkpoint: only its input is kept during the forward pass,
+    everything inside is recomputed in the backward pass.
+    """
+    def __init__(self, module, activate=False):
+        super(Recompute, self).__init__()
+        self.module = module
+        self.activate = activate
+        self.input_numel = 0
+        self.recomputing = False
+        # Checkpoints keep the keys of the unwrapped model (no ".module."), old checkpoints can be loaded
+        self._register_state_dict_hook(strip_module_keys)
+        self._register_load_state_dict_pre_hook(add_module_keys)
+
+    def run(self, *args):
+        if not self.recomputing:
+            return self.module(*args)
+        # Recomputation in the backward pass: the BatchNorm running statistics have already been updated by the forward pass
+        batch_norms = [mod for mod in self.module.modules() if isinstance(mod, nn.modules.batchnorm._BatchNorm) and mod.training and mod.track_running_stats]
+        saved = [(mod.running_mean.clone(), mod.running_var.clone(), mod.num_batches_tracked.clone()) for mod in batch_norms]
+        output = self.module(*args)
+        with th.no_grad():
+            for mod, (running_mean, running_var, num_batches_tracked) in zip(batch_norms, saved):
+                mod.running_mean.copy_(running_mean)
+                mod.running_var.copy_(running_var)
+                mod.num_batches_tracked.copy_(num_batches_tracked)
+        return output
+
+    def forward(self, *args):
+        if self.activate and th.is_grad_enabled(): # Training mode
+            self.input_numel = sum(arg.numel() for arg in args if isinstance(arg, th.Tensor)) # What is kept in memory
+            self.recomputing = False
+            output = checkpoint(self.run, *args, use_reentrant=False)
+            self.recomputing = True # The next calls of run come from the backward pass
+            return output
+        else: # activate is False or Validation mode
+            return self.module(*args)
+
+def strip_module_keys(module, state_dict, prefix, local_metadata):
+    for key in [key for key in state_dict if key.startswith(prefix + 'module.')]:
+        state_dict[prefix + key[len(prefix + 'module.'):]] = state_dict.pop(key)
+    return state_dict
+
+def add_module_keys(state_dict, prefix, local_metadata, strict, missing_keys, unexpected_keys, error_msgs):
+    for key in [key for key in state_dict if key.startswith(prefix) and not key.startswith(prefix + 'module.')]:
+        state_dict[prefix + 'module.' + key[len(prefix):]] = state_dict.pop(key)
+
+def wrap_recompute(module, active):
+    # Layers inside are marked so that the activation memory can be logged properly
+    for mod in module.modules():
+        mod.recompute = True
+    return Recompute(module, active)
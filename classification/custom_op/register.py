@@ -6,12 +6,18 @@ from .conv2d.conv_avg import wrap_conv_avg_layer
 from .conv2d.conv_hosvd_var import wrap_convHOSVD_var
 from .linear.linear_hosvd_var import wrap_linearHOSVD_var
 
-from .conv2d.conv_ASI import wrap_convASI
-from .linear.linear_ASI import wrap_linearASI
+from .conv2d.conv_ASI import wrap_convASI, wrap_convASI_QAT
+from .linear.linear_ASI import wrap_linearASI, wrap_linearASI_QAT
+from .conv1d.conv_ASI import wrap_conv1dASI
+from .conv3d.conv_ASI import wrap_conv3dASI
+from .attention.attention_ASI import wrap_attentionASI
 
 
 
 from .conv2d.conv_normal import wrap_conv
+from .recompute import wrap_recompute
+from .conv2d.conv_offload import wrap_conv_offload
+from .offload import wrap_offload_block
 
 from .conv2d.conv_measure_perplexity_HOSVD import wrap_conv_measure_perplexity_HOSVD
 from .linear.linear_measure_perplexity_HOSVD import wrap_linear_measure_perplexity_HOSVD
@@ -71,10 +77,21 @@ def register_ASI(module, cfgs):
         for param in target.parameters(): # Turn off gradient of previous version
             param.requires_grad = False
 
-        if cfgs["type"] == "conv":
-            upd_layer = wrap_convASI(target, True, cfgs["truncation_threshold"][layer_idx], no_reuse=cfgs["no_reuse"])
+        if cfgs["type"] == "conv" and cfgs.get("qconfig") is not None: # Quantization-aware fine-tuning
+            upd_layer = wrap_convASI_QAT(target, True, cfgs["truncation_threshold"][layer_idx], cfgs["qconfig"], no_reuse=cfgs["no_reuse"])
+        elif cfgs["type"] == "linear" and cfgs.get("qconfig") is not None:
+            upd_layer = wrap_linearASI_QAT(target, True, cfgs["truncation_threshold"][layer_idx], cfgs["qconfig"], no_reuse=cfgs["no_reuse"])
+        elif cfgs["type"] == "conv":
+            upd_layer = wrap_convASI(target, True, cfgs["truncation_threshold"][layer_idx], no_reuse=cfgs["no_reuse"], async_decomposition=cfgs.get("async_decomposition", False),
+                                     async_workers=cfgs.get("async_workers", 1), compile_friendly=cfgs.get("compile_friendly", False), factored_grad=cfgs.get("factored_grad", False))
         elif cfgs["type"] == "linear":
             upd_layer = wrap_linearASI(target, True, cfgs["truncation_threshold"][layer_idx], no_reuse=cfgs["no_reuse"])
+        elif cfgs["type"] == "conv1d":
+            upd_layer = wrap_conv1dASI(target, True, cfgs["truncation_threshold"][layer_idx], no_reuse=cfgs["no_reuse"])
+        elif cfgs["type"] == "conv3d":
+            upd_layer = wrap_conv3dASI(target, True, cfgs["truncation_threshold"][layer_idx], no_reuse=cfgs["no_reuse"])
+        elif cfgs["type"] == "attention":
+            upd_layer = wrap_attentionASI(target, True, cfgs["truncation_threshold"][layer_idx], matmul_rank=cfgs["matmul_rank"], no_reuse=cfgs["no_reuse"])
 
 
         parent = reduce(getattr, path_seq[:-1], module)
@@ -114,11 +131,102 @@ def register_measure_perplexity_HOSVD(module, cfgs):
             param.requires_grad = False
 
         if cfgs["type"] == "conv":
-            upd_layer = wrap_conv_measure_perplexity_HOSVD(target, True, cfgs["explain_variance_threshold"], cfgs["perplexity"], cfgs["measured_rank"], cfgs["layer_mem"], layer_idx)
+            upd_layer = wrap_conv_measure_perplexity_HOSVD(target, True, cfgs["explain_variance_threshold"], cfgs["perplexity"], cfgs["measured_rank"], cfgs["layer_mem"], layer_idx,
+                                                           filt_radius=cfgs.get("radius"), filter_perplexity=cfgs.get("filter_perplexity"),
+                                                           layer_flops=cfgs.get("layer_flops"), spectra=cfgs.get("spectra"))
         
         elif cfgs["type"] == "linear":
             upd_layer = wrap_linear_measure_perplexity_HOSVD(target, True, cfgs["explain_variance_threshold"], cfgs["perplexity"], cfgs["measured_rank"], cfgs["layer_mem"], layer_idx)
 
 
         parent = reduce(getattr, path_seq[:-1], module)
-        setattr(parent, path_seq[-1], upd_layer)
\ No newline at end of file
+        setattr(parent, path_seq[-1], upd_layer)
+
+def register_mixed(module, cfgs):
+    logging.info("Registering planned strategy for each layer")
+    if cfgs == -1:
+        logging.info("No Filter Required")
+        return
+    # Install filter: "grad_filter" -> Conv2dAvg, "ASI" -> Conv2d_ASI, "vanilla" -> unchanged, "recompute" -> parent module is recomputed
+    recompute_parents = []
+    for layer_idx, name in enumerate(cfgs["finetuned_layer"]):
+        path_seq = name.split('.')
+        strategy = cfgs["strategy"][layer_idx]
+
+        if strategy == "recompute":
+            parent_name = '.'.join(path_seq[:-1])
+            if parent_name not in recompute_parents:
+                recompute_parents.append(parent_name)
+            continue
+        elif strategy == "vanilla":
+            continue
+
+        target = reduce(getattr, path_seq, module)
+
+        for param in target.parameters(): # Turn off gradient of previous version
+            param.requires_grad = False
+
+        if strategy == "grad_filter":
+            upd_layer = wrap_conv_avg_layer(target, cfgs['radius'], True)
+        elif strategy == "ASI":
+            upd_layer = wrap_convASI(target, True, cfgs["truncation_threshold"][layer_idx], no_reuse=cfgs["no_reuse"], async_decomposition=cfgs.get("async_decomposition", False),
+                                     async_workers=cfgs.get("async_workers", 1))
+
+        parent = reduce(getattr, path_seq[:-1], module)
+        setattr(parent, path_seq[-1], upd_layer)
+
+    for name in recompute_parents:
+        path_seq = name.split('.')
+        target = reduce(getattr, path_seq, module)
+
+        upd_layer = wrap_recompute(target, True)
+
+        parent = reduce(getattr, path_seq[:-1], module)
+        setattr(parent, path_seq[-1], upd_layer)
+
+def register_offload(module, cfgs):
+    logging.info("Registering offloading of the saved tensors")
+    if cfgs == -1:
+        logging.info("No Filter Required")
+        return
+    if cfgs["type"] != "conv":
+        raise ValueError(f"Offloading is only implemented for conv layers, not {cfgs['type']}")
+    # The saved tensors are offloaded per parent block of the finetuned layers (conv, BatchNorm, activation...): the input
+    # of a conv is also saved by the layers before it, offloading it alone would free nothing. A layer directly in the
+    # backbone is offloaded alone. The index of each block gives the prefetching order.
+    parents = []
+    for name in cfgs["finetuned_layer"]:
+        parent_name = '.'.join(name.split('.')[:-1])
+        if parent_name.count('.') >= 1 and parent_name not in parents:
+            parents.append(parent_name)
+    parents = [name for name in parents if not any(name.startswith(other + '.') for other in parents)] # Nested blocks: the outer one
+    block_of = lambda name: next((parent_name for parent_name in parents if name.startswith(parent_name + '.')), None)
+    units = [] # Blocks and layers offloaded alone, in forward order
+    for name in cfgs["finetuned_layer"]:
+        unit = block_of(name) or name
+        if unit not in units:
+            units.append(unit)
+
+    for name in cfgs["finetuned_layer"]:
+        path_seq = name.split('.')
+        target = reduce(getattr, path_seq, module)
+
+        for param in target.parameters(): # Turn off gradient of previous version
+            param.requires_grad = False
+
+        if block_of(name) is not None: # Plain convolution, its block offloads
+            upd_layer = wrap_conv_offload(target, False, cfgs["offloader"], units.index(block_of(name)))
+        else:
+            upd_layer = wrap_conv_offload(target, True, cfgs["offloader"], units.index(name))
+
+        parent = reduce(getattr, path_seq[:-1], module)
+        setattr(parent, path_seq[-1], upd_layer)
+
+    for name in parents:
+        path_seq = name.split('.')
+        target = reduce(getattr, path_seq, module)
+
+        upd_layer = wrap_offload_block(target, True, cfgs["offloader"], units.index(name))
+
+        parent = reduce(getattr, path_seq[:-1], module)
+        setattr(parent, path_seq[-1], upd_layer)
@@ -39,7 +39,7 @@ class ClsDatasetA(LightningDataModule):
                     train_split=0.8,
                     batch_size=32, train_shuffle=True,
                     width=224, height=224,
-                    train_workers=4, val_workers=1, num_train_batch=None, num_val_batch=None, num_test_batch=None, max_length=512):
+                    train_workers=4, val_workers=1, num_train_batch=None, num_val_batch=None, num_test_batch=None, max_length=512, drop_last=True):
         super(ClsDatasetA, self).__init__()
         self.name = name
         self.data_dir = data_dir
@@ -58,6 +58,7 @@ class ClsDatasetA(LightningDataModule):
         self.num_val_batch = num_val_batch
         self.num_test_batch = num_test_batch
         self.max_length = max_length
+        self.drop_last = drop_last # ASI layers handle a smaller last batch, drop_last=False can be used with them
 
     def set_tokenizer(self, tokenizer):
         self.tokenizer = tokenizer
@@ -222,11 +223,11 @@ class ClsDatasetA(LightningDataModule):
 
     def train_dataloader(self):
         return DataLoader(self.train_dataset, batch_size=self.batch_size, shuffle=self.train_shuffle,
-            num_workers=self.train_workers, pin_memory=True, drop_last=True)
+            num_workers=self.train_workers, pin_memory=True, drop_last=self.drop_last)
 
     def val_dataloader(self):
         return DataLoader(self.val_dataset, batch_size=self.batch_size, shuffle=False,
-                num_workers=self.val_workers, pin_memory=True, drop_last=True)
+                num_workers=self.val_workers, pin_memory=True, drop_last=self.drop_last)
 
     def predict_dataloader(self):
         return DataLoader(self.val_dataset, batch_size=1, shuffle=False,
@@ -243,7 +244,7 @@ class ClsDatasetB(LightningDataModule):
                  batch_size=32, train_shuffle=True,
                  width=224, height=224,
                  train_workers=4, val_workers=1,
-                 usr_group=None, partition=0, shards_per_partition=2, num_train_batch=None, num_val_batch=None, num_test_batch=None):
+                 usr_group=None, partition=0, shards_per_partition=2, num_train_batch=None, num_val_batch=None, num_test_batch=None, drop_last=True):
         super(ClsDatasetB, self).__init__()
         self.name = name
         self.data_dir = data_dir
@@ -271,6 +272,7 @@ class ClsDatasetB(LightningDataModule):
         self.num_train_batch = num_train_batch
         self.num_val_batch = num_val_batch
         self.num_test_batch = num_test_batch
+        self.drop_last = drop_last
 
     def switch_partition(self, partition):
         logging.info(f"Load partition {partition}")
@@ -435,11 +437,11 @@ class ClsDatasetB(LightningDataModule):
 
     def train_dataloader(self):
         return DataLoader(self.train_dataset, batch_size=self.batch_size, shuffle=self.train_shuffle,
-                          num_workers=self.train_workers, pin_memory=False, drop_last=True)
+                          num_workers=self.train_workers, pin_memory=False, drop_last=self.drop_last)
 
     def val_dataloader(self):
         return DataLoader(self.val_dataset, batch_size=self.batch_size, shuffle=False,
-                          num_workers=self.val_workers, pin_memory=False, drop_last=True)
+                          num_workers=self.val_workers, pin_memory=False, drop_last=self.drop_last)
 
     def predict_dataloader(self):
         return DataLoader(self.val_dataset, batch_size=1, shuffle=False,
@@ -455,7 +457,7 @@ class ClsDataset(LightningDataModule):
                  batch_size=32, train_shuffle=True,
                  width=224, height=224,
                  train_workers=4, val_workers=1,
-                 usr_group=None, partition=0, shards_per_partition=2, num_train_batch=None, num_val_batch=None, num_test_batch=None, max_length=512):
+                 usr_group=None, partition=0, shards_per_partition=2, num_train_batch=None, num_val_batch=None, num_test_batch=None, max_length=512, drop_last=True):
         super(ClsDataset, self).__init__()
         self.batch_size = batch_size
         self.train_workers = train_workers
@@ -463,11 +465,11 @@ class ClsDataset(LightningDataModule):
 
         if self.setup_type == 'A':
             self.datamodule = ClsDatasetA(data_dir, name, train_split, batch_size, train_shuffle,
-                                       width, height, train_workers, val_workers, num_train_batch, num_val_batch, num_test_batch, max_length)
+                                       width, height, train_workers, val_workers, num_train_batch, num_val_batch, num_test_batch, max_length, drop_last)
         elif self.setup_type == 'B':
             self.datamodule = ClsDatasetB(data_dir, name, num_partitions, iid, train_split,
                                        batch_size, train_shuffle, width, height,
-                                       train_workers, val_workers, usr_group, partition, shards_per_partition, num_train_batch, num_val_batch, num_test_batch)
+                                       train_workers, val_workers, usr_group, partition, shards_per_partition, num_train_batch, num_val_batch, num_test_batch, drop_last)
         else:
             raise ValueError(f"Invalid setup value: {setup}. It must be 'A' or 'B'.")
     def set_tokenizer(self, tokenizer):
@@ -1,16 +1,22 @@
+import os
+import sys
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'shared')) # Modules shared by classification and segmentation
 import logging
 from pytorch_lightning.utilities.cli import LightningCLI
 from pytorch_lightning.loggers import TensorBoardLogger
 from classification.model import ClassificationModel
 from dataloader.pl_dataset import ClsDataset
-from classification.callback import LogActivationMemoryCallback
-import os
-from pytorch_lightning.callbacks import ModelCheckpoint
+from classification.callback import LogActivationMemoryCallback, SyncSubspaceCallback
+from pytorch_lightning.callbacks import ModelCheckpoint, GPUStatsMonitor
+from pytorch_lightning.strategies import DDPStrategy
 
 
 logging.basicConfig(level=logging.INFO)
 
 
+def parse_epsilons(set_of_epsilons):
+    return [float(item) for item in set_of_epsilons.split(',')]
+
 class CLI(LightningCLI):
     def add_arguments_to_parser(self, parser):
         parser.add_argument("--logger.save_dir", default='./runs')
@@ -18,6 +24,23 @@ class CLI(LightningCLI):
         parser.add_argument("--checkpoint", default=None)
 
         parser.add_argument('--set_of_epsilons', type=str, help='Comma separated list of epochs', default='0, 0')
+        parser.add_argument('--measure_single_pass', type=bool, help='Measure the perplexity of all epsilons in one forward/backward instead of one epoch per epsilon', default=True)
+        # Offline measurement (utils/perplexity_engine.py): the layers are recorded, then measured on a pool of CPU processes
+        parser.add_argument('--measure_workers', type=int, help='Number of processes of the offline measurement, disabled if 0, all cores if -1', default=0)
+        parser.add_argument('--measure_batches', type=int, help='Number of batches recorded by the offline measurement', default=1)
+        parser.add_argument('--measure_spill_dir', type=str, help='Directory of the spill files of the offline measurement, kept in memory if None', default=None)
+        # Provenance of the perplexity tables stored in --model.perplexity_cache
+        parser.link_arguments("set_of_epsilons", "model.perplexity_epsilons", compute_fn=parse_epsilons)
+        parser.link_arguments(("data.name", "data.setup", "data.partition", "data.usr_group"), "model.perplexity_dataset",
+                              compute_fn=lambda name, setup, partition, usr_group: f"{name}_setup{setup}_partition{partition}_{usr_group}")
+        parser.link_arguments(("data.batch_size", "data.height", "data.width"), "model.perplexity_input_size",
+                              compute_fn=lambda batch_size, height, width: [batch_size, 3, height, width])
+
+        # Data parallel training on CPU (gloo), the ASI subspaces of the replicas are synchronized every sync_subspace_every batches
+        parser.add_argument('--ddp_cpu', type=int, help='Number of CPU processes for data parallel training, disabled if < 2', default=0)
+        parser.add_argument('--sync_subspace_every', type=int, help='Synchronize the ASI subspaces every n training batches', default=50)
+        parser.add_argument('--sync_subspace_mode', type=str, help='broadcast (from rank 0) or average', default='broadcast')
+        parser.add_argument('--asi_comm_hook', type=bool, help='All-reduce the gradients of Conv2d_ASI in low-rank form', default=False)
 
     def instantiate_trainer(self, **kwargs):
         if 'fit' in self.config.keys():
@@ -52,6 +75,20 @@ class CLI(LightningCLI):
             kwargs['enable_checkpointing'] = False
         ######################################
 
+        ############### DDP on CPU with gloo ###############
+        if cfg['ddp_cpu'] > 1:
+            if cfg['model']['factored_grad']:
+                # The weights of the ASI layers get no .grad, DDP would not synchronize their factored gradients
+                raise ValueError("factored_grad is not supported with --ddp_cpu, the factored gradients are not all-reduced")
+            logging.info(f"Data parallel training on {cfg['ddp_cpu']} CPU processes")
+            kwargs['accelerator'] = 'cpu'
+            kwargs['devices'] = cfg['ddp_cpu']
+            kwargs['gpus'] = None
+            kwargs['strategy'] = DDPStrategy(process_group_backend='gloo', find_unused_parameters=False)
+            callbacks = kwargs['callbacks'] if 'callbacks' in kwargs else (self._get(self.config_init, 'trainer').get('callbacks') or [])
+            kwargs['callbacks'] = [callback for callback in callbacks if not isinstance(callback, GPUStatsMonitor)]
+        ######################################
+
         trainer = super(CLI, self).instantiate_trainer(**kwargs)
         return trainer
     
@@ -61,6 +98,9 @@ class CLI(LightningCLI):
 
 
 from utils.perplexity import Perplexity
+from utils.perplexity_engine import measure_perplexity_parallel
+from utils.planner import get_layer_shapes
+import torch
 import shutil
 
 def delete_junk_folder(base_path):
@@ -71,27 +111,47 @@ def delete_junk_folder(base_path):
             # Xóa thư mục
             shutil.rmtree(folder_path)
 
-def run():
-    cli = CLI(ClassificationModel, ClsDataset, run=False, save_config_overwrite=True)
-
-    model = cli.model
-    trainer = cli.trainer
-    data = cli.datamodule
-    ##############################################
-    if model.measure_perplexity_HOSVD_var:
-        total_conv_layer = len(model.all_conv_layers)
-
-        set_of_epsilons = [float(item) for item in cli.config['set_of_epsilons'].split(',')]
-
+def measure_perplexity(cli, model, data, **trainer_kwargs):
+    # Perplexity table of model (measure_perplexity_HOSVD_var=True), saved in the log directory and in the cache if any
+    total_conv_layer = len(model.all_conv_layers)
+
+    set_of_epsilons = parse_epsilons(cli.config['set_of_epsilons'])
+    single_pass = cli.config['measure_single_pass']
+    total_epoch = 1 if single_pass else len(set_of_epsilons)
+    trainer = cli.reset_trainer(max_epochs=total_epoch, **trainer_kwargs)
+
+    if cli.config['measure_workers'] != 0:
+        def loss_fn(model, batch): # Same as training_step
+            if model.set_bn_eval:
+                model.bn_eval()
+            img, label = batch['image'], batch['label']
+            if img.shape[1] == 1:
+                img = torch.cat([img] * 3, dim=1)
+            return model.loss(model(img), label)
+
+        data.setup('fit')
+        perplexity = measure_perplexity_parallel(model, model.filter_cfgs["finetuned_layer"], data.train_dataloader(), loss_fn, set_of_epsilons,
+                                                 num_batches=cli.config['measure_batches'],
+                                                 num_workers=None if cli.config['measure_workers'] < 0 else cli.config['measure_workers'],
+                                                 spill_dir=cli.config['measure_spill_dir'], radius=model.filt_radius)
+        record_shapes(model, perplexity)
+        saved_location = os.path.dirname(trainer.logger.log_dir) # Not created by the logger, nothing has been logged
+        os.makedirs(saved_location, exist_ok=True)
+        perplexity.save(os.path.join(saved_location, 'perplexity.pkl'))
+        delete_junk_folder(saved_location)
+    else:
         perplexity = Perplexity(set_of_epsilons=set_of_epsilons,
                                 perplexity=[[None for epsilon_idx in range(len(set_of_epsilons))] for layer in range(total_conv_layer)],
                                 ranks=[[None for epsilon_idx in range(len(set_of_epsilons))] for layer in range(total_conv_layer)],
-                                layer_mems=[[None for epsilon_idx in range(len(set_of_epsilons))] for layer in range(total_conv_layer)])
-        
-        total_epoch = len(set_of_epsilons)
-        trainer = cli.reset_trainer(max_epochs=total_epoch)
-
-        callback = LogActivationMemoryCallback(perplexity=perplexity)
+                                layer_mems=[[None for epsilon_idx in range(len(set_of_epsilons))] for layer in range(total_conv_layer)],
+                                filter_perplexity=[None for layer in range(total_conv_layer)],
+                                layer_flops=[[None for epsilon_idx in range(len(set_of_epsilons))] for layer in range(total_conv_layer)],
+                                vanilla_flops=[None for layer in range(total_conv_layer)],
+                                layer_names=list(model.conv_layer_names),
+                                spectra=[None for layer in range(total_conv_layer)])
+        record_shapes(model, perplexity)
+
+        callback = LogActivationMemoryCallback(perplexity=perplexity, single_pass=single_pass)
         trainer.callbacks.append(callback)
 
         trainer.fit(model, data)
@@ -99,13 +159,45 @@ def run():
         perplexity.save(os.path.join(os.path.dirname(model.logger.log_dir), 'perplexity.pkl'))
         delete_junk_folder(os.path.dirname(model.logger.log_dir))
 
+    if model.perplexity_cache is not None:
+        model.perplexity_cache.store(perplexity, model.perplexity_provenance)
+    return perplexity
+
+def record_shapes(model, perplexity):
+    # Shapes of the layers of the table at the measured input size, to compute their memory at other sizes (Perplexity.for_shapes)
+    input_size = model.perplexity_provenance["input_size"]
+    if input_size is not None:
+        shapes = get_layer_shapes(model, perplexity.layer_names, input_size)
+        perplexity.input_size, perplexity.shapes = list(input_size), [shapes[name] for name in perplexity.layer_names]
+
+def run():
+    cli = CLI(ClassificationModel, ClsDataset, run=False, save_config_overwrite=True)
 
+    model = cli.model
+    trainer = cli.trainer
+    data = cli.datamodule
+    ##############################################
+    if model.measure_perplexity_HOSVD_var:
+        measure_perplexity(cli, model, data)
         return
+
+    if model.with_ASI and model.suitable_ranks is None: # Not in the cache: measured on measure_batches batches, then the model is built again
+        logging.info("Measuring the perplexity table before training")
+        measure_model = ClassificationModel(**dict(model.initial_state, with_ASI=False, measure_perplexity_HOSVD_var=True))
+        measure_perplexity(cli, measure_model, data, limit_train_batches=cli.config['measure_batches'], limit_val_batches=0,
+                           logger_postfix="_perplexity") # Logged aside, the version folders of the measurement are deleted
+        del measure_model
+        model = ClassificationModel(**model.initial_state)
+        trainer = cli.reset_trainer()
     #################################################################################################
     log_activation_mem = True # A flag indicates that should the memory is logged or not
     # Add call back to log activation memory
     callback = LogActivationMemoryCallback(log_activation_mem=log_activation_mem)
     trainer.callbacks.append(callback)
+    if cli.config['ddp_cpu'] > 1:
+        trainer.callbacks.append(SyncSubspaceCallback(every_n_steps=cli.config['sync_subspace_every'],
+                                                      mode=cli.config['sync_subspace_mode'],
+                                                      comm_hook=cli.config['asi_comm_hook']))
     
     # logging.info(str(model))
     
@@ -114,4 +206,5 @@ def run():
     else:
         trainer.fit(model, data)
 
-run()
+if __name__ == "__main__": # Spawned processes (offline measurement, DDP) import this module again
+    run()
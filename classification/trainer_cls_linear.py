@@ -1,11 +1,14 @@
+import os
+import sys
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'shared')) # Modules shared by classification and segmentation
 import logging
 from pytorch_lightning.utilities.cli import LightningCLI
 from pytorch_lightning.loggers import TensorBoardLogger
 from classification.model_linear import ClassificationModel
 from dataloader.pl_dataset import ClsDataset
-from classification.callback import LogActivationMemoryCallback
-import os
-from pytorch_lightning.callbacks import ModelCheckpoint
+from classification.callback import LogActivationMemoryCallback, SyncSubspaceCallback
+from pytorch_lightning.callbacks import ModelCheckpoint, GPUStatsMonitor
+from pytorch_lightning.strategies import DDPStrategy
 
 logging.basicConfig(level=logging.INFO)
 
@@ -18,6 +21,12 @@ class CLI(LightningCLI):
 
         parser.add_argument('--set_of_epsilons', type=str, help='Comma separated list of epochs', default='0, 0')
 
+        # Data parallel training on CPU (gloo), the ASI subspaces of the replicas are synchronized every sync_subspace_every batches
+        parser.add_argument('--ddp_cpu', type=int, help='Number of CPU processes for data parallel training, disabled if < 2', default=0)
+        parser.add_argument('--sync_subspace_every', type=int, help='Synchronize the ASI subspaces every n training batches', default=50)
+        parser.add_argument('--sync_subspace_mode', type=str, help='broadcast (from rank 0) or average', default='broadcast')
+        parser.add_argument('--asi_comm_hook', type=bool, help='All-reduce the gradients of Conv2d_ASI in low-rank form', default=False)
+
     def instantiate_trainer(self, **kwargs):
         if 'fit' in self.config.keys():
             cfg = self.config['fit']
@@ -52,6 +61,17 @@ class CLI(LightningCLI):
             kwargs['enable_checkpointing'] = False
         ######################################
 
+        ############### DDP on CPU with gloo ###############
+        if cfg['ddp_cpu'] > 1:
+            logging.info(f"Data parallel training on {cfg['ddp_cpu']} CPU processes")
+            kwargs['accelerator'] = 'cpu'
+            kwargs['devices'] = cfg['ddp_cpu']
+            kwargs['gpus'] = None
+            kwargs['strategy'] = DDPStrategy(process_group_backend='gloo', find_unused_parameters=False)
+            callbacks = kwargs['callbacks'] if 'callbacks' in kwargs else (self._get(self.config_init, 'trainer').get('callbacks') or [])
+            kwargs['callbacks'] = [callback for callback in callbacks if not isinstance(callback, GPUStatsMonitor)]
+        ######################################
+
         trainer = super(CLI, self).instantiate_trainer(**kwargs)
         return trainer
 
@@ -105,6 +125,10 @@ def run():
     # Add call back to log activation memory
     callback = LogActivationMemoryCallback(log_activation_mem=log_activation_mem)
     trainer.callbacks.append(callback)
+    if cli.config['ddp_cpu'] > 1:
+        trainer.callbacks.append(SyncSubspaceCallback(every_n_steps=cli.config['sync_subspace_every'],
+                                                      mode=cli.config['sync_subspace_mode'],
+                                                      comm_hook=cli.config['asi_comm_hook']))
     
     # logging.info(str(model))
 
@@ -115,4 +139,5 @@ def run():
     # trainer.validate(model, datamodule=data)
 
 
-run()
+if __name__ == "__main__": # Spawned processes (offline measurement, DDP) import this module again
+    run()
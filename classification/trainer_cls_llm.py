@@ -1,10 +1,12 @@
+import os
+import sys
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'shared')) # Modules shared by classification and segmentation
 import logging
 from pytorch_lightning.utilities.cli import LightningCLI
 from pytorch_lightning.loggers import TensorBoardLogger
 from classification.model_llm import ClassificationModel
 from dataloader.pl_dataset import ClsDataset
 from classification.callback import LogActivationMemoryCallback
-import os
 
 os.environ["TOKENIZERS_PARALLELISM"] = "false"
 
@@ -100,4 +102,5 @@ def run():
     # trainer.validate(model, datamodule=data)
 
 
-run()
+if __name__ == "__main__": # Spawned processes (offline measurement, DDP) import this module again
+    run()
@@ -0,0 +1,157 @@
+import torch as th
+import torch.distributed as dist
+
+from custom_op.conv2d.conv_ASI import Conv2d_ASI
+from subspace_sync import align_basis
+
+# DDP communication hook for ASI layers: the weight gradient of a Conv2d_ASI (C', C, K_H, K_W) is all-reduced in the
+# space of a basis Q (C, K1) shared by all ranks, i.e. only (C', K1, K_H, K_W) + (C, K1) elements are sent instead of C'*C*K_H*K_W.
+# The hook works on the dense gradient computed by the backward pass (DDP hands over materialized gradients): it is
+# projected on Q, the Z4 factors of the ranks are not sent as they are.
+#   0. the ranks agree on K1 of each layer (minimum over the ranks, u1 is truncated to it): K1 depends on the local
+#      batch, and all ranks must send tensors of the same size
+#   1. each rank aligns its u1 to the previous shared basis, the aligned u1 are averaged and orthonormalized -> Q
+#   2. each rank projects its gradient on Q: Z = G x_1 Q^T, Z is averaged, G = Z x_1 Q
+# Layers whose factors are not smaller than the dense gradient, or without u1 on some rank (and all other parameters),
+# use the usual dense all-reduce on every rank.
+
+class ASICommState:
+    def __init__(self, model, process_group=None):
+        self.process_group = process_group
+        self.modules = {} # Weight of each Conv2d_ASI -> layer
+        for mod in model.modules():
+            if isinstance(mod, Conv2d_ASI) and mod.groups == 1:
+                self.modules[mod.weight] = mod
+        self.bases = {} # Shared basis Q of each layer from the previous step
+        self.num_element_sent = 0 # For logging
+        self.num_element_dense = 0
+
+def get_u1(module):
+    if getattr(module, 'compile_friendly', False):
+        return module.u1
+    if module.u_list is None:
+        return None
+    return module.u_list[1]
+
+def ASI_allreduce_hook(state, bucket):
+    group = state.process_group if state.process_group is not None else dist.group.WORLD
+    world_size = dist.get_world_size(group)
+    rank = dist.get_rank(group)
+
+    grads = bucket.gradients()
+    params = bucket.parameters()
+
+    # 0. K1 of each candidate layer agreed by all ranks, 0 if some rank has no u1 yet
+    candidates = [(i, param, get_u1(state.modules[param])) for i, (param, grad) in enumerate(zip(params, grads))
+                  if param in state.modules and grad.dim() == 4] # Same list on all ranks (same model)
+    ranks_K1 = th.tensor([u1.shape[1] if u1 is not None else 0 for _, _, u1 in candidates], dtype=th.int64)
+    if len(candidates) > 0:
+        dist.all_reduce(ranks_K1, op=dist.ReduceOp.MIN, group=group)
+
+    # Choose which gradients are sent in factored form, the same on all ranks
+    compressed = []
+    for (i, param, u1), K1 in zip(candidates, ranks_K1.tolist()):
+        C_prime, C, K_H, K_W = grads[i].shape
+        if K1 == 0 or C * K1 + C_prime * K1 * K_H * K_W >= grads[i].numel(): # Fall back to dense
+            continue
+        compressed.append((i, param, u1[:, :K1].to(dtype=grads[i].dtype)))
+
+    # 1. Shared basis
+    if len(compressed) > 0:
+        bases = []
+        for _, param, u1 in compressed:
+            Q = state.bases.get(param)
+            if Q is not None and Q.shape == u1.shape:
+                bases.append(align_basis(u1, Q))
+            else: # First step: take the basis of rank 0
+                bases.append(u1 if rank == 0 else th.zeros_like(u1))
+        flat_bases = th.cat([u.flatten() for u in bases])
+        dist.all_reduce(flat_bases, group=group)
+        offset = 0
+        for _, param, u1 in compressed:
+            Q = flat_bases[offset:offset + u1.numel()].view_as(u1)
+            offset += u1.numel()
+            state.bases[param] = th.linalg.qr(Q.float())[0].to(dtype=u1.dtype)
+
+    # 2. Projected gradients and dense gradients in a single all-reduce
+    compressed_idx = set(i for i, _, _ in compressed)
+    to_send = []
+    for i, grad in enumerate(grads):
+        if i in compressed_idx:
+            to_send.append(th.einsum("oikl,ir->orkl", grad, state.bases[params[i]]).flatten()) # Shape: (C', C, K_H, K_W) and (C, K1) -> (C', K1, K_H, K_W)
+        else:
+            to_send.append(grad.flatten())
+    flat = th.cat(to_send)
+    state.num_element_sent += flat.numel() + sum(u1.numel() for _, _, u1 in compressed)
+    state.num_element_dense += bucket.buffer().numel()
+    dist.all_reduce(flat, group=group)
+    flat.div_(world_size)
+
+    offset = 0
+    for i, grad in enumerate(grads):
+        if i in compressed_idx:
+            Q = state.bases[params[i]]
+            C_prime, C, K_H, K_W = grad.shape
+            Z = flat[offset:offset + C_prime * Q.shape[1] * K_H * K_W].view(C_prime, Q.shape[1], K_H, K_W)
+            grad.copy_(th.einsum("orkl,ir->oikl", Z, Q)) # Shape: (C', K1, K_H, K_W) and (C, K1) -> (C', C, K_H, K_W)
+            offset += Z.numel()
+        else:
+            grad.copy_(flat[offset:offset + grad.numel()].view_as(grad))
+            offset += grad.numel()
+
+    fut = th.futures.Future()
+    fut.set_result(bucket.buffer())
+    return fut
+
+def register_ASI_comm_hook(ddp_model, process_group=None):
+    state = ASICommState(ddp_model.module, process_group)
+    ddp_model.register_comm_hook(state, ASI_allreduce_hook)
+    return state
+
+########################## Check on CPU with gloo: PYTHONPATH=../shared python -m utils.ddp_comm_hook --world_size 4 ##########################
+def _check(rank, world_size, rank_of_layer, steps):
+    import os
+    import torch.nn as nn
+    from torch.nn.parallel import DistributedDataParallel as DDP
+    from custom_op.conv2d.conv_ASI import wrap_convASI
+
+    os.environ['MASTER_ADDR'] = '127.0.0.1'
+    os.environ['MASTER_PORT'] = '29533'
+    dist.init_process_group('gloo', rank=rank, world_size=world_size)
+
+    def build_model():
+        th.manual_seed(233)
+        model = nn.Sequential(nn.Conv2d(3, 32, 3, padding=1), nn.ReLU(), nn.Conv2d(32, 64, 3, padding=1), nn.ReLU(),
+                              nn.AdaptiveAvgPool2d(1), nn.Flatten(), nn.Linear(64, 10))
+        model[2] = wrap_convASI(model[2], True, rank_of_layer)
+        return model
+
+    compressed_model = DDP(build_model())
+    state = register_ASI_comm_hook(compressed_model)
+    dense_model = DDP(build_model())
+
+    for step in range(steps):
+        th.manual_seed(step * world_size + rank) # Different data on each rank
+        x, y = th.randn(8, 3, 16, 16), th.randint(0, 10, (8,))
+        for model in [compressed_model, dense_model]:
+            model.zero_grad()
+            nn.functional.cross_entropy(model(x), y).backward()
+        grad_compressed = compressed_model.module[2].weight.grad
+        grad_dense = dense_model.module[2].weight.grad
+        error = (th.norm(grad_compressed - grad_dense) / th.norm(grad_dense)).item()
+        if rank == 0:
+            print(f"step {step}: relative error of the ASI layer gradient {error:.4f}, "
+                  f"classifier gradient equal: {th.allclose(compressed_model.module[6].weight.grad, dense_model.module[6].weight.grad, atol=1e-6)}")
+    if rank == 0:
+        print(f"Sent {state.num_element_sent} elements instead of {state.num_element_dense}")
+    dist.destroy_process_group()
+
+if __name__ == "__main__":
+    import argparse
+    import torch.multiprocessing as mp
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--world_size", type=int, default=2)
+    parser.add_argument("--rank", type=int, default=8)
+    parser.add_argument("--steps", type=int, default=5)
+    args = parser.parse_args()
+    mp.spawn(_check, args=(args.world_size, args.rank, args.steps), nprocs=args.world_size)
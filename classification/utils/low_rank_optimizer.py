@@ -0,0 +1,100 @@
+import torch as th
+from torch.optim import Optimizer
+
+class LowRankOptimizer(Optimizer):
+    """
+    Adam (or SGD with momentum if use_sgd) where the weights of Conv2d_ASI with factored gradients (param.grad_factors)
+    keep their optimizer state in a projected subspace (GaLore-style):
+
+    - the full gradient G = sum_j conv2d(Z4_j, u1_j) of shape (C', C, K_H, K_W) is never built, it is projected on
+      P (C, r) directly from the factors: R = sum_j Z4_j x_1 (u1_j^T P), shape (C', r, K_H, K_W)
+    - the moments have the shape of R, the update is brought back to the weight space with P
+    - P is the last u1 (orthonormal), refreshed every update_proj_gap steps, the moments are re-projected on the new P
+
+    The other parameters are updated like in th.optim.Adam / th.optim.SGD.
+    """
+    def __init__(self, params, lr=1e-3, betas=(0.9, 0.999), eps=1e-8, weight_decay=0, momentum=0, use_sgd=False, update_proj_gap=200):
+        defaults = dict(lr=lr, betas=betas, eps=eps, weight_decay=weight_decay, momentum=momentum, use_sgd=use_sgd, update_proj_gap=update_proj_gap)
+        super(LowRankOptimizer, self).__init__(params, defaults)
+
+    def zero_grad(self, set_to_none=False):
+        super(LowRankOptimizer, self).zero_grad(set_to_none=set_to_none)
+        for group in self.param_groups:
+            for p in group['params']:
+                if getattr(p, 'grad_factors', None) is not None:
+                    p.grad_factors.clear()
+
+    def update(self, p, grad, state, group):
+        # Usual Adam / SGD update, grad can be a projected gradient
+        if group['weight_decay'] != 0 and 'P' not in state:
+            grad = grad.add(p, alpha=group['weight_decay'])
+
+        if group['use_sgd']:
+            if group['momentum'] == 0:
+                return grad
+            if 'momentum_buffer' not in state:
+                state['momentum_buffer'] = grad.clone()
+            else:
+                state['momentum_buffer'].mul_(group['momentum']).add_(grad)
+            return state['momentum_buffer']
+
+        beta1, beta2 = group['betas']
+        if 'exp_avg' not in state:
+            state['exp_avg'] = th.zeros_like(grad)
+            state['exp_avg_sq'] = th.zeros_like(grad)
+        state['exp_avg'].mul_(beta1).add_(grad, alpha=1 - beta1)
+        state['exp_avg_sq'].mul_(beta2).addcmul_(grad, grad, value=1 - beta2)
+        bias_correction1 = 1 - beta1 ** state['step']
+        bias_correction2 = 1 - beta2 ** state['step']
+        denom = (state['exp_avg_sq'] / bias_correction2).sqrt().add_(group['eps'])
+        return (state['exp_avg'] / bias_correction1) / denom
+
+    def update_projection(self, state, P):
+        # Move the moments from the old subspace to the new one
+        if 'P' in state and state['P'].shape == P.shape:
+            change = state['P'].t() @ P # Shape: (r, r)
+            for key in ['momentum_buffer', 'exp_avg']:
+                if key in state:
+                    state[key] = th.einsum("orkl,rs->oskl", state[key], change)
+            if 'exp_avg_sq' in state: # Second moment: only kept in the diagonal of the new basis
+                state['exp_avg_sq'] = th.einsum("orkl,rs->oskl", state['exp_avg_sq'], change ** 2)
+        else: # First step or the rank has changed
+            for key in ['momentum_buffer', 'exp_avg', 'exp_avg_sq']:
+                state.pop(key, None)
+            state['step'] = 1 # New moments, the bias correction starts again
+        state['P'] = P
+
+    @th.no_grad()
+    def step(self, closure=None):
+        loss = None
+        if closure is not None:
+            with th.enable_grad():
+                loss = closure()
+
+        for group in self.param_groups:
+            for p in group['params']:
+                grad_factors = getattr(p, 'grad_factors', None)
+                if grad_factors is not None and len(grad_factors.factors) > 0: # Factored gradient of Conv2d_ASI
+                    state = self.state[p]
+                    state['step'] = state.get('step', 0) + 1
+                    _, u1_last = grad_factors.factors[-1]
+                    if 'P' not in state or state['P'].shape != u1_last.shape or (state['step'] - 1) % group['update_proj_gap'] == 0:
+                        self.update_projection(state, u1_last.to(dtype=p.dtype))
+                    P = state['P'] # Shape: (C, r)
+
+                    R = 0
+                    for Z4, u1 in grad_factors.factors:
+                        R = R + th.einsum("oakl,ar->orkl", Z4.to(dtype=p.dtype), u1.to(dtype=p.dtype).t() @ P) # Shape: (C', K1, K_H, K_W) and (K1, r) -> (C', r, K_H, K_W)
+                    if group['weight_decay'] != 0:
+                        R = R + group['weight_decay'] * th.einsum("oikl,ir->orkl", p, P)
+
+                    update = self.update(p, R, state, group)
+                    p.add_(th.einsum("orkl,ir->oikl", update, P), alpha=-group['lr']) # Shape: (C', r, K_H, K_W) and (C, r) -> (C', C, K_H, K_W)
+
+                elif p.grad is not None:
+                    state = self.state[p]
+                    state['step'] = state.get('step', 0) + 1
+                    update = self.update(p, p.grad, state, group)
+                    p.add_(update, alpha=-group['lr'])
+
+        return loss
@@ -1,20 +1,84 @@
-# Measure based on backtracking approach
+# Measure based on multiple-choice knapsack solvers (rank_allocation.py)
 
 import pickle
+import copy
 import matplotlib.pyplot as plt
 import os
+import itertools
+import numpy as np
+from math import sqrt, prod
+from utils.planner import ASI_cost, vanilla_cost
+from rank_allocation import as_arrays, summarize, allocate, min_memory_solution, pareto_frontier, query_frontier, solve_two_budgets
+from perplexity_table import is_missing, save_table, load_table, weights_fingerprint, PerplexityCache
+
+TABLES = ['perplexity', 'layer_mems', 'perplexity_std', 'layer_mems_std', 'layer_flops', 'vanilla_flops', 'filter_perplexity'] # Numeric tables, see perplexity_table.py
+
+def rank_memory(shape, rank):
+    # MB of the HOSVD (core and factors) of an input of shape shape["input"], rank of each mode clipped as in hosvd_var
+    dims = shape["input"]
+    K = [min(int(k), n, prod(dims) // n) for k, n in zip(rank, dims)]
+    return (prod(K) + sum(k*n for k, n in zip(K, dims)))*4/(1024*1024)
+
+class RunningStats:
+    """
+    Running mean and variance (Welford) of each cell of a (layers, epsilons) table, O(layers x epsilons) memory
+    whatever the number of batches.
+    """
+    def __init__(self, num_layers, num_epsilons):
+        self.count = [[0 for _ in range(num_epsilons)] for _ in range(num_layers)]
+        self.mean = [[0. for _ in range(num_epsilons)] for _ in range(num_layers)]
+        self.M2 = [[0. for _ in range(num_epsilons)] for _ in range(num_layers)] # Sum of squared deviations
+
+    def update(self, layer, epsilon, value):
+        self.count[layer][epsilon] += 1
+        delta = value - self.mean[layer][epsilon]
+        self.mean[layer][epsilon] += delta / self.count[layer][epsilon]
+        self.M2[layer][epsilon] += delta * (value - self.mean[layer][epsilon])
+
+    def get(self, layer, epsilon):
+        # (mean, standard deviation over the batches)
+        count = self.count[layer][epsilon]
+        std = sqrt(self.M2[layer][epsilon] / (count - 1)) if count > 1 else 0.
+        return self.mean[layer][epsilon], std
+
+def update_spectra(previous, spectra, count):
+    """
+    Running mean of the spectra (cumulative explained variance of each mode) of a layer over the batches, count is the
+    number of batches in previous. A batch with other dimensions (smaller last batch) is skipped. Returns (mean, count).
+    """
+    if previous is None:
+        return spectra, 1
+    if [len(mode) for mode in previous] != [len(mode) for mode in spectra]:
+        return previous, count
+    return [[p + (v - p) / (count + 1) for p, v in zip(mode_previous, mode)] for mode_previous, mode in zip(previous, spectra)], count + 1
 
 class Perplexity:
-    def __init__(self, set_of_epsilons=[], perplexity=[], ranks=[], layer_mems=[], link='.'):
+    def __init__(self, set_of_epsilons=[], perplexity=[], ranks=[], layer_mems=[], filter_perplexity=[], layer_flops=[], vanilla_flops=[],
+                 perplexity_std=[], layer_mems_std=[], num_batches=1, layer_names=[], spectra=[], link='.'):
+        self.layer_names = layer_names
         self.set_of_epsilons = set_of_epsilons
         self.perplexity = perplexity
         self.link = link
         self.ranks = ranks
         self.layer_mems = layer_mems
+        self.frontiers = {} # num_of_finetuned -> (memory, perplexity, indices) of the Pareto frontier
+        self.filter_perplexity = filter_perplexity # Perplexity of gradient filter for each layer (does not depend on epsilon)
+        self.layer_flops = layer_flops # Forward + backward FLOPs of ASI, same layout as layer_mems
+        self.vanilla_flops = vanilla_flops # Forward + backward FLOPs of vanilla training for each layer
+        # Measured on num_batches batches: perplexity is the mean, with its standard deviation over the batches. layer_mems is the
+        # memory of the ranks (the largest of the batches) on the largest batch, its std is 0 (older tables: mean and std over the batches)
+        self.perplexity_std = perplexity_std
+        self.layer_mems_std = layer_mems_std
+        self.num_batches = num_batches
+        self.spectra = spectra # Cumulative explained variance of each mode of each layer (single pass measurement), see mode_options
+        self.metadata = {} # What produced the table (weights, dataset, input shape ...), see PerplexityCache
+        # Input size (B, C, H, W) of the measurement and shape of each layer at this size, to compute the memory at another size (see for_shapes)
+        self.input_size = None
+        self.shapes = []
         
 
     def plot(self, is_saved=False, name=None):
-        if not self.set_of_epsilons or not self.perplexity:
+        if len(self.set_of_epsilons) == 0 or len(self.perplexity) == 0:
             print("Dữ liệu epsilon hoặc perplexity trống.")
             return
 
@@ -38,23 +102,94 @@ class Perplexity:
         plt.show()
 
     def save(self, link):
-        with open(link, 'wb') as file:
+        if not link.endswith('.pkl'):
+            return self.save_table(link)
+        tmp_link = f"{link}.{os.getpid()}.tmp" # Written aside then renamed: other processes may be loading the same file
+        with open(tmp_link, 'wb') as file:
             pickle.dump({
                 'set_of_epsilons': self.set_of_epsilons,
                 'perplexity': self.perplexity,
                 'ranks': self.ranks,
-                'layer_mems': self.layer_mems
+                'layer_mems': self.layer_mems,
+                'frontiers': self.frontiers,
+                'filter_perplexity': self.filter_perplexity,
+                'layer_flops': self.layer_flops,
+                'vanilla_flops': self.vanilla_flops,
+                'perplexity_std': self.perplexity_std,
+                'layer_mems_std': self.layer_mems_std,
+                'num_batches': self.num_batches,
+                'layer_names': self.layer_names,
+                'metadata': self.metadata,
+                'input_size': self.input_size,
+                'shapes': self.shapes,
+                'spectra': self.spectra
             }, file)
+        os.replace(tmp_link, link)
         print(f'Perplexity is saved at {link}')
 
     def load(self, link):
+        if os.path.isdir(link):
+            return self.load_table(link)
         with open(link, 'rb') as file:
             data = pickle.load(file)
             self.set_of_epsilons = data['set_of_epsilons']
             self.perplexity = data['perplexity']
             self.ranks = data['ranks']
             self.layer_mems = data['layer_mems']
+            self.frontiers = data.get('frontiers', {}) # Not available in older files
+            self.filter_perplexity = data.get('filter_perplexity', []) # Not available in older files
+            self.layer_flops = data.get('layer_flops', [])
+            self.vanilla_flops = data.get('vanilla_flops', [])
+            self.perplexity_std = data.get('perplexity_std', [])
+            self.layer_mems_std = data.get('layer_mems_std', [])
+            self.num_batches = data.get('num_batches', 1)
+            self.layer_names = data.get('layer_names', [])
+            self.metadata = data.get('metadata', {})
+            self.input_size = data.get('input_size', None)
+            self.shapes = data.get('shapes', [])
+            self.spectra = data.get('spectra', [])
+
+    def save_table(self, directory):
+        save_table(self, directory, TABLES, {
+            'layer_names': self.layer_names,
+            'set_of_epsilons': self.set_of_epsilons,
+            'ranks': self.ranks,
+            'num_batches': self.num_batches,
+            'metadata': self.metadata,
+            'input_size': self.input_size,
+            'shapes': self.shapes,
+            'spectra': self.spectra
+        })
+
+    def load_table(self, directory):
+        meta = load_table(self, directory, TABLES)
+        self.layer_names = meta['layer_names']
+        self.set_of_epsilons = meta['set_of_epsilons']
+        self.ranks = meta['ranks']
+        self.num_batches = meta['num_batches']
+        self.metadata = meta['metadata']
+        self.input_size = meta.get('input_size', None)
+        self.shapes = meta.get('shapes', [])
+        self.spectra = meta.get('spectra', [])
     
+    def for_shapes(self, shapes, input_size=None):
+        """
+        Copy of the table for another batch size or resolution: shapes are the layer shapes at this size (see
+        utils.planner.get_layer_shapes), in the order of the rows. The memory and FLOPs of the measured ranks of each mode
+        are computed again with ASI_cost (ranks clipped to the new shapes), the perplexity is kept.
+        """
+        table = copy.copy(self)
+        table.input_size, table.shapes, table.frontiers = input_size, shapes, {}
+        cost = lambda shape, rank: ASI_cost(shape, list(rank) if isinstance(rank, (list, tuple)) else rank)
+        table.layer_mems = [[cost(shape, rank)[0]*4/(1024*1024) if rank is not None else None for rank in ranks] # MB
+                            for shape, ranks in zip(shapes, self.ranks)]
+        table.layer_flops = [[sum(cost(shape, rank)[1:]) if rank is not None else None for rank in ranks]
+                             for shape, ranks in zip(shapes, self.ranks)]
+        table.vanilla_flops = [sum(vanilla_cost(shape)[1:]) for shape in shapes]
+        if len(self.layer_mems_std) > 0: # The memory of given ranks does not vary any more
+            table.layer_mems_std = [[0. for _ in row] for row in table.layer_mems]
+        return table
+
     def get_suitable_ranks(self, best_indices, num_of_finetuned):
         if num_of_finetuned == None or num_of_finetuned > len(self.layer_mems):
             print("[Perplexity class] Warning, num_of_finetuned is bigger than total number of layer or None, set it to be total number of layer")
@@ -85,57 +220,182 @@ class Perplexity:
         
         return suitable_mems
 
-    def find_best_combination(self, budget, num_of_finetuned=None):
+    def has_frontier(self, num_of_finetuned=None):
         if num_of_finetuned == None or num_of_finetuned > len(self.layer_mems):
-            print("[Perplexity class] Warning, num_of_finetuned is bigger than total number of layer or None, set it to be total number of layer")
             num_of_finetuned = len(self.layer_mems)
-        
-        total_layer = len(self.layer_mems)
-        total_rank = len(self.layer_mems[0])
+        return num_of_finetuned in self.frontiers
 
-        best_memory = 0
-        best_perplexity = float('inf')
-        best_indices = []
-
-        min_memory = float('inf')
-        min_memory_indices = []
-
-        def backtrack(layer, current_memory, current_perplexity, indices):
-            nonlocal best_memory, best_perplexity, best_indices, min_memory, min_memory_indices
+    def get_frontier(self, num_of_finetuned=None):
+        """
+        Pareto frontier (memory, perplexity, indices) of the finetuned layers, computed once and kept in self.frontiers
+        (saved with the perplexity file). Memory is increasing and perplexity strictly decreasing along the frontier.
+        """
+        if num_of_finetuned == None or num_of_finetuned > len(self.layer_mems):
+            num_of_finetuned = len(self.layer_mems)
+        if num_of_finetuned not in self.frontiers:
+            start_layer = len(self.layer_mems) - num_of_finetuned
+            self.frontiers[num_of_finetuned] = pareto_frontier(self.layer_mems[start_layer:], self.perplexity[start_layer:])
+        return self.frontiers[num_of_finetuned]
+
+    def frontier_points(self, num_of_finetuned=None):
+        # [(memory, perplexity, indices, ranks)] of every point of the frontier, e.g. to sweep the budgets
+        memory, perplexity, indices = self.get_frontier(num_of_finetuned)
+        return [(float(m), float(p), [int(i) for i in idx], self.get_suitable_ranks(idx, num_of_finetuned))
+                for m, p, idx in zip(memory, perplexity, indices)]
+
+    def plot_frontier(self, num_of_finetuned=None, is_saved=False, name=None):
+        memory, perplexity, _ = self.get_frontier(num_of_finetuned)
+        plt.step(memory, perplexity, where='post', marker='.')
+        plt.xlabel('Memory (MB)')
+        plt.ylabel('Perplexity')
+        plt.title('Memory-perplexity Pareto frontier')
+        plt.grid(True)
 
-            if layer == total_layer:
-                if current_memory <= budget and current_perplexity < best_perplexity:
-                    best_memory = current_memory
-                    best_perplexity = current_perplexity
-                    best_indices = indices[:]
-                
-                if current_memory < min_memory:
-                    min_memory = current_memory
-                    min_memory_indices = indices[:]
+        if is_saved:
+            if name is None: name = 'frontier.svg'
+            file_path = os.path.join(self.link, name)
+            plt.savefig(file_path)
+            print(f'Figure is saved at {file_path}')
 
-                return
+        plt.show()
 
-            for rank in range(total_rank):
-                new_memory = current_memory + self.layer_mems[layer][rank]
-                new_perplexity = current_perplexity + self.perplexity[layer][rank]
+    def confidence_bounds(self, start_layer, perplexity_kappa=None, memory_kappa=None):
+        """
+        Tables of the finetuned layers with the spread over the measured batches:
+            - perplexity + perplexity_kappa * standard error: upper confidence bound of the mean perplexity
+            - layer_mems + memory_kappa * std: memory of a single training batch, exceeded with a small probability
+        """
+        costs = np.asarray(self.layer_mems[start_layer:], dtype=np.float64)
+        values = np.asarray(self.perplexity[start_layer:], dtype=np.float64)
+        if (perplexity_kappa and len(self.perplexity_std) == 0) or (memory_kappa and len(self.layer_mems_std) == 0):
+            raise ValueError("The spread over batches is not measured in this perplexity file, measure the perplexity on several batches")
+        if perplexity_kappa:
+            values = values + perplexity_kappa * np.asarray(self.perplexity_std[start_layer:], dtype=np.float64) / sqrt(self.num_batches)
+        if memory_kappa:
+            costs = costs + memory_kappa * np.asarray(self.layer_mems_std[start_layer:], dtype=np.float64)
+        return costs, values
+
+    def find_best_combination(self, budget, num_of_finetuned=None, method="auto", flops_budget=None, flops_weight=None,
+                              perplexity_kappa=None, memory_kappa=None):
+        """
+        Epsilon of each finetuned layer minimizing the total perplexity within the memory budget (multiple-choice knapsack,
+        see rank_allocation.py). Returns (memory, perplexity, indices, ranks).
+        If the frontier of num_of_finetuned is already known (or method="frontier"), the budget is answered by binary search on it.
+        With the FLOPs measured (layer_flops):
+            - flops_budget: the total FLOPs must also fit flops_budget (only flops_budget if budget is None)
+            - flops_weight: budget is on memory (MB) + flops_weight * FLOPs
+        With perplexity_kappa / memory_kappa, the solver works on the confidence bounds (see confidence_bounds)
+        instead of the means, and the returned memory and perplexity are these bounds.
+        """
+        if num_of_finetuned == None or num_of_finetuned > len(self.layer_mems):
+            print("[Perplexity class] Warning, num_of_finetuned is bigger than total number of layer or None, set it to be total number of layer")
+            num_of_finetuned = len(self.layer_mems)
 
-                indices.append(rank)
-                backtrack(layer + 1, new_memory, new_perplexity, indices)
-                indices.pop()
+        start_layer = len(self.layer_mems) - num_of_finetuned
+        costs = self.layer_mems[start_layer:]
+        values = self.perplexity[start_layer:]
+        bounded = bool(perplexity_kappa) or bool(memory_kappa)
+        if bounded:
+            costs, values = self.confidence_bounds(start_layer, perplexity_kappa, memory_kappa)
+
+        if flops_budget is None and flops_weight is None:
+            if not bounded and (method == "frontier" or (method == "auto" and self.has_frontier(num_of_finetuned))): # The frontier is on the means
+                solution = query_frontier(self.get_frontier(num_of_finetuned), budget)
+            else:
+                solution = allocate(costs, values, budget, method=method)
+            if solution is None:
+                print("Warning: No valid combination found within the budget. Returning the combination with the smallest memory.")
+                solution = min_memory_solution(costs, values)
+            best_memory, best_perplexity, best_indices = solution
+        else:
+            if len(self.layer_flops) == 0 or any(is_missing(value) for row in self.layer_flops[start_layer:] for value in row):
+                raise ValueError("FLOPs are not measured in this perplexity file, measure the perplexity again to use flops_budget or flops_weight")
+            costs, values = as_arrays(costs, values)
+            flops = np.asarray(self.layer_flops[start_layer:], dtype=np.float64)
+            if flops_weight is not None:
+                constraint = costs + flops_weight * flops
+                solution = allocate(constraint, values, budget, method=method)
+            elif budget is None:
+                constraint = flops
+                solution = allocate(constraint, values, flops_budget, method=method)
+            else:
+                constraint = costs + flops / flops_budget * budget # Only used for the fallback
+                solution = solve_two_budgets(costs, flops, values, budget, flops_budget)
+            if solution is None:
+                print("Warning: No valid combination found within the budgets. Returning the cheapest combination.")
+                solution = min_memory_solution(constraint, values)
+            best_memory, best_perplexity, best_indices = summarize(costs, values, solution[2])
+
+        if len(self.layer_flops) > 0 and len(self.vanilla_flops) > 0 and not any(is_missing(value) for value in self.vanilla_flops[start_layer:]) \
+                and not any(is_missing(value) for row in self.layer_flops[start_layer:] for value in row):
+            best_flops = sum(self.layer_flops[start_layer + i][idx] for i, idx in enumerate(best_indices))
+            vanilla_flops = sum(self.vanilla_flops[start_layer:])
+            print(f"[Perplexity class] FLOPs of the finetuned layers: {best_flops:.4g} (vanilla training: {vanilla_flops:.4g})")
+            if best_flops > vanilla_flops:
+                print("[Perplexity class] Warning, the decomposition costs more FLOPs than vanilla training with these ranks, consider flops_budget")
+        return best_memory, best_perplexity, best_indices, self.get_suitable_ranks(best_indices, num_of_finetuned)
+
+    def mode_options(self, layer_idx, thresholds=None, max_options=32):
+        """
+        Options of layer layer_idx where the rank of each mode is chosen separately: for each mode, the ranks reaching the
+        thresholds of its spectrum, and all their combinations. The gradient error of ranks (K0, K1, K2, K3) is modeled as
+            alpha * sqrt(sum over the modes of the variance left out by Kn)
+        i.e. proportional to the HOSVD bound of the input error. The measured epsilons are options too, with their measured
+        perplexity: alpha is the largest ratio perplexity / modeled error of the measured epsilons, so that a modeled option
+        is never scored better than the measurements would have it. Returns (costs, values, ranks) of the Pareto optimal
+        options, at most max_options of them.
+        """
+        measured = [(m, p, list(r)) for m, p, r in zip(self.layer_mems[layer_idx], self.perplexity[layer_idx], self.ranks[layer_idx]) if not is_missing(p)]
+        costs, values, ranks = [m for m, _, _ in measured], [p for _, p, _ in measured], [r for _, _, r in measured]
+        spectra = self.spectra[layer_idx] if self.spectra else None
+
+        if spectra is not None:
+            left_out = lambda mode, k: max(0., 1. - mode[min(k, len(mode)) - 1])
+            error = lambda rank: sqrt(sum(left_out(mode, k) for mode, k in zip(spectra, rank)))
+            errors = np.array([error(r) for r in ranks])
+            if np.any(errors > 0): # Otherwise only full ranks are measured, alpha can not be fitted
+                alpha = float(np.max(np.array(values)[errors > 0] / errors[errors > 0]))
+                dims = self.shapes[layer_idx]["input"] if self.shapes else [len(mode) for mode in spectra] # Memory at the shapes of the table (see for_shapes)
+                thresholds = thresholds or sorted(set(self.set_of_epsilons) | {0.5, 0.6, 0.7, 0.8, 0.9, 0.95, 0.99, 1.})
+                mode_ranks = [sorted({min(int(np.searchsorted(mode, t)) + 1, len(mode)) for t in thresholds}) for mode in spectra]
+                for rank in itertools.product(*mode_ranks):
+                    K = [min(k, n) for k, n in zip(rank, dims)]
+                    costs.append((prod(K) + sum(k*n for k, n in zip(K, dims)))*4/(1024*1024)) # MB, as in the measurement
+                    values.append(alpha * error(rank))
+                    ranks.append(K)
+
+        if not costs:
+            raise ValueError(f"Layer {layer_idx} has no measured perplexity, measure the perplexity again to choose its ranks")
+        costs, values = np.asarray(costs, dtype=np.float64), np.asarray(values, dtype=np.float64)
+        order = np.lexsort((values, costs))
+        best = np.minimum.accumulate(values[order])
+        keep = order[np.r_[True, values[order][1:] < best[:-1]]] # Pareto optimal: cheaper or strictly better
+        if len(keep) > max_options:
+            keep = keep[np.linspace(0, len(keep) - 1, max_options).round().astype(int)]
+        return costs[keep].tolist(), values[keep].tolist(), [ranks[i] for i in keep]
+
+    def find_best_mode_ranks(self, budget, num_of_finetuned=None, thresholds=None, max_options=32, method="auto"):
+        """
+        Ranks of each mode of each finetuned layer minimizing the total perplexity within the memory budget, the options
+        of each layer being the ones of mode_options (only the measured epsilons for a layer without spectra).
+        Returns (memory, perplexity, ranks), the perplexity of the modeled options being a conservative estimate (see mode_options).
+        """
+        if num_of_finetuned == None or num_of_finetuned > len(self.layer_mems):
+            print("[Perplexity class] Warning, num_of_finetuned is bigger than total number of layer or None, set it to be total number of layer")
+            num_of_finetuned = len(self.layer_mems)
 
         start_layer = len(self.layer_mems) - num_of_finetuned
-        backtrack(start_layer, 0, 0, [])
+        options = [self.mode_options(layer_idx, thresholds, max_options) for layer_idx in range(start_layer, len(self.layer_mems))]
+        width = max(len(costs) for costs, _, _ in options)
+        pad = lambda row: row + [row[-1]] * (width - len(row)) # Repeating an option of a layer changes nothing
+        costs, values = [pad(costs) for costs, _, _ in options], [pad(values) for _, values, _ in options]
 
-        if best_perplexity == float('inf'):
+        solution = allocate(costs, values, budget, method=method)
+        if solution is None:
             print("Warning: No valid combination found within the budget. Returning the combination with the smallest memory.")
-            best_perplexity = 0
-            i = 0
-            for layer in range(start_layer, len(self.layer_mems)):
-                best_perplexity += self.perplexity[layer][min_memory_indices[i]]
-                i+= 1
-            return min_memory, best_perplexity, min_memory_indices, self.get_suitable_ranks(min_memory_indices, num_of_finetuned)
-        else:
-            return best_memory, best_perplexity, best_indices, self.get_suitable_ranks(best_indices, num_of_finetuned)
+            solution = min_memory_solution(costs, values)
+        best_memory, best_perplexity, best_indices = solution
+        return best_memory, best_perplexity, [options[i][2][idx] for i, idx in enumerate(best_indices)]
 
 def merged_perplexity(*links_to_perplexity):
 
@@ -144,15 +404,31 @@ def merged_perplexity(*links_to_perplexity):
 
     perplexity_merged = Perplexity()
     perplexity_merged.load(links_to_perplexity[0])
+    perplexity_merged.frontiers = {} # The options change, the frontiers have to be recomputed
+    concat = lambda table1, table2: [list(row1) + list(row2) for row1, row2 in zip(table1, table2)] # Lists or loaded arrays
 
     for link in links_to_perplexity[1:]:
         perplexity_temp = Perplexity()
         perplexity_temp.load(link)
 
         perplexity_merged.set_of_epsilons += perplexity_temp.set_of_epsilons
-        perplexity_merged.perplexity = [row1 + row2 for row1, row2 in zip(perplexity_merged.perplexity, perplexity_temp.perplexity)]
-        perplexity_merged.ranks = [row1 + row2 for row1, row2 in zip(perplexity_merged.ranks, perplexity_temp.ranks)]
-        perplexity_merged.layer_mems = [row1 + row2 for row1, row2 in zip(perplexity_merged.layer_mems, perplexity_temp.layer_mems)]
+        perplexity_merged.perplexity = concat(perplexity_merged.perplexity, perplexity_temp.perplexity)
+        perplexity_merged.ranks = concat(perplexity_merged.ranks, perplexity_temp.ranks)
+        perplexity_merged.layer_mems = concat(perplexity_merged.layer_mems, perplexity_temp.layer_mems)
+        if len(perplexity_merged.perplexity_std) > 0 and len(perplexity_temp.perplexity_std) > 0:
+            perplexity_merged.perplexity_std = concat(perplexity_merged.perplexity_std, perplexity_temp.perplexity_std)
+            perplexity_merged.layer_mems_std = concat(perplexity_merged.layer_mems_std, perplexity_temp.layer_mems_std)
+            perplexity_merged.num_batches = min(perplexity_merged.num_batches, perplexity_temp.num_batches)
+        else: # The spread is not known for all epsilons
+            perplexity_merged.perplexity_std, perplexity_merged.layer_mems_std = [], []
+        if len(perplexity_merged.layer_flops) > 0 and len(perplexity_temp.layer_flops) > 0:
+            perplexity_merged.layer_flops = concat(perplexity_merged.layer_flops, perplexity_temp.layer_flops)
+        else: # FLOPs are not known for all epsilons
+            perplexity_merged.layer_flops = []
+        if all(is_missing(value) for value in perplexity_merged.filter_perplexity):
+            perplexity_merged.filter_perplexity = perplexity_temp.filter_perplexity
+        if not any(value is not None for value in perplexity_merged.spectra): # Does not depend on epsilon
+            perplexity_merged.spectra = perplexity_temp.spectra
 
     saved_location = os.path.dirname(os.path.dirname(links_to_perplexity[0]))
     os.makedirs(saved_location, exist_ok=True)
@@ -1,8 +1,9 @@
-# Measure based on dynamic programming approach
+# Measure based on dynamic programming approach (vectorized, see rank_allocation.py)
 
 import pickle
 import matplotlib.pyplot as plt
 import os
+from rank_allocation import allocate, min_memory_solution
 
 class Perplexity:
     def __init__(self, set_of_epsilons=[], perplexity=[], ranks=[], layer_mems=[], link='.'):
@@ -107,36 +108,13 @@ class Perplexity:
             print("Set budget as minimum possible budget")
             budget = int(min_budget_required * round_to)
         
-        dp = [[float('inf')] * (budget + 1) for _ in range(num_of_finetuned + 1)]
-        dp[0][0] = 0
-        
-        choice = [[0] * (budget + 1) for _ in range(num_of_finetuned + 1)]
-        
-        for layer in range(1, num_of_finetuned + 1):
-            for b in range(budget + 1):
-                for rank in range(num_ranks):
-                    mem_cost = int(self.layer_mems[start_layer + layer - 1][rank] * round_to)
+        costs = self.layer_mems[start_layer:start_layer + num_of_finetuned]
+        values = self.perplexity[start_layer:start_layer + num_of_finetuned]
+        solution = allocate(costs, values, budget / round_to, method="dp", num_bins=max(budget, 1))
+        if solution is None: # Budget set to the minimum one: the rounding of the costs may leave no room
+            solution = min_memory_solution(costs, values)
+        best_budget_float, best_perplexity, selected_ranks = solution
 
-                    if b >= mem_cost:
-                        new_perplexity = dp[layer-1][b-mem_cost] + self.perplexity[start_layer + layer - 1][rank]
-
-                        if new_perplexity < dp[layer][b]:
-                            dp[layer][b] = new_perplexity
-                            choice[layer][b] = rank
-        
-        best_perplexity = min(dp[num_of_finetuned])
-        best_budget = dp[num_of_finetuned].index(best_perplexity)
-        
-        selected_ranks = []
-        current_budget = best_budget
-        
-        for layer in range(num_of_finetuned, 0, -1):
-            selected_rank = choice[layer][current_budget]
-            selected_ranks.insert(0, selected_rank)
-            current_budget -= int(self.layer_mems[start_layer + layer - 1][selected_rank] * round_to)
-        
-        best_budget_float = best_budget / float(round_to)
-        
         return best_budget_float, best_perplexity, selected_ranks, self.get_suitable_ranks(selected_ranks, num_of_finetuned)
 
 def merged_perplexity(*links_to_perplexity):
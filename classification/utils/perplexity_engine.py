@@ -0,0 +1,168 @@
+# Offline perplexity measurement on a pool of CPU processes
+# The (input, grad_output) of every measured conv2d layer are recorded for a few batches, then each (layer, batch) pair is
+# measured independently by a worker: one HOSVD for all epsilons (hosvd_var_multi), the exact weight gradient, and the
+# low-rank gradient error, rank, memory and FLOPs of each epsilon. Tensors with at least spill_numel elements are written
+# to .npy spill files in spill_dir and memory-mapped by the workers instead of going through the pool.
+
+import os
+import shutil
+import logging
+import tempfile
+from functools import reduce
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import torch as th
+import torch.nn as nn
+import torch.multiprocessing as mp
+from custom_op.compression.hosvd_var import hosvd_var_multi
+from custom_op.conv2d.conv_measure_perplexity_HOSVD import low_rank_grad_weight, filter_gap
+from utils.planner import ASI_cost, vanilla_cost
+from utils.perplexity import Perplexity, RunningStats, update_spectra, rank_memory
+
+def spill(tensor, spill_dir, name, spill_numel):
+    tensor = tensor.detach().cpu()
+    if spill_dir is None or tensor.numel() < spill_numel:
+        return tensor
+    path = os.path.join(spill_dir, f"{name}.npy")
+    np.save(path, tensor.numpy())
+    return path
+
+def unspill(stored):
+    if isinstance(stored, str):
+        return th.from_numpy(np.array(np.load(stored, mmap_mode='r'))) # Copied out of the mapping, the file can be removed
+    return stored
+
+def stored_bytes(stored):
+    return os.path.getsize(stored) if isinstance(stored, str) else stored.numel() * stored.element_size()
+
+def record_layers(model, layer_names, dataloader, loss_fn, num_batches=1, spill_dir=None, spill_numel=1 << 24):
+    """
+    Run num_batches forward/backward passes (loss_fn(model, batch) returns the loss) and keep the (input, grad_output)
+    of each layer. Returns records {name: [(batch_idx, input, grad_output)]} (tensors or spill files) and convs {name: parameters}.
+    """
+    layers = {name: reduce(getattr, name.split('.'), model) for name in layer_names}
+    records = {name: [] for name in layer_names}
+    current = {"batch": 0}
+    handles = []
+
+    def layer_hook(name):
+        def hook_fn(module, input, output):
+            batch_idx = current["batch"]
+            x = spill(input[0], spill_dir, f"{name}_{batch_idx}_input", spill_numel)
+            def grad_hook(grad):
+                records[name].append((batch_idx, x, spill(grad, spill_dir, f"{name}_{batch_idx}_grad_output", spill_numel)))
+            if output.requires_grad:
+                output.register_hook(grad_hook)
+        return hook_fn
+
+    # Measurement layers (Conv2d_measure_perplexity_HOSVD) run as plain convolutions while recording
+    activated = {name: layer.activate for name, layer in layers.items() if hasattr(layer, 'activate')}
+    for name, layer in layers.items():
+        if name in activated:
+            layer.activate = False
+        handles.append(layer.register_forward_hook(layer_hook(name)))
+
+    is_training = model.training
+    model.train()
+    try:
+        for batch_idx, batch in enumerate(dataloader):
+            if batch_idx >= num_batches:
+                break
+            current["batch"] = batch_idx
+            model.zero_grad()
+            loss_fn(model, batch).backward()
+    finally:
+        for handle in handles:
+            handle.remove()
+        for name, activate in activated.items():
+            layers[name].activate = activate
+        model.zero_grad()
+        model.train(is_training)
+
+    convs = {name: {"weight": layer.weight.detach().cpu(), "stride": tuple(layer.stride), "padding": tuple(layer.padding),
+                    "dilation": tuple(layer.dilation), "groups": layer.groups} for name, layer in layers.items()}
+    return records, convs
+
+def measure_job(job):
+    # Measurement of one (layer, batch) pair for all epsilons, run by a worker
+    name, batch_idx, stored_input, stored_grad_output, conv, set_of_epsilons, radius = job
+    input, grad_output = unspill(stored_input), unspill(stored_grad_output)
+    weight, stride, padding, dilation, groups = conv["weight"], conv["stride"], conv["padding"], conv["dilation"], conv["groups"]
+
+    with th.no_grad():
+        grad_weight = nn.grad.conv2d_weight(input, weight.shape, grad_output, stride, padding, dilation, groups)
+        S, (u0, u1, u2, u3), rank_lists, ex_var_list = hosvd_var_multi(input, set_of_epsilons, return_spectra=True)
+        Z1 = th.einsum("bk,bchw->kchw", u0, grad_output) # Shape: (B, K0) einsum with (B, C', H', W') -> (K0, C', H', W')
+        perplexity = []
+        for K0, K1, K2, K3 in rank_lists:
+            grad_weight_low_rank = low_rank_grad_weight(Z1[:K0], S[:K0, :K1, :K2, :K3], u1[:, :K1], u2[:, :K2], u3[:, :K3],
+                                                        weight.shape, stride, dilation, padding, groups)
+            perplexity.append(th.norm(grad_weight_low_rank - grad_weight).item())
+
+    shape = {"input": list(input.shape), "output": list(grad_output.shape), "kernel_size": list(weight.shape[2:])}
+    layer_flops = [sum(ASI_cost(shape, rank_list)[1:]) for rank_list in rank_lists]
+    vanilla_flops = sum(vanilla_cost(shape)[1:])
+    filter_perplexity = None
+    if radius is not None:
+        filter_perplexity = filter_gap(input, weight, grad_output, grad_weight, stride, dilation, padding, groups, radius).item()
+    spectra = [ex_var.tolist() for ex_var in ex_var_list]
+    return name, batch_idx, perplexity, rank_lists, layer_flops, vanilla_flops, filter_perplexity, spectra, shape
+
+def measure_perplexity_parallel(model, layer_names, dataloader, loss_fn, set_of_epsilons, num_batches=1, num_workers=None,
+                                spill_dir=None, spill_numel=1 << 24, radius=None):
+    """
+    Perplexity table of layer_names (same layout as the one of LogActivationMemoryCallback), measured on num_batches batches
+    by num_workers processes (all cores if None). Perplexity is the mean over the batches (with its standard deviation,
+    see RunningStats), ranks and FLOPs are the largest of the batches. The memory is the one of these ranks on the largest
+    batch (rank_memory), i.e. what training with them allocates, so its standard deviation is 0.
+    """
+    num_workers = num_workers or os.cpu_count()
+    if spill_dir is not None:
+        os.makedirs(spill_dir, exist_ok=True)
+        spill_dir = tempfile.mkdtemp(prefix="perplexity_", dir=spill_dir)
+
+    try:
+        records, convs = record_layers(model, layer_names, dataloader, loss_fn, num_batches, spill_dir, spill_numel)
+        jobs = [(name, batch_idx, x, grad, convs[name], list(set_of_epsilons), radius)
+                for name in layer_names for batch_idx, x, grad in records[name]]
+        jobs.sort(key=lambda job: -stored_bytes(job[2])) # Largest inputs first, to balance the workers
+        logging.info(f"Measuring {len(jobs)} (layer, batch) pairs on {num_workers} processes")
+
+        threads = max(1, (os.cpu_count() or 1) // num_workers)
+        layer_index = {name: i for i, name in enumerate(layer_names)}
+        L, E = len(layer_names), len(set_of_epsilons)
+        perplexity_stats, filter_stats = RunningStats(L, E), RunningStats(L, 1)
+        input_shapes = [None] * L # Largest input of each layer
+        ranks, layer_flops, vanilla_flops = [None] * L, [[0] * E for _ in range(L)], [None] * L
+        spectra, spectra_count = [None] * L, [0] * L
+        with ProcessPoolExecutor(max_workers=num_workers, mp_context=mp.get_context('spawn'),
+                                 initializer=th.set_num_threads, initargs=(threads,)) as executor:
+            for name, _, batch_perplexity, batch_ranks, batch_flops, batch_vanilla, batch_filter, batch_spectra, batch_shape in executor.map(measure_job, jobs):
+                i = layer_index[name]
+                for e in range(E):
+                    perplexity_stats.update(i, e, batch_perplexity[e])
+                    layer_flops[i][e] = max(layer_flops[i][e], batch_flops[e])
+                input_shapes[i] = batch_shape["input"] if input_shapes[i] is None else [max(a, b) for a, b in zip(batch_shape["input"], input_shapes[i])]
+                ranks[i] = batch_ranks if ranks[i] is None else [[max(a, b) for a, b in zip(r, previous)] for r, previous in zip(batch_ranks, ranks[i])]
+                vanilla_flops[i] = batch_vanilla
+                if batch_filter is not None:
+                    filter_stats.update(i, 0, batch_filter)
+                spectra[i], spectra_count[i] = update_spectra(spectra[i], batch_spectra, spectra_count[i])
+    finally:
+        if spill_dir is not None:
+            shutil.rmtree(spill_dir, ignore_errors=True)
+
+    for name in layer_names:
+        if ranks[layer_index[name]] is None:
+            raise RuntimeError(f"Layer {name} has not been reached by the backward pass, it can not be measured")
+    perplexity = Perplexity(layer_names=list(layer_names), set_of_epsilons=list(set_of_epsilons),
+                            perplexity=[[perplexity_stats.get(i, e)[0] for e in range(E)] for i in range(L)],
+                            perplexity_std=[[perplexity_stats.get(i, e)[1] for e in range(E)] for i in range(L)],
+                            ranks=ranks,
+                            layer_mems=[[rank_memory({"input": input_shapes[i]}, ranks[i][e]) for e in range(E)] for i in range(L)],
+                            layer_mems_std=[[0. for e in range(E)] for i in range(L)],
+                            layer_flops=layer_flops, vanilla_flops=vanilla_flops,
+                            filter_perplexity=[filter_stats.get(i, 0)[0] if radius is not None else None for i in range(L)],
+                            num_batches=min(min(row) for row in perplexity_stats.count),
+                            spectra=spectra)
+    return perplexity
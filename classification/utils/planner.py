@@ -0,0 +1,239 @@
+# Choose a training strategy for each finetuned conv2d layer: vanilla, gradient filter, ASI or recomputation
+
+import logging
+from math import ceil, prod
+from functools import reduce
+import torch as th
+
+def is_missing(value):
+    # None in a measured table, NaN in a loaded one (same as shared/perplexity_table.py, custom_op imports this module without shared/ on sys.path)
+    return value is None or value != value
+
+########################## Cost of each strategy (same formulas as ClassificationModel.get_activation_size) ##########################
+def vanilla_cost(shape):
+    B, C, H, W = shape["input"]
+    _, C_prime, H_prime, W_prime = shape["output"]
+    K_H, K_W = shape["kernel_size"]
+
+    num_element = B*C*H*W
+    vanilla_fw = (K_H*K_W*C_prime*C*H*W)*B
+    vanilla_bw = (K_H*K_W*C*C_prime*H_prime*W_prime)*B
+    return num_element, vanilla_fw, vanilla_bw
+
+def grad_filter_cost(shape, radius):
+    B, C, H, W = shape["input"]
+    _, C_prime, H_prime, W_prime = shape["output"]
+    K_H, K_W = shape["kernel_size"]
+    stride = shape["stride"]
+
+    p_h, p_w = ceil(H_prime / radius), ceil(W_prime / radius)
+    x_order_h, x_order_w = radius * stride[0], radius * stride[1]
+    x_pad_h, x_pad_w = ceil((p_h * x_order_h - H) / 2), ceil((p_w * x_order_w - W) / 2)
+
+    x_sum_height = ((H + 2 * x_pad_h - x_order_h) // x_order_h) + 1
+    x_sum_width = ((W + 2 * x_pad_w - x_order_w) // x_order_w) + 1
+
+    num_element = B * C * x_sum_height * x_sum_width
+
+    forward_overhead = (H/radius)*(W/radius)*(radius**2-1)*C*B
+    conv_forward = K_H*K_W*C*C_prime*B*H*W
+
+    gradient_filering_overhead = B*C_prime*(H_prime/radius)*(W_prime/radius)
+    weight_sum_overhead = C_prime*C*(K_H*K_W-1)
+    scalar_mult_backward = B*C_prime*(H_prime/radius)*(W_prime/radius)
+    frobenius_backward = K_H*K_W*C*C_prime*B*H*W
+
+    return num_element, forward_overhead + conv_forward, gradient_filering_overhead + weight_sum_overhead + scalar_mult_backward + frobenius_backward
+
+def ASI_cost(shape, rank):
+    B, C, H, W = shape["input"]
+    _, C_prime, H_prime, W_prime = shape["output"]
+    K_H, K_W = shape["kernel_size"]
+
+    # Rank of each mode is clipped in the same way as find_U
+    dims = [B, C, H, W]
+    if type(rank) != list: rank = [rank] * 4
+    K0, K1, K2, K3 = [min(k, n, prod(dims) // n) for k, n in zip(rank, dims)]
+
+    num_element = K0*K1*K2*K3 + K0*B + K1*C + K2*H + K3*W
+
+    fw_overhead = 0
+    for K in [K0, K1, K2, K3]:
+        fw_overhead += 2*B*C*H*W*K + K**3
+    vanilla_fw = (K_H*K_W*C_prime*C*H*W)*B
+
+    bw = (K0*C_prime*H_prime*W_prime*B + H*K0*K1*K2*K3 + H*W*K0*K1*K3 + C_prime*K0*K1*K_H*K_W*H_prime*W_prime + C_prime*C*K_H*K_W*K1)
+
+    return num_element, fw_overhead + vanilla_fw, bw
+
+def recompute_cost(shape):
+    # The parent module only keeps its input (counted once per parent in plan_strategies), the forward is run twice
+    _, vanilla_fw, vanilla_bw = vanilla_cost(shape)
+    return 0, 2*vanilla_fw, vanilla_bw
+
+########################## Shapes ##########################
+def get_layer_shapes(model, layer_names, input_size):
+    """
+    Feed a dummy batch of size input_size into the backbone and record, for each layer in layer_names,
+    its input/output shapes and the number of input elements of its parent module.
+    """
+    shapes = {name: {} for name in layer_names}
+    parent_inputs = {}
+    handles = []
+
+    def layer_hook(name):
+        def hook_fn(module, input, output):
+            shapes[name]["input"] = list(input[0].shape)
+            shapes[name]["output"] = list(output.shape)
+            shapes[name]["kernel_size"] = list(module.kernel_size)
+            shapes[name]["stride"] = list(module.stride)
+        return hook_fn
+
+    def parent_hook(name):
+        def hook_fn(module, input, output):
+            parent_inputs[name] = sum(x.numel() for x in input if isinstance(x, th.Tensor))
+        return hook_fn
+
+    for name in layer_names:
+        path_seq = name.split('.')
+        handles.append(reduce(getattr, path_seq, model).register_forward_hook(layer_hook(name)))
+        parent_name = '.'.join(path_seq[:-1])
+        if parent_name not in parent_inputs:
+            parent_inputs[parent_name] = None
+            handles.append(reduce(getattr, path_seq[:-1], model).register_forward_hook(parent_hook(parent_name)))
+
+    is_training = model.training
+    model.eval() # Keep BatchNorm statistics untouched
+    with th.no_grad():
+        model.backbone(th.zeros(input_size))
+    model.train(is_training)
+
+    for handle in handles:
+        handle.remove()
+
+    for name in layer_names:
+        shapes[name]["parent"] = '.'.join(name.split('.')[:-1])
+        shapes[name]["parent_input"] = parent_inputs[shapes[name]["parent"]]
+    return shapes
+
+########################## Planner ##########################
+def prune(states, budget, flops_budget, perplexity_bound, round_to):
+    """
+    Each state is (memory, flops, perplexity, choices). Remove states over budget or over the perplexity bound, keep the one
+    with the smallest perplexity in each memory (and FLOPs) bucket, then remove dominated states.
+    """
+    states = [s for s in states if s[0] <= budget and (flops_budget is None or s[1] <= flops_budget) and s[2] <= perplexity_bound]
+    buckets = {}
+    for s in states:
+        key = (round(s[0] / budget * round_to), round(s[1] / flops_budget * round_to) if flops_budget is not None else 0)
+        if key not in buckets or (s[2], s[1]) < (buckets[key][2], buckets[key][1]):
+            buckets[key] = s
+
+    kept = []
+    for s in sorted(buckets.values(), key=lambda s: (s[2], s[0], s[1])):
+        if not any(k[0] <= s[0] and (flops_budget is None or k[1] <= s[1]) for k in kept):
+            kept.append(s)
+    return kept
+
+def combine(states_a, states_b, budget, flops_budget, perplexity_bound, round_to):
+    return prune([(a[0] + b[0], a[1] + b[1], a[2] + b[2], a[3] + b[3]) for a in states_a for b in states_b], budget, flops_budget, perplexity_bound, round_to)
+
+def plan_strategies(shapes, perplexity, start_layer, budget, flops_budget=None, perplexity_bound=None, radius=None, element_size=4, round_to=1000):
+    """
+    Args:
+        shapes (dict): Output of get_layer_shapes, ordered as the finetuned layers.
+        perplexity (Perplexity): Measured perplexity; layer start_layer + i of the table is the i-th finetuned layer.
+        budget (float): Activation memory budget (MB).
+        flops_budget (float): Budget of forward + backward FLOPs, ignored if None.
+        perplexity_bound (float): Accuracy proxy, the total perplexity of the plan must not exceed it. If None, the
+            perplexity of ASI with the most accurate measured epsilon in every layer.
+        radius (int): Radius of the gradient filter, the gradient filter is not considered if None or if the table has no filter perplexity.
+
+    Returns:
+        best_memory (MB), best_flops, best_perplexity, plan (a list of {"strategy", "rank", "memory", "flops", "perplexity"}, one per layer)
+
+    The cheapest plan (smallest memory, then smallest FLOPs) whose perplexity is within perplexity_bound and which fits
+    the memory and FLOPs budgets (vanilla and recomputation are exact, i.e. their perplexity is 0).
+    Recomputation is decided per parent module: all finetuned layers of the parent are recomputed together.
+    """
+    to_MB = element_size / (1024 * 1024)
+    layer_names = list(shapes)
+    use_grad_filter = radius is not None and len(perplexity.filter_perplexity) > 0 and not is_missing(perplexity.filter_perplexity[start_layer])
+    if radius is not None and not use_grad_filter:
+        logging.info("[Warning] No filter perplexity in the perplexity file => Gradient filter is not considered")
+
+    def option(strategy, cost, layer_perplexity, rank=None):
+        num_element, fw, bw = cost
+        memory = num_element * to_MB
+        return (memory, fw + bw, layer_perplexity, ({"strategy": strategy, "rank": rank, "memory": memory, "flops": fw + bw, "perplexity": layer_perplexity},))
+
+    def layer_options(layer_idx, name):
+        shape = shapes[name]
+        table_idx = start_layer + layer_idx
+        options = [option("vanilla", vanilla_cost(shape), 0)]
+        if use_grad_filter:
+            options.append(option("grad_filter", grad_filter_cost(shape, radius), perplexity.filter_perplexity[table_idx], rank=radius))
+        for epsilon_idx in range(len(perplexity.set_of_epsilons)):
+            rank = perplexity.ranks[table_idx][epsilon_idx]
+            options.append(option("ASI", ASI_cost(shape, rank), perplexity.perplexity[table_idx][epsilon_idx], rank=rank))
+        return options
+
+    if perplexity_bound is None:
+        perplexity_bound = sum(min(p for p in perplexity.perplexity[start_layer + layer_idx] if not is_missing(p)) for layer_idx in range(len(layer_names)))
+        logging.info(f"Perplexity bound of the plan: {perplexity_bound} (most accurate measured epsilon of each layer)")
+
+    # Group consecutive layers that share the same parent module
+    groups = []
+    for layer_idx, name in enumerate(layer_names):
+        if len(groups) > 0 and shapes[groups[-1][-1][1]]["parent"] == shapes[name]["parent"]:
+            groups[-1].append((layer_idx, name))
+        else:
+            groups.append([(layer_idx, name)])
+
+    def can_recompute(group):
+        parent = shapes[group[0][1]]["parent"]
+        group_names = [name for _, name in group]
+        # The parent must be a sub-module of the backbone and must not contain finetuned layers with another strategy
+        return parent.count('.') >= 1 and all(not name.startswith(parent + '.') or name in group_names for name in layer_names)
+
+    units = []
+    fallbacks = [] # Plan with the smallest memory of each group, used when nothing fits the budget
+    for group in groups:
+        options = [(0, 0, 0, ())]
+        fallback = (0, 0, 0, ())
+        for layer_idx, name in group:
+            options = combine(options, layer_options(layer_idx, name), budget, flops_budget, perplexity_bound, round_to)
+            o = min(layer_options(layer_idx, name), key=lambda o: (o[0], o[2]))
+            fallback = (fallback[0] + o[0], fallback[1] + o[1], fallback[2] + o[2], fallback[3] + o[3])
+
+        if can_recompute(group):
+            memory = shapes[group[0][1]]["parent_input"] * to_MB
+            flops = 0
+            choices = ()
+            for layer_idx, name in group:
+                _, fw, bw = recompute_cost(shapes[name])
+                flops += fw + bw
+                choices += ({"strategy": "recompute", "rank": None, "memory": memory if len(choices) == 0 else 0, "flops": fw + bw, "perplexity": 0},)
+            options = prune(options + [(memory, flops, 0, choices)], budget, flops_budget, perplexity_bound, round_to)
+            if memory < fallback[0]:
+                fallback = (memory, flops, 0, choices)
+
+        units.append(options)
+        fallbacks.append(fallback)
+
+    states = [(0, 0, 0, ())]
+    for options in units:
+        states = combine(states, options, budget, flops_budget, perplexity_bound, round_to)
+        if len(states) == 0:
+            break
+
+    if len(states) == 0:
+        logging.info("[Warning] No valid plan found within the budget and the perplexity bound. Returning the plan with the smallest memory.")
+        best = (0, 0, 0, ())
+        for o in fallbacks:
+            best = (best[0] + o[0], best[1] + o[1], best[2] + o[2], best[3] + o[3])
+    else:
+        best = min(states, key=lambda s: (s[0], s[1], s[2])) # Smallest memory, then smallest FLOPs
+
+    best_memory, best_flops, best_perplexity, plan = best
+    return best_memory, best_flops, best_perplexity, list(plan)
@@ -1,16 +1,17 @@
 import torch.nn as nn
 import torch
-def get_all_linear_with_name(model):
+from torchvision.models.swin_transformer import ShiftedWindowAttention
+def get_all_linear_with_name(model, keywords=['mlp']):
     linear_layers = {}
 
     for name, mod in model.named_modules():
-        if isinstance(mod, nn.modules.linear.Linear) and 'mlp' in name:
+        if isinstance(mod, nn.modules.linear.Linear) and any(keyword in name for keyword in keywords):
             linear_layers[name] = mod
 
     return linear_layers
 
-def get_active_linear_with_name(model):
-    total_linear_layer = get_all_linear_with_name(model)
+def get_active_linear_with_name(model, keywords=['mlp']):
+    total_linear_layer = get_all_linear_with_name(model, keywords)
     if model.num_of_finetune == "all" or model.num_of_finetune > len(total_linear_layer):
         return total_linear_layer
     elif model.num_of_finetune == None or model.num_of_finetune == 0:
@@ -19,6 +20,27 @@ def get_active_linear_with_name(model):
         active_linear_layers = dict(list(total_linear_layer.items())[-model.num_of_finetune:])
         return active_linear_layers
 
+def is_attention(mod):
+    # Exact types: ShiftedWindowAttentionV2 (logit_scale, cpb_mlp) subclasses ShiftedWindowAttention and is not supported
+    return type(mod) in (nn.MultiheadAttention, ShiftedWindowAttention)
+
+def get_all_attention_with_name(model):
+    attention_layers = {}
+
+    for name, mod in model.named_modules():
+        if is_attention(mod):
+            attention_layers[name] = mod
+
+    return attention_layers
+
+def get_active_attention_with_name(model):
+    # Attention layers that still have trainable parameters once the model is frozen
+    total_attention_layer = get_all_attention_with_name(model)
+    active_attention_layers = {name: mod for name, mod in total_attention_layer.items() if any(param.requires_grad for param in mod.parameters())}
+    if len(active_attention_layers) == 0:
+        return -1
+    return active_attention_layers
+
 def get_all_conv_with_name(model):
     conv_layers = {}
     for name, mod in model.named_modules():
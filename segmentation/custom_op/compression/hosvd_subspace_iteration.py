@@ -63,9 +63,12 @@ def hosvd_subspace_iteration(A, previous_Ulist, reuse_U, rank):
     if type(rank) != list: rank = [rank] * A.dim()
     # Loop over each mode of the tensor
     for i in range(A.dim()):
-        if reuse_U: previous_U = previous_Ulist[i]
+        # The size of a mode can change between iterations (smaller last batch, micro-batches of different sizes):
+        # such a mode cannot be warm started and is re-sketched from a random start
+        reuse = reuse_U and previous_Ulist[i].shape[0] == A.shape[i]
+        if reuse: previous_U = previous_Ulist[i]
         else: previous_U = None
-        u = find_U_mode_n(n=i, A=A, rank=rank[i], reuse_U=reuse_U, previous_U=previous_U)
+        u = find_U_mode_n(n=i, A=A, rank=rank[i], reuse_U=reuse, previous_U=previous_U)
         # Perform tensor contraction along the ith mode
         S = th.tensordot(S, u, dims=([0], [0]))
         u_list.append(u)
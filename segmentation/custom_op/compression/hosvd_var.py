@@ -102,6 +102,32 @@ def hosvd_var(A, var=0.9, return_rank=False):
             rank_list.append(r)
         return S, u_list, rank_list
 
+def hosvd_var_multi(A, vars):
+    """
+    HOSVD of tensor A for several explained variance thresholds, with one SVD per mode.
+    Truncating the factors commutes with the contractions, so the core of each threshold is a slice of the full core.
+
+    Args:
+        A (torch.Tensor): The tensor to be decomposed.
+        vars (list): Explained variance thresholds.
+
+    Returns:
+        S (torch.Tensor): Full core tensor, S[:K0, :K1, :K2, :K3] is the core of a threshold.
+        u_list (list): Full factor matrices, u_list[n][:, :Kn] are the factors of a threshold.
+        rank_lists (list): [K0, K1, K2, K3] of each threshold.
+    """
+    S = A.clone()
+    u_list = []
+    ex_var_list = []
+    for i in range(A.dim()):
+        u, _, _, ex_var = svd_mode_n(i, A, return_full_rank=True)
+        S = th.tensordot(S, u, dims=([0], [0]))
+        u_list.append(u)
+        ex_var_list.append(ex_var)
+    # Same truncation point as truncated_svd_4_mode_var
+    rank_lists = [[min(th.searchsorted(ex_var, var).item() + 1, ex_var.numel()) for ex_var in ex_var_list] for var in vars]
+    return S, u_list, rank_lists
+
 def restore_hosvd_var(S, u_list):
     """
     Restore the original tensor from the core tensor and factor matrices.
@@ -3,6 +3,7 @@ from torch.autograd import Function
 from typing import Any
 from torch.nn.functional import conv2d, pad
 import torch.nn as nn
+import time
 from ..compression.hosvd_subspace_iteration import hosvd_subspace_iteration, restore_hosvd_subspace_iteration
 
 class Conv2d_ASI_op(Function):
@@ -113,12 +114,15 @@ class Conv2d_ASI(nn.Conv2d):
         self.rank = rank
         self.reuse_U = False
         self.u_list = None
+        self.decomposition_time = 0. # Seconds spent in the decomposition
 
     def forward(self, x: th.Tensor) -> th.Tensor:
+        start = time.perf_counter()
         if self.activate and th.is_grad_enabled(): # Training mode
             # Perform HOSVD_power decomposition on the input tensor
             S, self.u_list = hosvd_subspace_iteration(x, previous_Ulist=self.u_list, reuse_U=self.reuse_U, rank=self.rank)
             self.reuse_U = True
+            self.decomposition_time += time.perf_counter() - start
 
             u_list = self.u_list
             u0, u1, u2, u3 = u_list # B, C, H, W
@@ -0,0 +1,185 @@
+import torch as th
+from torch.autograd import Function
+from typing import Any
+from torch.nn.functional import conv2d, avg_pool2d
+import torch.nn as nn
+import time
+from math import ceil
+from ..compression.hosvd_subspace_iteration import hosvd_subspace_iteration
+
+###### Gradient filter + HOSVD_power: the patch-averaged activation is compressed by ASI #############
+def get_pooling_cfgs(x_h, x_w, h, w, order, stride):
+    # Same patches as Conv2dAvgOp
+    p_h, p_w = ceil(h / order), ceil(w / order)
+    x_order_h, x_order_w = order * stride[0], order * stride[1]
+    x_pad_h, x_pad_w = ceil((p_h * x_order_h - x_h) / 2), ceil((p_w * x_order_w - x_w) / 2)
+    return p_h, p_w, x_order_h, x_order_w, x_pad_h, x_pad_w
+
+def pool_input(x, h, w, order, stride):
+    # x_sum of Conv2dAvgOp, h and w are the spatial sizes of the output of the convolution
+    x_h, x_w = x.shape[-2:]
+    _, _, x_order_h, x_order_w, x_pad_h, x_pad_w = get_pooling_cfgs(x_h, x_w, h, w, order, stride)
+    return avg_pool2d(x, kernel_size=(x_order_h, x_order_w),
+                      stride=(x_order_h, x_order_w),
+                      padding=(x_pad_h, x_pad_w), divisor_override=1)
+
+class Conv2dAvg_ASI_op(Function):
+    @staticmethod
+    def forward(ctx: Any, *args: Any, **kwargs: Any) -> Any:
+        x, weight, bias, stride, dilation, padding, order, groups, S, u0, u1, u2, u3 = args # S, u0, u1, u2, u3: factors of x_sum
+
+        # Perform convolution
+        y = conv2d(x, weight, bias, stride, padding, dilation=dilation, groups=groups)
+
+        # Save tensors for backward pass
+        ctx.save_for_backward(S, u0, u1, u2, u3, weight, bias)
+        ctx.pooling_cfgs = get_pooling_cfgs(x.shape[-2], x.shape[-1], y.shape[-2], y.shape[-1], order, stride)
+        ctx.x_size = x.shape
+        ctx.stride = stride
+        ctx.dilation = dilation
+        ctx.order = order
+        ctx.groups = groups
+
+        return y
+
+    @staticmethod
+    def backward(ctx: Any, *grad_outputs: Any) -> Any:
+        """
+        Gradient filter backward where x_sum is replaced by its Tucker factors:
+        the filtered gradient (B, C', p_h, p_w) is directly projected on the factors of x_sum (B, C, p_h, p_w).
+        """
+        # Retrieve saved tensors
+        S, u0, u1, u2, u3, weight, bias = ctx.saved_tensors
+        p_h, p_w, _, _, x_pad_h, x_pad_w = ctx.pooling_cfgs
+        n, c_in, x_h, x_w = ctx.x_size
+        s_h, s_w = ctx.stride
+        order = ctx.order
+        grouping = ctx.groups != 1
+        k_h, k_w = weight.shape[-2:]
+
+        grad_x = grad_w = grad_b = None
+        grad_y, = grad_outputs
+        _, c_out, gy_h, gy_w = grad_y.shape
+
+        grad_y_pad_h, grad_y_pad_w = ceil((p_h * order - gy_h) / 2), ceil((p_w * order - gy_w) / 2)
+        grad_y_avg = avg_pool2d(grad_y, kernel_size=order, stride=order,
+                                padding=(grad_y_pad_h, grad_y_pad_w),
+                                count_include_pad=False) # Shape: (B, C', p_h, p_w)
+
+        # Compute gradient with respect to the input (same as Conv2dAvgOp / Conv2dDilatedOp, it does not need x_sum)
+        if ctx.needs_input_grad[0]:
+            if ctx.dilation[0] == 1 or ctx.dilation[0] < order:
+                weight_sum = weight.sum(dim=(-1, -2))
+                if grouping:
+                    grad_x_sum = grad_y_avg * weight_sum.view(1, c_out, 1, 1)
+                else:
+                    grad_x_sum = (weight_sum.t() @ grad_y_avg.flatten(start_dim=2)).view(n, c_in, p_h, p_w)
+            else:
+                equ_dil = ctx.dilation[0] // order
+                if grouping:
+                    grad_x_sum = conv2d(grad_y_avg, th.flip(weight, (2, 3)), padding=equ_dil, dilation=equ_dil, groups=weight.shape[0])
+                else:
+                    grad_x_sum = conv2d(grad_y_avg, th.flip(weight.permute(1, 0, 2, 3), (2, 3)), padding=equ_dil, dilation=equ_dil)
+            grad_x = th.broadcast_to(grad_x_sum.view(n, c_in, p_h, p_w, 1, 1),
+                                     (n, c_in, p_h, p_w, order * s_h, order * s_w))
+            grad_x = grad_x.permute(0, 1, 2, 4, 3, 5).reshape(
+                n, c_in, p_h * order * s_h, p_w * order * s_w)
+            grad_x = grad_x[..., x_pad_h:x_pad_h + x_h, x_pad_w:x_pad_w + x_w]
+
+        # Compute gradient with respect to the weights
+        if ctx.needs_input_grad[1]:
+            Z1 = th.einsum("bk,bohw->kohw", u0, grad_y_avg) # Shape: (B, K0) einsum with (B, C', p_h, p_w) -> (K0, C', p_h, p_w)
+            Z2 = th.einsum("kohw,hc->kocw", Z1, u2) # Shape: (K0, C', p_h, p_w) einsum with (p_h, K2) -> (K0, C', K2, p_w)
+            Z3 = th.einsum("kocw,wd->kocd", Z2, u3) # Shape: (K0, C', K2, p_w) einsum with (p_w, K3) -> (K0, C', K2, K3)
+            if grouping: # Depthwise
+                grad_w_sum = th.einsum("kocd,kacd,oa->o", Z3, S, u1) # Shape: (K0, C', K2, K3), (K0, K1, K2, K3) and (C, K1) -> (C')
+                grad_w = th.broadcast_to(grad_w_sum.view(c_out, 1, 1, 1), (c_out, 1, k_h, k_w)).clone()
+            else:
+                Z4 = th.einsum("kocd,kacd->oa", Z3, S) # Shape: (K0, C', K2, K3) einsum with (K0, K1, K2, K3) -> (C', K1)
+                grad_w_sum = Z4 @ u1.t() # Shape: (C', K1) @ (K1, C) -> (C', C)
+                grad_w = th.broadcast_to(grad_w_sum.view(c_out, c_in, 1, 1), (c_out, c_in, k_h, k_w)).clone()
+
+        if bias is not None and ctx.needs_input_grad[2]:
+            grad_b = grad_y.sum(dim=(0, 2, 3))
+
+        return grad_x, grad_w, grad_b, None, None, None, None, None, None, None, None, None, None
+
+class Conv2dAvg_ASI(nn.Conv2d):
+    """
+    Custom Conv2D layer combining the gradient filter (patches of size radius) and HOSVD_power-based decomposition of the patch-averaged input.
+    """
+    def __init__(
+            self,
+            in_channels: int,
+            out_channels: int,
+            kernel_size,
+            order=4,
+            stride=1,
+            dilation=1,
+            groups=1,
+            bias=True,
+            padding=0,
+            device=None,
+            dtype=None,
+            activate=False,
+            rank=1
+    ) -> None:
+        if kernel_size is int:
+            kernel_size = [kernel_size, kernel_size]
+        if padding is int:
+            padding = [padding, padding]
+        if dilation is int:
+            dilation = [dilation, dilation]
+        super(Conv2dAvg_ASI, self).__init__(in_channels=in_channels,
+                                        out_channels=out_channels,
+                                        kernel_size=kernel_size,
+                                        stride=stride,
+                                        dilation=dilation,
+                                        groups=groups,
+                                        bias=bias,
+                                        padding=padding,
+                                        padding_mode='zeros',
+                                        device=device,
+                                        dtype=dtype)
+        self.activate = activate
+        self.order = order
+        self.rank = rank
+        self.reuse_U = False
+        self.u_list = None
+        self.decomposition_time = 0. # Seconds spent in the decomposition
+
+    def forward(self, x: th.Tensor) -> th.Tensor:
+        start = time.perf_counter()
+        if self.activate and th.is_grad_enabled(): # Training mode
+            x_h, x_w = x.shape[-2:]
+            h = (x_h + 2 * self.padding[0] - self.dilation[0] * (self.kernel_size[0] - 1) - 1) // self.stride[0] + 1
+            w = (x_w + 2 * self.padding[1] - self.dilation[1] * (self.kernel_size[1] - 1) - 1) // self.stride[1] + 1
+
+            x_sum = pool_input(x.detach(), h, w, self.order, self.stride) # Shape: (B, C, p_h, p_w)
+            S, self.u_list = hosvd_subspace_iteration(x_sum, previous_Ulist=self.u_list, reuse_U=self.reuse_U, rank=self.rank)
+            self.reuse_U = True
+            self.decomposition_time += time.perf_counter() - start
+
+            u0, u1, u2, u3 = self.u_list # B, C, p_h, p_w
+            y = Conv2dAvg_ASI_op.apply(x, self.weight, self.bias, self.stride, self.dilation, self.padding, self.order, self.groups, S, u0, u1, u2, u3)
+        else: # activate is False or Inference mode
+            y = super().forward(x)
+        return y
+
+def wrap_conv_avg_ASI(conv, radius, rank, active):
+    new_conv = Conv2dAvg_ASI(in_channels=conv.in_channels,
+                         out_channels=conv.out_channels,
+                         kernel_size=conv.kernel_size,
+                         stride=conv.stride,
+                         dilation=conv.dilation,
+                         bias=conv.bias is not None,
+                         groups=conv.groups,
+                         padding=conv.padding,
+                         order=radius,
+                         activate=active,
+                         rank=rank
+                         )
+    new_conv.weight.data = conv.weight.data
+    if new_conv.bias is not None:
+        new_conv.bias.data = conv.bias.data
+    return new_conv
@@ -3,7 +3,38 @@ from torch.autograd import Function
 from typing import Any
 from torch.nn.functional import conv2d, pad
 import torch.nn as nn
-from ..compression.hosvd_var import hosvd_var
+from ..compression.hosvd_var import hosvd_var_multi
+
+def low_rank_grad_weight(Z1, S, u1, u2, u3, weight_shape, stride, dilation, padding, groups):
+    """
+    Weight gradient from the HOSVD of the input (core S, factors u1, u2, u3) and Z1 = u0^T grad_output, same steps as Conv2d_ASI.
+    """
+    C_prime, _, K_H, K_W = weight_shape # Shape: (C', C, K_H, K_W)
+    C = u1.shape[0]
+
+    # Pad the input
+    u2_padded = pad(u2, (0, 0, padding[0], padding[0])) # Shape: (H_padded, K2)
+    u3_padded = pad(u3, (0, 0, padding[0], padding[0])) # Shape: (W_padded, K3)
+    #______________________________________________________________________________________________________________
+    # Calculate Z2: (conv2d 1x1):
+    Z2 = th.einsum("abcd,hc->abhd", S, u2_padded) # Shape: (K0, K1, K2, K3) einsum with (H_padded, K2) -> (K0, K1, H_padded, K2, K3) -> (K0, K1, H_padded, K3)
+    #______________________________________________________________________________________________________________
+    # Calculate Z3: (conv2d 1x1):
+    Z3 = th.einsum("abhd,wd->abhw", Z2, u3_padded) # Shape: (K0, K1, H_padded, K3) einsum with (W_padded, K3) -> (K0, K1, H_padded, W_padded, K3) -> (K0, K1, H_padded, W_padded)
+    # ______________________________________________________________________________________________________________
+    # Calculate Z4: (conv2d H'xW'):
+    if stride == dilation:
+        Z4 = conv2d(Z3.permute(1, 0, 2, 3), Z1.permute(1, 0, 2, 3)).permute(1, 0, 2, 3) # Shape: (K1, K0, H_padded, W_padded) conv with (C', K0, H', W') --> (K1, C', K_H, K_W) -> (C', K1, K_H, K_W)
+    else:
+        Z4 = nn.grad.conv2d_weight(Z3, (C_prime, u1.shape[1], K_H, K_W), Z1, stride=stride, dilation=dilation, groups=1) # Shape (C', K1, K_H, K_W)
+    #______________________________________________________________________________________________________________
+    # calculate grad_weight
+    if groups == C == C_prime: # Depthwise
+        return th.einsum("ckhw,ck->ckhw", Z4, u1).sum(dim=1, keepdim=True) # Shape: (C', 1, K_H, K_W)
+    elif groups == 1:
+        return conv2d(Z4, u1.unsqueeze(-1).unsqueeze(-1)) # Shape: (C', K1, K_H, K_W) conv with (C, K1, 1, 1) -> (C', C, K_H, K_W)
+    else:
+        raise NotImplementedError("Grouped convolutions (other than depthwise) are not supported")
 
 class Conv2d_measure_perplexity_HOSVD_op(Function):
     """
@@ -20,10 +51,14 @@ class Conv2d_measure_perplexity_HOSVD_op(Function):
 
         print("Forward: Layer", layer_idx, " with epsilon is ", explain_variance_threshold)
 
-        S, u_list, rank_list = hosvd_var(input, var=explain_variance_threshold, return_rank=True)
+        # A list of epsilons is measured in a single pass: one decomposition, then only the truncation changes
+        multi = isinstance(explain_variance_threshold, (list, tuple))
+        S, u_list, rank_lists = hosvd_var_multi(input, explain_variance_threshold if multi else [explain_variance_threshold])
+        B, C, H, W = input.shape
 
-        layer_mem[layer_idx] = ((S.numel() + u_list[0].numel() + u_list[1].numel() + u_list[2].numel() + u_list[3].numel())*4/(1024*1024)) # MB
-        measured_rank_hosvd[layer_idx] = rank_list
+        mems = [(K0*K1*K2*K3 + B*K0 + C*K1 + H*K2 + W*K3)*4/(1024*1024) for K0, K1, K2, K3 in rank_lists] # MB
+        layer_mem[layer_idx] = mems if multi else mems[0]
+        measured_rank_hosvd[layer_idx] = rank_lists if multi else rank_lists[0]
 
         # Save tensors for backward pass
         ctx.save_for_backward(input, S, u_list[0], u_list[1], u_list[2], u_list[3], weight, bias)
@@ -32,6 +67,8 @@ class Conv2d_measure_perplexity_HOSVD_op(Function):
         ctx.dilation = dilation
         ctx.groups = groups
         ctx.perplexity = perplexity
+        ctx.rank_lists = rank_lists
+        ctx.multi = multi
         ctx.layer_idx = layer_idx
 
         return output
@@ -62,38 +99,16 @@ class Conv2d_measure_perplexity_HOSVD_op(Function):
         # Compute gradient with respect to the weights
         if ctx.needs_input_grad[1]:
 
-            _, _, K_H, K_W = weight.shape # Shape: (C', C, K_H, K_W)
-            _, C_prime, H_prime, W_prime = grad_output.shape # Shape: (B, C', H', W')
-            
-            # Pad the input
-            u2_padded = pad(u2, (0, 0, padding[0], padding[0])) # Shape: (H_padded, K2)
-            u3_padded = pad(u3, (0, 0, padding[0], padding[0])) # Shape: (W_padded, K3)
-            # Calculate Z1: (conv2d 1x1):
-            Z1 = th.einsum("bk,bchw->kchw", u0, grad_output) # Shape: (B, K0) einsum with (B, C', H', W') -> (B, K0, C', H', W') -> (K0, C', H', W')
-            #______________________________________________________________________________________________________________
-            # Calculate Z2: (conv2d 1x1):
-            Z2 = th.einsum("abcd,hc->abhd", S, u2_padded) # Shape: (K0, K1, K2, K3) einsum with (H_padded, K2) -> (K0, K1, H_padded, K2, K3) -> (K0, K1, H_padded, K3)
-            #______________________________________________________________________________________________________________
-            # Calculate Z3: (conv2d 1x1):
-            Z3 = th.einsum("abhd,wd->abhw", Z2, u3_padded) # Shape: (K0, K1, H_padded, K3) einsum with (W_padded, K3) -> (K0, K1, H_padded, W_padded, K3) -> (K0, K1, H_padded, W_padded)
-            # ______________________________________________________________________________________________________________
-            # Calculate Z4: (conv2d H'xW'):
-            if stride == dilation:
-                Z4 = conv2d(Z3.permute(1, 0, 2, 3), Z1.permute(1, 0, 2, 3)).permute(1, 0, 2, 3) # Shape: (K1, K0, H_padded, W_padded) conv with (C', K0, H', W') --> (K1, C', K_H, K_W) -> (C', K1, K_H, K_W)
-            else:
-                Z4 = nn.grad.conv2d_weight(Z3, (C_prime, u1.shape[1], K_H, K_W), Z1, stride=stride, dilation=dilation, groups=1) # Shape (C', K1, K_H, K_W)
-            #______________________________________________________________________________________________________________
-            # calculate grad_weight
-            if groups == C == C_prime: # Depthwise
-                grad_weight_low_rank = th.einsum("ckhw,ck->ckhw", Z4, u1).sum(dim=1, keepdim=True) # Shape: (C', 1, K_H, K_W)
-            elif groups == 1:
-                grad_weight_low_rank = conv2d(Z4, u1.unsqueeze(-1).unsqueeze(-1)) # Shape: (C', K1, K_H, K_W) conv with (C, K1, 1, 1) -> (C', C, K_H, K_W)
-            else:
-                pass
-
             grad_weight = nn.grad.conv2d_weight(input, weight.shape, grad_output, stride, padding, dilation, groups)
 
-            perplexity[layer_idx] = th.norm(grad_weight_low_rank - grad_weight)
+            # Calculate Z1: (conv2d 1x1), it only contracts over the batch: the one of each epsilon is a slice
+            Z1 = th.einsum("bk,bchw->kchw", u0, grad_output) # Shape: (B, K0) einsum with (B, C', H', W') -> (B, K0, C', H', W') -> (K0, C', H', W')
+            perplexities = []
+            for K0, K1, K2, K3 in ctx.rank_lists:
+                grad_weight_low_rank = low_rank_grad_weight(Z1[:K0], S[:K0, :K1, :K2, :K3], u1[:, :K1], u2[:, :K2], u3[:, :K3],
+                                                            weight.shape, stride, dilation, padding, groups)
+                perplexities.append(th.norm(grad_weight_low_rank - grad_weight))
+            perplexity[layer_idx] = perplexities if ctx.multi else perplexities[0]
 
         # if bias is not None and ctx.needs_input_grad[2]:
         #     grad_bias = grad_output.sum((0, 2, 3)).squeeze(0)
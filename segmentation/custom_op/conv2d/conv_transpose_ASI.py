@@ -0,0 +1,139 @@
+import torch as th
+from torch.autograd import Function
+from typing import Any
+from torch.nn.functional import conv2d, conv_transpose2d
+import torch.nn as nn
+from ..compression.hosvd_subspace_iteration import hosvd_subspace_iteration
+
+###### HOSVD_power for transposed convolution (decoder upsampling) #############
+class ConvTranspose2d_ASI_op(Function):
+    @staticmethod
+    def forward(ctx: Any, *args: Any, **kwargs: Any) -> Any:
+        input, weight, bias, stride, dilation, padding, output_padding, groups, S, u0, u1, u2, u3 = args
+
+        # Perform transposed convolution
+        output = conv_transpose2d(input, weight, bias, stride, padding, output_padding, groups, dilation)
+
+        # Save tensors for backward pass
+        ctx.save_for_backward(S, u0, u1, u2, u3, weight, bias)
+        ctx.stride = stride
+        ctx.padding = padding
+        ctx.dilation = dilation
+        ctx.groups = groups
+
+        return output
+
+    @staticmethod
+    def backward(ctx: Any, *grad_outputs: Any) -> Any:
+        """
+        The transposed convolution is the input-gradient of a conv2d whose input is grad_output,
+        so its weight gradient is conv2d_weight(grad_output, weight.shape, input). We evaluate it
+        with the input replaced by its Tucker factors.
+        """
+        # Retrieve saved tensors
+        S, u0, u1, u2, u3, weight, bias = ctx.saved_tensors
+        stride = ctx.stride
+        padding = ctx.padding
+        dilation = ctx.dilation
+        groups = ctx.groups
+
+        grad_input = grad_weight = grad_bias = None
+        grad_output, = grad_outputs
+
+        # Compute gradient with respect to the input
+        if ctx.needs_input_grad[0]:
+            grad_input = conv2d(grad_output, weight, None, stride, padding, dilation, groups)
+
+        # Compute gradient with respect to the weights
+        if ctx.needs_input_grad[1]:
+            C_in, C_out_per_group, K_H, K_W = weight.shape # Shape: (C, C'/groups, K_H, K_W)
+            K1 = u1.shape[1]
+
+            # Calculate Z1: (conv2d 1x1):
+            Z1 = th.einsum("bk,bchw->kchw", u0, grad_output) # Shape: (B, K0) einsum with (B, C', H', W') -> (K0, C', H', W')
+            #______________________________________________________________________________________________________________
+            # Calculate Z2: (conv2d 1x1):
+            Z2 = th.einsum("abcd,hc->abhd", S, u2) # Shape: (K0, K1, K2, K3) einsum with (H, K2) -> (K0, K1, H, K3)
+            #______________________________________________________________________________________________________________
+            # Calculate Z3: (conv2d 1x1):
+            Z3 = th.einsum("abhd,wd->abhw", Z2, u3) # Shape: (K0, K1, H, K3) einsum with (W, K3) -> (K0, K1, H, W)
+            # ______________________________________________________________________________________________________________
+            # calculate grad_weight
+            if groups == 1:
+                Z4 = nn.grad.conv2d_weight(Z1, (K1, C_out_per_group, K_H, K_W), Z3, stride=stride, padding=padding, dilation=dilation, groups=1) # Shape: (K1, C', K_H, K_W)
+                grad_weight = th.einsum("ck,kohw->cohw", u1, Z4) # Shape: (C, K1) einsum with (K1, C', K_H, K_W) -> (C, C', K_H, K_W)
+            else: # Grouped / depthwise: channels of different groups must not mix, so expand the channel mode first
+                Z4 = th.einsum("abhw,cb->achw", Z3, u1) # Shape: (K0, K1, H, W) einsum with (C, K1) -> (K0, C, H, W)
+                grad_weight = nn.grad.conv2d_weight(Z1, weight.shape, Z4, stride=stride, padding=padding, dilation=dilation, groups=groups) # Shape: (C, C'/groups, K_H, K_W)
+
+        if bias is not None and ctx.needs_input_grad[2]:
+            grad_bias = grad_output.sum((0, 2, 3)).squeeze(0)
+
+        return grad_input, grad_weight, grad_bias, None, None, None, None, None, None, None, None, None, None
+
+class ConvTranspose2d_ASI(nn.ConvTranspose2d):
+    """
+    Custom ConvTranspose2D layer with HOSVD_power-based decomposition.
+    """
+    def __init__(
+            self,
+            in_channels: int,
+            out_channels: int,
+            kernel_size,
+            stride=1,
+            padding=0,
+            output_padding=0,
+            groups=1,
+            bias=True,
+            dilation=1,
+            device=None,
+            dtype=None,
+            activate=False,
+            rank=1
+    ) -> None:
+        super(ConvTranspose2d_ASI, self).__init__(in_channels=in_channels,
+                                        out_channels=out_channels,
+                                        kernel_size=kernel_size,
+                                        stride=stride,
+                                        padding=padding,
+                                        output_padding=output_padding,
+                                        groups=groups,
+                                        bias=bias,
+                                        dilation=dilation,
+                                        padding_mode='zeros',
+                                        device=device,
+                                        dtype=dtype)
+        self.activate = activate
+        self.rank = rank
+        self.reuse_U = False
+        self.u_list = None
+
+    def forward(self, x: th.Tensor) -> th.Tensor:
+        if self.activate and th.is_grad_enabled(): # Training mode
+            S, self.u_list = hosvd_subspace_iteration(x, previous_Ulist=self.u_list, reuse_U=self.reuse_U, rank=self.rank)
+            self.reuse_U = True
+
+            u0, u1, u2, u3 = self.u_list # B, C, H, W
+            y = ConvTranspose2d_ASI_op.apply(x, self.weight, self.bias, self.stride, self.dilation, self.padding, self.output_padding, self.groups, S, u0, u1, u2, u3)
+
+        else: # activate is False or Inference mode
+            y = super().forward(x)
+        return y
+
+def wrap_convTransposeASI(conv, active, rank):
+    new_conv = ConvTranspose2d_ASI(in_channels=conv.in_channels,
+                         out_channels=conv.out_channels,
+                         kernel_size=conv.kernel_size,
+                         stride=conv.stride,
+                         padding=conv.padding,
+                         output_padding=conv.output_padding,
+                         groups=conv.groups,
+                         bias=conv.bias is not None,
+                         dilation=conv.dilation,
+                         activate=active,
+                         rank=rank
+                         )
+    new_conv.weight.data = conv.weight.data
+    if new_conv.bias is not None:
+        new_conv.bias.data = conv.bias.data
+    return new_conv
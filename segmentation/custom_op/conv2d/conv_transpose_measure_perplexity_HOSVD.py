@@ -0,0 +1,158 @@
+import torch as th
+from torch.autograd import Function
+from typing import Any
+from torch.nn.functional import conv2d, conv_transpose2d
+import torch.nn as nn
+from ..compression.hosvd_var import hosvd_var_multi
+
+class ConvTranspose2d_measure_perplexity_HOSVD_op(Function):
+    """
+    Measure the gap between the exact weight gradient of a transposed convolution and the one
+    obtained from a HOSVD approximation of its input.
+    """
+
+    @staticmethod
+    def forward(ctx: Any, *args: Any, **kwargs: Any) -> Any:
+        input, weight, bias, stride, dilation, padding, output_padding, groups, explain_variance_threshold, perplexity, measured_rank_hosvd, layer_mem, layer_idx = args
+
+        # Perform transposed convolution
+        output = conv_transpose2d(input, weight, bias, stride, padding, output_padding, groups, dilation)
+
+        print("Forward: Layer", layer_idx, " with epsilon is ", explain_variance_threshold)
+
+        # A list of epsilons is measured in a single pass: one decomposition, then only the truncation changes
+        multi = isinstance(explain_variance_threshold, (list, tuple))
+        S, u_list, rank_lists = hosvd_var_multi(input, explain_variance_threshold if multi else [explain_variance_threshold])
+        B, C, H, W = input.shape
+
+        mems = [(K0*K1*K2*K3 + B*K0 + C*K1 + H*K2 + W*K3)*4/(1024*1024) for K0, K1, K2, K3 in rank_lists] # MB
+        layer_mem[layer_idx] = mems if multi else mems[0]
+        measured_rank_hosvd[layer_idx] = rank_lists if multi else rank_lists[0]
+
+        # Save tensors for backward pass
+        ctx.save_for_backward(input, S, u_list[0], u_list[1], u_list[2], u_list[3], weight, bias)
+        ctx.stride = stride
+        ctx.padding = padding
+        ctx.dilation = dilation
+        ctx.groups = groups
+        ctx.perplexity = perplexity
+        ctx.rank_lists = rank_lists
+        ctx.multi = multi
+        ctx.layer_idx = layer_idx
+
+        return output
+
+    @staticmethod
+    def backward(ctx: Any, *grad_outputs: Any) -> Any:
+        # Retrieve saved tensors
+        input, S, u0, u1, u2, u3, weight, bias  = ctx.saved_tensors
+
+        perplexity = ctx.perplexity
+        stride = ctx.stride
+        padding = ctx.padding
+        dilation = ctx.dilation
+        groups = ctx.groups
+        layer_idx = ctx.layer_idx
+
+        grad_input = None
+        grad_output, = grad_outputs
+
+        # Compute gradient with respect to the input
+        if ctx.needs_input_grad[0]:
+            grad_input = conv2d(grad_output, weight, None, stride, padding, dilation, groups)
+
+        # Compute gradient with respect to the weights
+        if ctx.needs_input_grad[1]:
+            _, C_out_per_group, K_H, K_W = weight.shape # Shape: (C, C'/groups, K_H, K_W)
+
+            grad_weight = nn.grad.conv2d_weight(grad_output, weight.shape, input, stride, padding, dilation, groups)
+
+            Z1_full = th.einsum("bk,bchw->kchw", u0, grad_output) # Shape: (B, K0) einsum with (B, C', H', W') -> (K0, C', H', W')
+            perplexities = []
+            for K0, K1, K2, K3 in ctx.rank_lists: # Truncation of each epsilon
+                Z1 = Z1_full[:K0]
+                Z2 = th.einsum("abcd,hc->abhd", S[:K0, :K1, :K2, :K3], u2[:, :K2]) # Shape: (K0, K1, K2, K3) einsum with (H, K2) -> (K0, K1, H, K3)
+                Z3 = th.einsum("abhd,wd->abhw", Z2, u3[:, :K3]) # Shape: (K0, K1, H, K3) einsum with (W, K3) -> (K0, K1, H, W)
+                if groups == 1:
+                    Z4 = nn.grad.conv2d_weight(Z1, (K1, C_out_per_group, K_H, K_W), Z3, stride=stride, padding=padding, dilation=dilation, groups=1) # Shape: (K1, C', K_H, K_W)
+                    grad_weight_low_rank = th.einsum("ck,kohw->cohw", u1[:, :K1], Z4) # Shape: (C, C', K_H, K_W)
+                else:
+                    Z4 = th.einsum("abhw,cb->achw", Z3, u1[:, :K1]) # Shape: (K0, C, H, W)
+                    grad_weight_low_rank = nn.grad.conv2d_weight(Z1, weight.shape, Z4, stride=stride, padding=padding, dilation=dilation, groups=groups)
+                perplexities.append(th.norm(grad_weight_low_rank - grad_weight))
+            perplexity[layer_idx] = perplexities if ctx.multi else perplexities[0]
+
+        return grad_input, None, None, None, None, None, None, None, None, None, None, None, None
+
+class ConvTranspose2d_measure_perplexity_HOSVD(nn.ConvTranspose2d):
+    """
+    Custom ConvTranspose2D layer with HOSVD-based decomposition.
+    """
+    def __init__(
+            self,
+            in_channels: int,
+            out_channels: int,
+            kernel_size,
+            stride=1,
+            padding=0,
+            output_padding=0,
+            groups=1,
+            bias=True,
+            dilation=1,
+            device=None,
+            dtype=None,
+            activate=False,
+            explain_variance_threshold=None,
+            perplexity=None,
+            measured_rank_svd=None,
+            layer_mem=None,
+            layer_idx=None
+    ) -> None:
+        super(ConvTranspose2d_measure_perplexity_HOSVD, self).__init__(in_channels=in_channels,
+                                        out_channels=out_channels,
+                                        kernel_size=kernel_size,
+                                        stride=stride,
+                                        padding=padding,
+                                        output_padding=output_padding,
+                                        groups=groups,
+                                        bias=bias,
+                                        dilation=dilation,
+                                        padding_mode='zeros',
+                                        device=device,
+                                        dtype=dtype)
+        self.activate = activate
+        self.explain_variance_threshold = explain_variance_threshold
+        self.perplexity = perplexity
+        self.measured_rank_svd = measured_rank_svd
+        self.layer_mem = layer_mem
+        self.layer_idx=layer_idx
+
+    def forward(self, x: th.Tensor) -> th.Tensor:
+        if self.activate and th.is_grad_enabled(): # Training mode
+            y = ConvTranspose2d_measure_perplexity_HOSVD_op.apply(x, self.weight, self.bias, self.stride, self.dilation, self.padding, self.output_padding, self.groups, \
+                                                       self.explain_variance_threshold, self.perplexity, self.measured_rank_svd, self.layer_mem, self.layer_idx)
+        else: # activate is False or Inference mode
+            y = super().forward(x)
+        return y
+
+def wrap_conv_transpose_measure_perplexity_HOSVD(conv, active, explain_variance_threshold, perplexity, measured_rank_svd, layer_mem, layer_idx):
+    new_conv = ConvTranspose2d_measure_perplexity_HOSVD(in_channels=conv.in_channels,
+                         out_channels=conv.out_channels,
+                         kernel_size=conv.kernel_size,
+                         stride=conv.stride,
+                         padding=conv.padding,
+                         output_padding=conv.output_padding,
+                         groups=conv.groups,
+                         bias=conv.bias is not None,
+                         dilation=conv.dilation,
+                         activate=active,
+                         explain_variance_threshold = explain_variance_threshold,
+                         perplexity = perplexity,
+                         measured_rank_svd=measured_rank_svd,
+                         layer_mem = layer_mem,
+                         layer_idx=layer_idx
+                         )
+    new_conv.weight.data = conv.weight.data
+    if new_conv.bias is not None:
+        new_conv.bias.data = conv.bias.data
+    return new_conv
@@ -5,9 +5,12 @@ from .conv2d.conv_avg import wrap_conv_layer
 from .conv2d.conv_hosvd import wrap_convHOSVD
 from tools.utils import attach_hooks_for_conv
 from .conv2d.conv_ASI import wrap_convASI
+from .conv2d.conv_transpose_ASI import wrap_convTransposeASI
+from .conv2d.conv_avg_ASI import wrap_conv_avg_ASI
 
 
 from .conv2d.conv_measure_perplexity_HOSVD import wrap_conv_measure_perplexity_HOSVD
+from .conv2d.conv_transpose_measure_perplexity_HOSVD import wrap_conv_transpose_measure_perplexity_HOSVD
 
 DEFAULT_CFG = {
     "path": "",
@@ -32,6 +35,11 @@ def add_grad_filter(module: nn.Module, cfg, hook):
         module = wrap_conv_layer(module, cfg['radius'], True)
 
         attach_hooks_for_conv(module=module, name=cfg['path'], hook=hook, special_param=cfg['radius'])
+    elif cfg['type'] == 'deconv':
+        # No gradient filter for transposed convolutions: the layer is trained as in vanilla training
+        logging.info(f"[Warning] Gradient filter is not implemented for ConvTranspose2d, {cfg['path']} is kept vanilla")
+
+        attach_hooks_for_conv(module=module, name=cfg['path'], hook=hook)
     else:
         raise NotImplementedError
     return module
@@ -66,7 +74,7 @@ def add_hook_for_base_conv(module: nn.Module, cfg, hook):
     elif cfg['type'] == 'resnet_basic_block':
         attach_hooks_for_conv(module=module.conv1, name=cfg['path']+'.conv1', hook=hook)
         attach_hooks_for_conv(module=module.conv2, name=cfg['path']+'.conv2', hook=hook)
-    elif cfg['type'] == 'conv':
+    elif cfg['type'] == 'conv' or cfg['type'] == 'deconv':
         attach_hooks_for_conv(module=module, name=cfg['path'], hook=hook)
     else:
         raise NotImplementedError
@@ -91,36 +99,54 @@ def add_measure_filter(module: nn.Module, cfg, layer_idx, cfgs):
         cfgs["layer_name"][layer_idx] = cfg['path'] + ".conv"
         layer_idx += 1
 
+    elif cfg['type'] == 'deconv':
+        module = wrap_conv_transpose_measure_perplexity_HOSVD(module, True, cfgs["SVD_var"], cfgs["perplexity"], cfgs["measured_rank"], cfgs["layer_mem"], layer_idx)
+        cfgs["layer_name"][layer_idx] = cfg['path']
+        layer_idx += 1
+
     else:
         raise NotImplementedError
     return module, layer_idx
 
+def wrap_ASI(conv, cfgs, rank):
+    # Gradient filter + ASI on the patch-averaged activation if hybrid_radius is given
+    if cfgs.get("hybrid_radius") is not None:
+        return wrap_conv_avg_ASI(conv, cfgs["hybrid_radius"], rank, True)
+    return wrap_convASI(conv, True, rank)
+
 def add_ASI(module: nn.Module, cfg, cfgs, hook):
     # xác định layer_idx dựa trên tên layer hiện tại, xem với tên này thì nó ứng với index nào trong perplexity.layername
     if cfg['type'] == 'cbr':
         layer_name = cfg['path'] + ".conv"
         layer_idx = cfgs["layer_names"].index(layer_name)
-        module.conv = wrap_convASI(module.conv, True, cfgs["rank"][layer_idx])
+        module.conv = wrap_ASI(module.conv, cfgs, cfgs["rank"][layer_idx])
 
         attach_hooks_for_conv(module=module.conv, name=layer_name, hook=hook, special_param=cfgs["rank"][layer_idx])
 
     elif cfg['type'] == 'resnet_basic_block':
         layer_name = cfg['path'] + ".conv1"
         layer_idx = cfgs["layer_names"].index(layer_name)
-        module.conv1 = wrap_convASI(module.conv1, True, cfgs["rank"][layer_idx])
+        module.conv1 = wrap_ASI(module.conv1, cfgs, cfgs["rank"][layer_idx])
 
         attach_hooks_for_conv(module=module.conv1, name=layer_name, hook=hook, special_param=cfgs["rank"][layer_idx])
 
         layer_name = cfg['path'] + ".conv2"
         layer_idx = cfgs["layer_names"].index(layer_name)
-        module.conv2 = wrap_convASI(module.conv2, True, cfgs["rank"][layer_idx])
+        module.conv2 = wrap_ASI(module.conv2, cfgs, cfgs["rank"][layer_idx])
 
         attach_hooks_for_conv(module=module.conv2, name=layer_name, hook=hook, special_param=cfgs["rank"][layer_idx])
 
     elif cfg['type'] == 'conv':
         layer_name = cfg['path'] + ".conv"
         layer_idx = cfgs["layer_names"].index(layer_name)
-        module = wrap_convASI(module, True, cfgs["rank"][layer_idx])
+        module = wrap_ASI(module, cfgs, cfgs["rank"][layer_idx])
+
+        attach_hooks_for_conv(module=module, name=layer_name, hook=hook, special_param=cfgs["rank"][layer_idx])
+
+    elif cfg['type'] == 'deconv':
+        layer_name = cfg['path']
+        layer_idx = cfgs["layer_names"].index(layer_name)
+        module = wrap_convTransposeASI(module, True, cfgs["rank"][layer_idx])
 
         attach_hooks_for_conv(module=module, name=layer_name, hook=hook, special_param=cfgs["rank"][layer_idx])
 
@@ -110,7 +110,8 @@ def train_segmentor(model,
         model = build_ddp(
             model,
             cfg.device,
-            device_ids=[int(os.environ['LOCAL_RANK'])],
+            device_ids=None
+            if cfg.device == 'cpu' else [int(os.environ['LOCAL_RANK'])],
             broadcast_buffers=False,
             find_unused_parameters=find_unused_parameters)
     else:
@@ -1,13 +1,36 @@
 # Copyright (c) OpenMMLab. All rights reserved.
 import mmcv
 import torch
-from mmcv.parallel import MMDataParallel, MMDistributedDataParallel
+from mmcv.parallel import (MMDataParallel, MMDistributedDataParallel,
+                           scatter_kwargs)
 
 from mmseg import digit_version
 
 dp_factory = {'cuda': MMDataParallel, 'cpu': MMDataParallel}
 
-ddp_factory = {'cuda': MMDistributedDataParallel}
+
+class MMCPUDistributedDataParallel(MMDistributedDataParallel):
+    """MMDistributedDataParallel for CPU processes (gloo backend).
+
+    Without ``device_ids`` the DataContainers of the batch are not
+    scattered, so they are unpacked here before calling the model.
+    """
+
+    def forward(self, *inputs, **kwargs):
+        inputs, kwargs = scatter_kwargs(inputs, kwargs, [-1], dim=self.dim)
+        return super().forward(*inputs[0], **kwargs[0])
+
+    def train_step(self, *inputs, **kwargs):
+        inputs, kwargs = scatter_kwargs(inputs, kwargs, [-1], dim=self.dim)
+        return super().train_step(*inputs[0], **kwargs[0])
+
+    def val_step(self, *inputs, **kwargs):
+        inputs, kwargs = scatter_kwargs(inputs, kwargs, [-1], dim=self.dim)
+        return super().val_step(*inputs[0], **kwargs[0])
+
+
+ddp_factory = {'cuda': MMDistributedDataParallel,
+               'cpu': MMCPUDistributedDataParallel}
 
 
 def build_dp(model, device='cuda', dim=0, *args, **kwargs):
@@ -40,11 +63,12 @@ def build_ddp(model, device='cuda', *args, **kwargs):
     """Build DistributedDataParallel module by device type.
 
     If device is cuda, return a MMDistributedDataParallel module;
-    if device is mlu, return a MLUDistributedDataParallel module.
+    if device is mlu, return a MLUDistributedDataParallel module;
+    if device is cpu, return a MMCPUDistributedDataParallel module.
 
     Args:
         model (:class:`nn.Module`): module to be parallelized.
-        device (str): device type, mlu or cuda.
+        device (str): device type, mlu, cuda or cpu.
 
     Returns:
         :class:`nn.Module`: parallelized module.
@@ -53,7 +77,8 @@ def build_ddp(model, device='cuda', *args, **kwargs):
         .. [1] https://pytorch.org/docs/stable/generated/torch.nn.parallel.
                      DistributedDataParallel.html
     """
-    assert device in ['cuda', 'mlu'], 'Only available for cuda or mlu devices.'
+    assert device in ['cuda', 'mlu', 'cpu'], \
+        'Only available for cuda, mlu or cpu devices.'
     if device == 'cuda':
         model = model.cuda()
     elif device == 'mlu':
@@ -1,6 +1,19 @@
 import pickle
+import copy
 import matplotlib.pyplot as plt
 import os
+import numpy as np
+from math import prod
+from rank_allocation import allocate, min_memory_solution, pareto_frontier, query_frontier
+from perplexity_table import save_table, load_table, weights_fingerprint, PerplexityCache
+
+TABLES = ['perplexity', 'layer_mems'] # Numeric tables, see perplexity_table.py
+
+def rank_memory(shape, rank):
+    # MB of the HOSVD (core and factors) of an input of shape (B, C, H, W), rank of each mode clipped as in ASI
+    dims = shape["input"]
+    K = [min(k, n, prod(dims) // n) for k, n in zip(rank, dims)]
+    return (prod(K) + sum(k*n for k, n in zip(K, dims)))*4/(1024*1024)
 
 class Perplexity:
     def __init__(self, layer_names = [], set_of_epsilons=[], perplexity=[], ranks=[], layer_mems=[], link='.'):
@@ -10,10 +23,15 @@ class Perplexity:
         self.link = link 
         self.ranks = ranks
         self.layer_mems = layer_mems
+        self.frontiers = {} # num_of_finetuned -> (memory, perplexity, indices) of the Pareto frontier
+        self.metadata = {} # What produced the table (weights, dataset, input shape ...), see PerplexityCache
+        # Input size (B, C, H, W) of the measurement and shape of each layer at this size, to compute the memory at another size (see for_shapes)
+        self.input_size = None
+        self.shapes = []
         
 
     def plot(self, is_saved=False, name=None):
-        if not self.set_of_epsilons or not self.perplexity:
+        if len(self.set_of_epsilons) == 0 or len(self.perplexity) == 0:
             return
 
         # Vẽ đồ thị
@@ -37,17 +55,27 @@ class Perplexity:
         plt.show()
 
     def save(self, link):
-        with open(link, 'wb') as file:
+        if not link.endswith('.pkl'):
+            return self.save_table(link)
+        tmp_link = f"{link}.{os.getpid()}.tmp" # Written aside then renamed: other processes may be loading the same file
+        with open(tmp_link, 'wb') as file:
             pickle.dump({
                 'layer_names': self.layer_names,
                 'set_of_epsilons': self.set_of_epsilons,
                 'perplexity': self.perplexity,
                 'ranks': self.ranks,
-                'layer_mems': self.layer_mems
+                'layer_mems': self.layer_mems,
+                'frontiers': self.frontiers,
+                'metadata': self.metadata,
+                'input_size': self.input_size,
+                'shapes': self.shapes
             }, file)
+        os.replace(tmp_link, link)
         print(f'Perplexity is saved at {link}')
 
     def load(self, link):
+        if os.path.isdir(link):
+            return self.load_table(link)
         with open(link, 'rb') as file:
             data = pickle.load(file)
             self.layer_names = data['layer_names']
@@ -55,7 +83,41 @@ class Perplexity:
             self.perplexity = data['perplexity']
             self.ranks = data['ranks']
             self.layer_mems = data['layer_mems']
+            self.frontiers = data.get('frontiers', {}) # Not available in older files
+            self.metadata = data.get('metadata', {})
+            self.input_size = data.get('input_size', None)
+            self.shapes = data.get('shapes', [])
+
+    def save_table(self, directory):
+        save_table(self, directory, TABLES, {
+            'layer_names': self.layer_names,
+            'set_of_epsilons': self.set_of_epsilons,
+            'ranks': self.ranks,
+            'metadata': self.metadata,
+            'input_size': self.input_size,
+            'shapes': self.shapes
+        })
+
+    def load_table(self, directory):
+        meta = load_table(self, directory, TABLES)
+        self.layer_names = meta['layer_names']
+        self.set_of_epsilons = meta['set_of_epsilons']
+        self.ranks = meta['ranks']
+        self.metadata = meta['metadata']
+        self.input_size = meta.get('input_size', None)
+        self.shapes = meta.get('shapes', [])
     
+    def for_shapes(self, shapes, input_size=None):
+        """
+        Copy of the table for another batch size or resolution: shapes are the layer shapes at this size, in the order
+        of the rows. The memory of the measured ranks of each mode is computed again (rank_memory), the perplexity is kept.
+        """
+        table = copy.copy(self)
+        table.input_size, table.shapes, table.frontiers = input_size, shapes, {}
+        table.layer_mems = [[rank_memory(shape, rank) if rank is not None else None for rank in ranks]
+                            for shape, ranks in zip(shapes, self.ranks)]
+        return table
+
     def get_suitable_ranks(self, best_indices, num_of_finetuned):
         if num_of_finetuned == None or num_of_finetuned > len(self.layer_mems):
             print("[Perplexity class] Warning, num_of_finetuned is bigger than total number of layer or None, set it to be total number of layer")
@@ -86,57 +148,69 @@ class Perplexity:
         
         return suitable_mems
 
-    def find_best_combination(self, budget, num_of_finetuned=None):
+    def has_frontier(self, num_of_finetuned=None):
         if num_of_finetuned == None or num_of_finetuned > len(self.layer_mems):
-            print("[Perplexity class] Warning, num_of_finetuned is bigger than total number of layer or None, set it to be total number of layer")
             num_of_finetuned = len(self.layer_mems)
-        
-        total_layer = len(self.layer_mems)
-        total_rank = len(self.layer_mems[0])
-
-        best_memory = 0
-        best_perplexity = float('inf')
-        best_indices = []
+        return num_of_finetuned in self.frontiers
 
-        min_memory = float('inf')
-        min_memory_indices = []
-
-        def backtrack(layer, current_memory, current_perplexity, indices):
-            nonlocal best_memory, best_perplexity, best_indices, min_memory, min_memory_indices
-
-            if layer == total_layer:
-                if current_memory <= budget and current_perplexity < best_perplexity:
-                    best_memory = current_memory
-                    best_perplexity = current_perplexity
-                    best_indices = indices[:]
-                
-                if current_memory < min_memory:
-                    min_memory = current_memory
-                    min_memory_indices = indices[:]
+    def get_frontier(self, num_of_finetuned=None):
+        """
+        Pareto frontier (memory, perplexity, indices) of the finetuned layers, computed once and kept in self.frontiers
+        (saved with the perplexity file). Memory is increasing and perplexity strictly decreasing along the frontier.
+        """
+        if num_of_finetuned == None or num_of_finetuned > len(self.layer_mems):
+            num_of_finetuned = len(self.layer_mems)
+        if num_of_finetuned not in self.frontiers:
+            start_layer = len(self.layer_mems) - num_of_finetuned
+            self.frontiers[num_of_finetuned] = pareto_frontier(self.layer_mems[start_layer:], self.perplexity[start_layer:])
+        return self.frontiers[num_of_finetuned]
+
+    def frontier_points(self, num_of_finetuned=None):
+        # [(memory, perplexity, indices, ranks)] of every point of the frontier, e.g. to sweep the budgets
+        memory, perplexity, indices = self.get_frontier(num_of_finetuned)
+        return [(float(m), float(p), [int(i) for i in idx], self.get_suitable_ranks(idx, num_of_finetuned))
+                for m, p, idx in zip(memory, perplexity, indices)]
+
+    def plot_frontier(self, num_of_finetuned=None, is_saved=False, name=None):
+        memory, perplexity, _ = self.get_frontier(num_of_finetuned)
+        plt.step(memory, perplexity, where='post', marker='.')
+        plt.xlabel('Memory (MB)')
+        plt.ylabel('Perplexity')
+        plt.title('Memory-perplexity Pareto frontier')
+        plt.grid(True)
 
-                return
+        if is_saved:
+            if name is None: name = 'frontier.svg'
+            file_path = os.path.join(self.link, name)
+            plt.savefig(file_path)
+            print(f'Figure is saved at {file_path}')
 
-            for rank in range(total_rank):
-                new_memory = current_memory + self.layer_mems[layer][rank]
-                new_perplexity = current_perplexity + self.perplexity[layer][rank]
+        plt.show()
 
-                indices.append(rank)
-                backtrack(layer + 1, new_memory, new_perplexity, indices)
-                indices.pop()
+    def find_best_combination(self, budget, num_of_finetuned=None, method="auto"):
+        """
+        Epsilon of each finetuned layer minimizing the total perplexity within the memory budget (multiple-choice knapsack,
+        see rank_allocation.py). Returns (memory, perplexity, indices, ranks).
+        If the frontier of num_of_finetuned is already known (or method="frontier"), the budget is answered by binary search on it.
+        """
+        if num_of_finetuned == None or num_of_finetuned > len(self.layer_mems):
+            print("[Perplexity class] Warning, num_of_finetuned is bigger than total number of layer or None, set it to be total number of layer")
+            num_of_finetuned = len(self.layer_mems)
 
         start_layer = len(self.layer_mems) - num_of_finetuned
-        backtrack(start_layer, 0, 0, [])
+        costs = self.layer_mems[start_layer:]
+        values = self.perplexity[start_layer:]
 
-        if best_perplexity == float('inf'):
-            print("Warning: No valid combination found within the budget. Returning the combination with the smallest memory.")
-            best_perplexity = 0
-            i = 0
-            for layer in range(start_layer, len(self.layer_mems)):
-                best_perplexity += self.perplexity[layer][min_memory_indices[i]]
-                i+= 1
-            return min_memory, best_perplexity, min_memory_indices, self.get_suitable_ranks(min_memory_indices, num_of_finetuned)
+        if method == "frontier" or (method == "auto" and self.has_frontier(num_of_finetuned)):
+            solution = query_frontier(self.get_frontier(num_of_finetuned), budget)
         else:
-            return best_memory, best_perplexity, best_indices, self.get_suitable_ranks(best_indices, num_of_finetuned)
+            solution = allocate(costs, values, budget, method=method)
+        if solution is None:
+            print("Warning: No valid combination found within the budget. Returning the combination with the smallest memory.")
+            solution = min_memory_solution(costs, values)
+
+        best_memory, best_perplexity, best_indices = solution
+        return best_memory, best_perplexity, best_indices, self.get_suitable_ranks(best_indices, num_of_finetuned)
 
 def merged_perplexity(*links_to_perplexity):
 
@@ -145,15 +219,17 @@ def merged_perplexity(*links_to_perplexity):
 
     perplexity_merged = Perplexity()
     perplexity_merged.load(links_to_perplexity[0])
+    perplexity_merged.frontiers = {} # The options change, the frontiers have to be recomputed
+    concat = lambda table1, table2: [list(row1) + list(row2) for row1, row2 in zip(table1, table2)] # Lists or loaded arrays
 
     for link in links_to_perplexity[1:]:
         perplexity_temp = Perplexity()
         perplexity_temp.load(link)
 
         perplexity_merged.set_of_epsilons += perplexity_temp.set_of_epsilons
-        perplexity_merged.perplexity = [row1 + row2 for row1, row2 in zip(perplexity_merged.perplexity, perplexity_temp.perplexity)]
-        perplexity_merged.ranks = [row1 + row2 for row1, row2 in zip(perplexity_merged.ranks, perplexity_temp.ranks)]
-        perplexity_merged.layer_mems = [row1 + row2 for row1, row2 in zip(perplexity_merged.layer_mems, perplexity_temp.layer_mems)]
+        perplexity_merged.perplexity = concat(perplexity_merged.perplexity, perplexity_temp.perplexity)
+        perplexity_merged.ranks = concat(perplexity_merged.ranks, perplexity_temp.ranks)
+        perplexity_merged.layer_mems = concat(perplexity_merged.layer_mems, perplexity_temp.layer_mems)
 
     saved_location = os.path.dirname(links_to_perplexity[0])
     os.makedirs(saved_location, exist_ok=True)
@@ -0,0 +1,21 @@
+from mmcv.runner import HOOKS, Hook
+
+from subspace_sync import sync_subspaces, gather_decomposition_time # shared/subspace_sync.py, see train.py
+
+@HOOKS.register_module()
+class SyncSubspaceHook(Hook):
+    """
+    Synchronize the warm-start subspaces of the replicas every interval iterations
+    and put the decomposition time of each rank (seconds per iteration) in the training log.
+    """
+    def __init__(self, interval=50, mode="broadcast"):
+        self.interval = interval
+        self.mode = mode
+
+    def after_train_iter(self, runner):
+        if not self.every_n_iters(runner, self.interval):
+            return
+        model = runner.model.module if hasattr(runner.model, 'module') else runner.model
+        sync_subspaces(model, self.mode)
+        times = gather_decomposition_time(model, reset=True)
+        runner.log_buffer.update({f"decomposition_time_rank{rank}": t / self.interval for rank, t in enumerate(times)})
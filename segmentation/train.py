@@ -3,8 +3,10 @@ import argparse
 import copy
 import os
 import os.path as osp
+import sys
 import time
 import warnings
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'shared')) # Modules shared by classification and segmentation
 
 import mmcv
 import torch
@@ -23,16 +25,21 @@ from mmseg.utils import (collect_env, get_device, get_root_logger,
 from custom_op.register import register_filter, register_HOSVD_filter, register_SVD_filter, register_measure_perplexity_HOSVD, register_HOSVD_power4_budget_filter
 from functools import reduce
 import torch.nn as nn
-from tools.perplexity import Perplexity, merged_perplexity
+from tools.perplexity import Perplexity, PerplexityCache, weights_fingerprint
 from tools.utils import delete_junk_folder
+from tools.subspace_sync import SyncSubspaceHook # Registers the hook
 
 def parse_args():
     parser = argparse.ArgumentParser(description='Train a segmentor')
     parser.add_argument('--measure_perplexity', help='Measure perplexity or not', default=False)
-    parser.add_argument('--SVD_var', help='SVD_var', default=0.8)
+    parser.add_argument('--SVD_var', help='SVD_var, space separated list of epsilons to measure the perplexity', default=0.8)
     parser.add_argument('--with_ASI', help='use ASI or not', default=False)
     parser.add_argument('--budget', help='budget for ASI', default=None)
     parser.add_argument('--perplexity_pkl', help='link to saved perplexity')
+    parser.add_argument('--perplexity_cache', help='directory of the perplexity tables, with_ASI without perplexity_pkl: the table of this model, data and SVD_var is measured only if it is not there', default=None)
+    parser.add_argument('--hybrid_radius', type=int, help='radius of the gradient filter applied before ASI (hybrid), not used if None', default=None)
+    parser.add_argument('--sync_subspace_every', type=int, help='distributed ASI: synchronize the subspaces of the replicas every n iterations', default=50)
+    parser.add_argument('--sync_subspace_mode', help='distributed ASI: broadcast (from rank 0) or average', default='broadcast')
     parser.add_argument('config', help='train config file path')
     parser.add_argument('--work-dir', help='the dir to save logs and models')
     parser.add_argument(
@@ -146,8 +153,42 @@ def get_latest_log_version(path):
     return max_version + 1
 
 
-def main(SVD_var_measure_perplexity=None):
+def backbone_fingerprint(model, checkpoint=None):
+    # Weights the perplexity is measured with: the pretrained backbone, overwritten by the checkpoint loaded by the runner
+    state_dict = {f"backbone.{name}": value for name, value in model.backbone.state_dict().items()}
+    if checkpoint is not None:
+        loaded = torch.load(checkpoint, map_location='cpu')
+        state_dict.update({name: value for name, value in loaded.get('state_dict', loaded).items() if name.startswith('backbone.')})
+    return weights_fingerprint(state_dict)
+
+def get_layer_shapes(model, layer_names, input_size):
+    # Input shape of each layer for a batch of input_size (B, C, H, W), from the forward of a single image
+    shapes = {}
+    handles = []
+    for name in layer_names:
+        try:
+            layer = reduce(getattr, name.split('.'), model)
+        except AttributeError: # Layers of type 'conv' are named path + ".conv" (see add_measure_filter)
+            layer = reduce(getattr, name[:-len(".conv")].split('.'), model)
+        hook_fn = lambda module, input, output, name=name: shapes.__setitem__(name, {"input": [input_size[0]] + list(input[0].shape[1:])})
+        handles.append(layer.register_forward_hook(hook_fn))
+    is_training = model.training
+    model.eval()
+    with torch.no_grad():
+        model.forward_dummy(torch.zeros([1] + list(input_size[1:])))
+    model.train(is_training)
+    for handle in handles:
+        handle.remove()
+    return shapes
+
+def main(SVD_var_measure_perplexity=None, perplexity_pkl=None):
+    # SVD_var_measure_perplexity: list of epsilons, all measured in the same run on the same batches
+    # perplexity_pkl: table of the ASI run, overrides --perplexity_pkl
     args = parse_args()
+    if SVD_var_measure_perplexity is not None:
+        args.measure_perplexity = True
+    if perplexity_pkl is not None:
+        args.perplexity_pkl = perplexity_pkl
 
     cfg = Config.fromfile(args.config)
     if args.cfg_options is not None:
@@ -182,7 +223,12 @@ def main(SVD_var_measure_perplexity=None):
         distributed = False
     else:
         distributed = True
-        init_dist(args.launcher, **cfg.dist_params)
+        if dist.is_initialized(): # The perplexity has been measured by this process before the ASI run
+            pass
+        elif args.launcher == 'pytorch' and not torch.cuda.is_available(): # CPU processes: torchrun --nproc_per_node N train.py ... --launcher pytorch
+            dist.init_process_group(backend='gloo')
+        else:
+            init_dist(args.launcher, **cfg.dist_params)
         # gpu_ids is used to calculate iter when resuming checkpoint
         _, world_size = get_dist_info()
         cfg.gpu_ids = range(world_size)
@@ -216,6 +262,14 @@ def main(SVD_var_measure_perplexity=None):
         test_cfg=cfg.get('test_cfg'))
     model.init_weights()
 
+    perplexity_cache = PerplexityCache(args.perplexity_cache) if args.perplexity_cache is not None else None
+    if perplexity_cache is not None and cfg.hosvd_var.enable:
+        provenance = {"weights": backbone_fingerprint(model, cfg.get('load_from')),
+                      "layers": [[cf['path'], cf['type']] for cf in cfg.hosvd_var['filter_install']],
+                      "dataset": [cfg.get('dataset_type'), cfg.get('data_root')],
+                      "input_size": [cfg.data.samples_per_gpu, 3] + list(cfg.get('crop_size', [])),
+                      "set_of_epsilons": [float(SVD_var) for SVD_var in str(args.SVD_var).strip().split()]}
+
     if cfg.gradient_filter.enable:
         work_dir = osp.join(osp.join(osp.dirname(work_dir), 'gradient_filter'), osp.basename(work_dir))
         register_filter(model, cfg.gradient_filter)
@@ -223,11 +277,14 @@ def main(SVD_var_measure_perplexity=None):
     elif cfg.full.enable: work_dir = osp.join(osp.join(osp.dirname(work_dir), 'full'), osp.basename(work_dir))
     elif cfg.hosvd_var.enable:
         if args.measure_perplexity:
+            if perplexity_cache is not None and perplexity_cache.lookup(provenance) is not None:
+                print(f"Perplexity table found in the cache: {perplexity_cache.lookup(provenance)}")
+                return perplexity_cache.lookup(provenance)
             work_dir = osp.join(osp.join(osp.dirname(work_dir), f'perplexity_{osp.basename(work_dir)}/'))
             work_dir = os.path.join('./perplexity', *work_dir.split(os.sep)[2:])
             total_conv_layer = 0
             for cf in cfg.hosvd_var['filter_install']:
-                if cf['type'] == 'cbr' or cf['type'] == 'conv': total_conv_layer += 1
+                if cf['type'] == 'cbr' or cf['type'] == 'conv' or cf['type'] == 'deconv': total_conv_layer += 1
                 elif cf['type'] == 'resnet_basic_block': total_conv_layer += 2
 
             perplexity=     [None for layer in range(total_conv_layer)]
@@ -239,17 +296,32 @@ def main(SVD_var_measure_perplexity=None):
             cfg.hosvd_var["SVD_var"] = SVD_var_measure_perplexity
             cfg.hosvd_var.update(new_items)
             register_measure_perplexity_HOSVD(model, cfg.hosvd_var)
+            measured_size = [cfg.data.samples_per_gpu, 3] + list(cfg.crop_size) # Memory at other sizes: Perplexity.for_shapes
+            measured_shapes = get_layer_shapes(model, layer_name, measured_size)
         elif args.with_ASI:
             work_dir = osp.join(osp.join(osp.dirname(work_dir), f'ASI_{osp.basename(work_dir)}/'))
             total_conv_layer = 0
             for cf in cfg.hosvd_var['filter_install']:
-                if cf['type'] == 'cbr' or cf['type'] == 'conv': total_conv_layer += 1
+                if cf['type'] == 'cbr' or cf['type'] == 'conv' or cf['type'] == 'deconv': total_conv_layer += 1
                 elif cf['type'] == 'resnet_basic_block': total_conv_layer += 2
 
+            if args.perplexity_pkl is None and perplexity_cache is not None:
+                args.perplexity_pkl = perplexity_cache.lookup(provenance)
+            if args.perplexity_pkl is None:
+                raise ValueError("No perplexity table for this model, data and SVD_var: give --perplexity_pkl or measure it with --perplexity_cache")
             perplexity = Perplexity()
             perplexity.load(args.perplexity_pkl)
+            input_size = [cfg.data.samples_per_gpu, 3] + list(cfg.crop_size)
+            if perplexity.shapes and input_size != list(perplexity.input_size):
+                # Measured with another batch size or crop: memory of the measured ranks at the training size
+                print(f"Perplexity measured with input size {perplexity.input_size}, the memory is computed for {input_size}")
+                shapes = get_layer_shapes(model, perplexity.layer_names, input_size)
+                perplexity = perplexity.for_shapes([shapes[name] for name in perplexity.layer_names], input_size)
+            elif not perplexity.has_frontier(total_conv_layer): # Computed once, the next runs answer any budget by binary search
+                perplexity.get_frontier(total_conv_layer)
+                perplexity.save(args.perplexity_pkl)
             best_memory, best_perplexity, best_indices, suitable_ranks = perplexity.find_best_combination(budget=float(args.budget), num_of_finetuned=total_conv_layer)
-            new_items = {"rank": suitable_ranks, "layer_names": perplexity.layer_names[-total_conv_layer:]}
+            new_items = {"rank": suitable_ranks, "layer_names": perplexity.layer_names[-total_conv_layer:], "hybrid_radius": args.hybrid_radius}
             cfg.hosvd_var.update(new_items)
             register_HOSVD_power4_budget_filter(model, cfg.hosvd_var)
         else:
@@ -327,8 +399,8 @@ def main(SVD_var_measure_perplexity=None):
                 m.weight.register_hook(get_moment_logger(model, n))
         # logger.info(f"Layers to be scaned:\n{conv_layer_names}")
 
-    # SyncBN is not support for DP
-    if not distributed:
+    # SyncBN is not support for DP (nor on CPU)
+    if not distributed or cfg.device == 'cpu':
         warnings.warn(
             'SyncBN is only supported with DDP. To be compatible with DP, '
             'we convert SyncBN to BN. Please use dist_train.sh which can '
@@ -350,6 +422,8 @@ def main(SVD_var_measure_perplexity=None):
             config=cfg.pretty_text,
             CLASSES=datasets[0].CLASSES,
             PALETTE=datasets[0].PALETTE)
+    if distributed and args.with_ASI:
+        cfg.custom_hooks = cfg.get('custom_hooks', []) + [dict(type='SyncSubspaceHook', interval=args.sync_subspace_every, mode=args.sync_subspace_mode)]
     # add an attribute for visualization convenience
     model.CLASSES = datasets[0].CLASSES
     # passing checkpoint meta for saving best checkpoint
@@ -368,30 +442,29 @@ def main(SVD_var_measure_perplexity=None):
         torch.save(moments, osp.join(cfg.work_dir, f"moment_log_{timestamp}"))
     
     if args.measure_perplexity:
-        perplexity_object = Perplexity(set_of_epsilons=[cfg.hosvd_var['SVD_var']], # Chỉ xét 1 epsilon mỗi lần test
-                                perplexity=[[None for epsilon_idx in range(1)] for layer in range(total_conv_layer)],
-                                ranks=[[None for epsilon_idx in range(1)] for layer in range(total_conv_layer)],
-                                layer_mems=[[None for epsilon_idx in range(1)] for layer in range(total_conv_layer)])
-
-        for i in range(total_conv_layer):
-            perplexity_object.perplexity[i][0] = perplexity[i].item() if isinstance(perplexity[i], torch.Tensor) else perplexity[i]
-            perplexity_object.ranks[i][0]      = measured_rank[i]
-            perplexity_object.layer_mems[i][0] = layer_mem[i].item() if isinstance(layer_mem[i], torch.Tensor) else layer_mem[i]
-        perplexity_object.layer_names = layer_name
-        perplexity_object.save(osp.join(osp.dirname(cfg.work_dir), f"perplexity_var{cfg.hosvd_var['SVD_var']}.pkl"))
+        to_float = lambda value: value.item() if isinstance(value, torch.Tensor) else value
+        perplexity_object = Perplexity(layer_names=layer_name,
+                                set_of_epsilons=list(cfg.hosvd_var['SVD_var']),
+                                perplexity=[[to_float(value) for value in perplexity[i]] for i in range(total_conv_layer)],
+                                ranks=[measured_rank[i] for i in range(total_conv_layer)],
+                                layer_mems=[[to_float(value) for value in layer_mem[i]] for i in range(total_conv_layer)])
+        perplexity_object.input_size, perplexity_object.shapes = measured_size, [measured_shapes[name] for name in layer_name]
+        saved_file = osp.join(osp.dirname(cfg.work_dir), 'perplexity_combined.pkl')
+        perplexity_object.save(saved_file)
+        if perplexity_cache is not None:
+            return perplexity_cache.store(perplexity_object, provenance)
         # delete_junk_folder(osp.dirname(cfg.work_dir))
-        return osp.join(osp.dirname(cfg.work_dir), f"perplexity_var{cfg.hosvd_var['SVD_var']}.pkl")
+        return saved_file
 
 if __name__ == '__main__':
     print("Train script")
     args = parse_args()
     if args.measure_perplexity:
-        perplexity_files = []
-        for SVD_var in args.SVD_var.strip().split():
-            perplexity_file = main(float(SVD_var))
-            perplexity_files.append(perplexity_file)
-        merged_perplexity(*perplexity_files)
-        # delete_junk_folder(osp.dirname(perplexity_files[0]))
+        # The segmentor, the datasets and the runner are built once for all epsilons
+        main([float(SVD_var) for SVD_var in str(args.SVD_var).strip().split()])
+    elif args.with_ASI and args.perplexity_pkl is None and args.perplexity_cache is not None:
+        # The table of this model, data and SVD_var is taken from the cache, or measured first (as with --measure_perplexity)
+        main(perplexity_pkl=main([float(SVD_var) for SVD_var in str(args.SVD_var).strip().split()]))
     else:
         main()
         
@@ -4,8 +4,10 @@ import argparse
 import copy
 import os
 import os.path as osp
+import sys
 import time
 import warnings
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'shared')) # Modules shared by classification and segmentation
 
 import mmcv
 import torch
@@ -50,6 +52,7 @@ def parse_args():
     parser.add_argument('--with_ASI', help='use ASI or not', default=False)
     parser.add_argument('--budget', help='budget for ASI', default=None)
     parser.add_argument('--perplexity_pkl', help='link to saved perplexity')
+    parser.add_argument('--hybrid_radius', type=int, help='radius of the gradient filter applied before ASI (hybrid), not used if None', default=None)
     parser.add_argument('config', help='train config file path')
     parser.add_argument('--work-dir', help='the dir to save logs and models')
     parser.add_argument(
@@ -269,18 +272,21 @@ def get_memory(link, args, unit='Byte'):
             work_dir = osp.join(osp.join(osp.dirname(work_dir), f'ASI_{osp.basename(work_dir)}/'))
             total_conv_layer = 0
             for cf in cfg.hosvd_var['filter_install']:
-                if cf['type'] == 'cbr' or cf['type'] == 'conv': total_conv_layer += 1
+                if cf['type'] == 'cbr' or cf['type'] == 'conv' or cf['type'] == 'deconv': total_conv_layer += 1
                 elif cf['type'] == 'resnet_basic_block': total_conv_layer += 2
 
             perplexity = Perplexity()
             perplexity.load(args.perplexity_pkl)
+            if not perplexity.has_frontier(total_conv_layer): # Computed once, the next runs answer any budget by binary search
+                perplexity.get_frontier(total_conv_layer)
+                perplexity.save(args.perplexity_pkl)
             best_memory, best_perplexity, best_indices, suitable_ranks = perplexity.find_best_combination(budget=float(args.budget), num_of_finetuned=total_conv_layer)
 
 
             print("Best memory là: ", best_memory, best_indices)
             # Đo sẽ khác vì pretrained data dùng size 512x1024, còn data finetune thì dùng 512x512
 
-            new_items = {"rank": suitable_ranks, "layer_names": perplexity.layer_names[-total_conv_layer:]}
+            new_items = {"rank": suitable_ranks, "layer_names": perplexity.layer_names[-total_conv_layer:], "hybrid_radius": args.hybrid_radius}
             cfg.hosvd_var.update(new_items)
             register_HOSVD_power4_budget_filter(model, cfg.hosvd_var, hook)
 
@@ -408,6 +414,8 @@ def get_memory(link, args, unit='Byte'):
     from math import ceil
     from custom_op.conv2d.conv_avg import Conv2dAvg
     from segmentation.custom_op.conv2d.conv_ASI import Conv2d_ASI
+    from segmentation.custom_op.conv2d.conv_transpose_ASI import ConvTranspose2d_ASI
+    from segmentation.custom_op.conv2d.conv_avg_ASI import Conv2dAvg_ASI, pool_input
     from segmentation.custom_op.compression.hosvd_subspace_iteration import hosvd_subspace_iteration
     num_element = 0
     num_flops_fw = 0
@@ -464,6 +472,43 @@ def get_memory(link, args, unit='Byte'):
                 num_flops_fw += fw_overhead + vanilla_fw
                 num_flops_bw += bw
                 
+            elif isinstance(hook[name].module, ConvTranspose2d_ASI):
+                S, u_list = hosvd_subspace_iteration(hook[name].inputs[0], previous_Ulist=None, reuse_U=False, rank=suitable_ranks[layer_index])
+                K0, K1, K2, K3 = S.shape
+
+                num_element += S.numel() + sum(u.numel() for u in u_list)
+                #################  FLOPs
+                fw_overhead = 0
+                for K in S.shape:
+                    fw_overhead += 2*B*C*H*W*K + K**3
+                vanilla_fw = (K_H*K_W*C_prime*C*H*W)*B # every input pixel is scattered over a K_H x K_W window
+                bw = (K0*C_prime*H_prime*W_prime*B + H*K0*K1*K2*K3 + H*W*K0*K1*K3 + C_prime*K0*K1*K_H*K_W*H*W + C_prime*C*K_H*K_W*K1)
+
+                num_flops_fw += fw_overhead + vanilla_fw
+                num_flops_bw += bw
+
+            elif isinstance(hook[name].module, Conv2dAvg_ASI):
+                filt_radius = hook[name].module.order
+                x_sum = pool_input(hook[name].inputs[0], int(H_prime), int(W_prime), filt_radius, hook[name].module.stride)
+                S, u_list = hosvd_subspace_iteration(x_sum, previous_Ulist=None, reuse_U=False, rank=suitable_ranks[layer_index])
+                K0, K1, K2, K3 = S.shape
+                P_H, P_W = x_sum.shape[-2:]
+
+                num_element += S.numel() + sum(u.numel() for u in u_list)
+                #################  FLOPs: gradient filter on the input, then ASI on the patch-averaged input
+                forward_overhead = (H/filt_radius)*(W/filt_radius)*(filt_radius**2-1)*C*B
+                for K in S.shape:
+                    forward_overhead += 2*B*C*P_H*P_W*K + K**3
+                conv_forward = K_H*K_W*C*C_prime*B*H*W
+
+                gradient_filering_overhead = B*C_prime*(H_prime/filt_radius)*(W_prime/filt_radius)
+                weight_sum_overhead = C_prime*C*(K_H*K_W-1)
+                scalar_mult_backward = B*C_prime*(H_prime/filt_radius)*(W_prime/filt_radius)
+                low_rank_backward = K0*C_prime*P_H*P_W*B + K0*C_prime*P_H*P_W*K2 + K0*C_prime*K2*P_W*K3 + C_prime*K0*K1*K2*K3 + C_prime*K1*C
+
+                num_flops_fw += forward_overhead + conv_forward
+                num_flops_bw += gradient_filering_overhead + weight_sum_overhead + scalar_mult_backward + low_rank_backward
+
             elif isinstance(hook[name].module, nn.modules.conv.Conv2d):
                 num_element += input_size[0]*input_size[1]*input_size[2]*input_size[3]
 
@@ -473,6 +518,15 @@ def get_memory(link, args, unit='Byte'):
                 num_flops_fw += vanilla_fw
                 num_flops_bw += vanilla_bw
 
+            elif isinstance(hook[name].module, nn.ConvTranspose2d): # Vanilla deconv (base, full, or gradient filter which keeps it vanilla)
+                num_element += input_size[0]*input_size[1]*input_size[2]*input_size[3]
+
+                vanilla_fw = (K_H*K_W*C_prime*C*H*W)*B # every input pixel is scattered over a K_H x K_W window
+                vanilla_bw = (K_H*K_W*C*C_prime*H*W)*B
+
+                num_flops_fw += vanilla_fw
+                num_flops_bw += vanilla_bw
+
         if unit == "Byte":
             mem = str(num_element*element_size)
         if unit == "MB":
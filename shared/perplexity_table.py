@@ -0,0 +1,108 @@
+import json
+import shutil
+import hashlib
+import os
+import numpy as np
+
+# Table format: a directory with meta.json (format version, layer names, epsilons, ranks, provenance) and one .npy file per
+# numeric table. The numeric tables are loaded as read-only memory-mapped arrays (not copied into lists), missing values
+# (None in a measured table) being NaN: test them with is_missing, and the emptiness of a table with len().
+# Shared by the Perplexity classes of classification and segmentation: their entry points add this directory (shared/) to sys.path.
+FORMAT_VERSION = 1
+
+def is_missing(value):
+    # None in a measured table, NaN in a loaded one
+    return value is None or (isinstance(value, (float, np.floating)) and np.isnan(value))
+
+def to_array(table):
+    # Lists (None for missing values) or arrays, e.g. a loaded table saved again
+    nan_if_none = lambda value: np.nan if value is None else float(value)
+    if isinstance(table[0], (list, tuple, np.ndarray)):
+        return np.array([[nan_if_none(value) for value in row] for row in table], dtype=np.float64)
+    return np.array([nan_if_none(value) for value in table], dtype=np.float64)
+
+def to_json(value):
+    # Ranks may hold tensors or numpy integers
+    return value.tolist() if hasattr(value, 'tolist') else str(value)
+
+def save_table(perplexity, directory, tables, meta):
+    """
+    Writes the non-empty tables (attribute names) of perplexity, its frontiers and meta (JSON) in directory.
+    """
+    tmp_directory = f"{directory.rstrip(os.sep)}.{os.getpid()}.tmp" # Written aside then renamed, other processes may be loading the table
+    os.makedirs(tmp_directory, exist_ok=True)
+    tables = [name for name in tables if len(getattr(perplexity, name)) > 0]
+    for name in tables:
+        np.save(os.path.join(tmp_directory, f"{name}.npy"), to_array(getattr(perplexity, name)))
+    for num_of_finetuned, (memory, values, indices) in perplexity.frontiers.items():
+        np.save(os.path.join(tmp_directory, f"frontier_{num_of_finetuned}_memory.npy"), np.asarray(memory))
+        np.save(os.path.join(tmp_directory, f"frontier_{num_of_finetuned}_perplexity.npy"), np.asarray(values))
+        np.save(os.path.join(tmp_directory, f"frontier_{num_of_finetuned}_indices.npy"), np.asarray(indices))
+    with open(os.path.join(tmp_directory, 'meta.json'), 'w') as file:
+        json.dump(dict(meta, format_version=FORMAT_VERSION, tables=tables, frontiers=sorted(perplexity.frontiers)),
+                  file, indent=1, default=to_json)
+    if os.path.isdir(directory): # A directory can not be replaced by a rename
+        shutil.rmtree(directory)
+    os.replace(tmp_directory, directory)
+    print(f'Perplexity is saved at {directory}')
+
+def load_table(perplexity, directory, tables):
+    """
+    Sets the tables (attribute names) and the frontiers of perplexity to the memory-mapped arrays of directory, an absent
+    table to []. Returns the meta dict of the table.
+    """
+    with open(os.path.join(directory, 'meta.json')) as file:
+        meta = json.load(file)
+    if meta['format_version'] > FORMAT_VERSION:
+        raise ValueError(f"Perplexity table {directory} has format version {meta['format_version']}, this code reads up to {FORMAT_VERSION}")
+    for name in tables:
+        setattr(perplexity, name, np.load(os.path.join(directory, f"{name}.npy"), mmap_mode='r') if name in meta['tables'] else [])
+    load = lambda num_of_finetuned, field: np.load(os.path.join(directory, f"frontier_{num_of_finetuned}_{field}.npy"), mmap_mode='r')
+    perplexity.frontiers = {num_of_finetuned: (load(num_of_finetuned, 'memory'), load(num_of_finetuned, 'perplexity'), load(num_of_finetuned, 'indices'))
+                            for num_of_finetuned in meta['frontiers']}
+    return meta
+
+def weights_fingerprint(state_dict):
+    # Hash of the names, shapes and values of a state dict (tensors or arrays)
+    hasher = hashlib.sha256()
+    for name in sorted(state_dict):
+        value = state_dict[name]
+        value = value.detach().cpu().float().numpy() if hasattr(value, 'detach') else np.asarray(value, dtype=np.float32)
+        hasher.update(f"{name}{list(value.shape)}".encode())
+        hasher.update(np.ascontiguousarray(value).tobytes())
+    return hasher.hexdigest()
+
+class PerplexityCache:
+    """
+    Directory of perplexity tables (see Perplexity.save_table), one per provenance: a dict of what produced the table
+    (weights_fingerprint of the backbone, layer names, dataset, input shape, epsilons ...). The table of a provenance is
+    found by the hash of the provenance, so the same measurement is never repeated and a stale table is never reused.
+    """
+    def __init__(self, directory):
+        self.directory = directory
+        os.makedirs(self.directory, exist_ok=True)
+
+    @staticmethod
+    def key(provenance):
+        return hashlib.sha256(json.dumps(provenance, sort_keys=True, default=to_json).encode()).hexdigest()[:20]
+
+    def path(self, provenance):
+        return os.path.join(self.directory, self.key(provenance))
+
+    def lookup(self, provenance):
+        # Link to the table of provenance, None on a miss
+        link = self.path(provenance)
+        if not os.path.isfile(os.path.join(link, 'meta.json')):
+            return None
+        with open(os.path.join(link, 'meta.json')) as file:
+            meta = json.load(file)
+        if meta['format_version'] > FORMAT_VERSION:
+            print(f"[Perplexity class] Warning, {link} has been written by a newer version, it is ignored")
+            return None
+        return link
+
+    def store(self, perplexity, provenance):
+        perplexity.metadata = dict(provenance, key=self.key(provenance))
+        link = self.path(provenance)
+        perplexity.save(link)
+        return link
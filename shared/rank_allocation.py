@@ -0,0 +1,309 @@
+import numpy as np
+
+# Rank allocation as a multiple-choice knapsack: one option (epsilon) per layer, minimize the total perplexity
+# with the total memory <= budget. costs and values have shape (L, E): L layers, E options per layer.
+#   - "bnb": exact branch-and-bound, for small problems (E**L combinations at most, pruned with suffix bounds)
+#   - "dp": dynamic programming over the memory discretized in num_bins steps, vectorized over the memory axis.
+#           Costs are rounded up, so the solution always fits the budget (optimal up to the discretization)
+#   - "lagrangian": greedy on the lower convex hull of each layer (LP relaxation of the knapsack), approximate
+#   - "auto": lagrangian if its LP bound proves it optimal, otherwise bnb if E**L <= max_combinations, otherwise dp
+# Solvers return (memory, perplexity, indices) or None if no combination fits the budget.
+# pareto_frontier gives the solutions of all budgets at once, query_frontier answers a budget by binary search.
+# solve_two_budgets adds a second constraint (FLOPs) on top of the memory budget.
+# Shared by classification and segmentation: their entry points add this directory (shared/) to sys.path.
+
+def as_arrays(costs, values):
+    costs = np.asarray(costs, dtype=np.float64)
+    values = np.asarray(values, dtype=np.float64)
+    if costs.ndim != 2 or costs.shape != values.shape:
+        raise ValueError(f"costs and values must have the same shape (layers, options), got {costs.shape} and {values.shape}")
+    return costs, values
+
+def summarize(costs, values, indices):
+    layers = np.arange(len(indices))
+    indices = np.asarray(indices, dtype=np.int64)
+    return float(costs[layers, indices].sum()), float(values[layers, indices].sum()), [int(i) for i in indices]
+
+def min_memory_solution(costs, values):
+    # Fallback when nothing fits the budget
+    costs, values = as_arrays(costs, values)
+    return summarize(costs, values, np.argmin(costs, axis=1))
+
+def lower_convex_hull(cost, value):
+    # Options of one layer on the lower convex hull, sorted by increasing cost (strictly decreasing value)
+    hull = []
+    for i in np.lexsort((value, cost)):
+        if hull and value[i] >= value[hull[-1]]: # Dominated: not cheaper and not better
+            continue
+        while len(hull) >= 2:
+            a, b = hull[-2], hull[-1]
+            if (value[b] - value[a]) * (cost[i] - cost[a]) >= (value[i] - value[a]) * (cost[b] - cost[a]): # b is above [a, i]
+                hull.pop()
+            else:
+                break
+        hull.append(int(i))
+    return hull
+
+def solve_lagrangian(costs, values, budget):
+    """
+    Greedy on the convex hulls: start from the cheapest option of each layer, then apply the upgrades by decreasing
+    perplexity gain per MB while they fit. Returns (solution, lower_bound), lower_bound being the LP relaxation value.
+    """
+    costs, values = as_arrays(costs, values)
+    hulls = [lower_convex_hull(c, v) for c, v in zip(costs, values)]
+    indices = [hull[0] for hull in hulls]
+    memory = sum(costs[layer, i] for layer, i in enumerate(indices))
+    if memory > budget:
+        return None, float('inf')
+
+    steps = []
+    for layer, hull in enumerate(hulls):
+        for a, b in zip(hull[:-1], hull[1:]):
+            slope = (values[layer, b] - values[layer, a]) / (costs[layer, b] - costs[layer, a])
+            steps.append((slope, layer, a, b))
+    steps.sort() # Convexity: the upgrades of a layer come in order
+
+    lower_bound = float(values[np.arange(len(indices)), indices].sum())
+    lp_done = False
+    for slope, layer, a, b in steps:
+        extra = costs[layer, b] - costs[layer, a]
+        if not lp_done:
+            if memory + extra <= budget:
+                lower_bound += values[layer, b] - values[layer, a]
+            else: # Fractional step of the LP relaxation
+                lower_bound += slope * (budget - memory)
+                lp_done = True
+        if indices[layer] == a and memory + extra <= budget:
+            indices[layer] = b
+            memory += extra
+    return summarize(costs, values, indices), lower_bound
+
+def solve_bnb(costs, values, budget, incumbent=None):
+    costs, values = as_arrays(costs, values)
+    L, E = costs.shape
+    min_cost_suffix = np.append(np.cumsum(costs.min(axis=1)[::-1])[::-1], 0.).tolist()
+    min_value_suffix = np.append(np.cumsum(values.min(axis=1)[::-1])[::-1], 0.).tolist()
+    cost_list, value_list = costs.tolist(), values.tolist()
+
+    best_perplexity = incumbent[1] if incumbent is not None else float('inf')
+    best_indices = list(incumbent[2]) if incumbent is not None else None
+    indices = []
+
+    def search(layer, memory, perplexity):
+        nonlocal best_perplexity, best_indices
+        if layer == L:
+            if perplexity < best_perplexity:
+                best_perplexity = perplexity
+                best_indices = indices[:]
+            return
+        for option in range(E):
+            new_memory = memory + cost_list[layer][option]
+            new_perplexity = perplexity + value_list[layer][option]
+            if new_memory + min_cost_suffix[layer + 1] > budget: # The next layers can not fit anymore
+                continue
+            if new_perplexity + min_value_suffix[layer + 1] >= best_perplexity: # Can not beat the best one
+                continue
+            indices.append(option)
+            search(layer + 1, new_memory, new_perplexity)
+            indices.pop()
+
+    search(0, 0., 0.)
+    if best_indices is None:
+        return None
+    return summarize(costs, values, best_indices)
+
+def solve_dp(costs, values, budget, num_bins=10000):
+    costs, values = as_arrays(costs, values)
+    L, E = costs.shape
+    if budget <= 0:
+        return None
+    step = budget / num_bins
+    weights = np.ceil(costs / step - 1e-9).astype(np.int64) # Rounded up: the discretized memory is never below the real one
+    weights = np.clip(weights, 0, num_bins + 1)
+
+    dp = np.full(num_bins + 1, np.inf) # dp[b]: best perplexity with a discretized memory of exactly b
+    dp[0] = 0
+    choice = np.zeros((L, num_bins + 1), dtype=np.int32)
+    columns = np.arange(num_bins + 1)
+    for layer in range(L):
+        candidates = np.full((E, num_bins + 1), np.inf)
+        for option in range(E):
+            w = weights[layer, option]
+            if w <= num_bins:
+                candidates[option, w:] = dp[:num_bins + 1 - w] + values[layer, option]
+        choice[layer] = np.argmin(candidates, axis=0)
+        dp = candidates[choice[layer], columns]
+
+    if np.isinf(dp).all():
+        return None
+    b = int(np.argmin(dp)) # First minimum: the smallest memory among equal perplexities
+    indices = [0] * L
+    for layer in range(L - 1, -1, -1):
+        indices[layer] = int(choice[layer, b])
+        b -= weights[layer, indices[layer]]
+    return summarize(costs, values, indices)
+
+def allocate(costs, values, budget, method="auto", num_bins=10000, max_combinations=1_000_000):
+    costs, values = as_arrays(costs, values)
+    L, E = costs.shape
+    if method == "bnb":
+        return solve_bnb(costs, values, budget)
+    elif method == "dp":
+        return solve_dp(costs, values, budget, num_bins=num_bins)
+    elif method == "lagrangian":
+        return solve_lagrangian(costs, values, budget)[0]
+    elif method != "auto":
+        raise ValueError(f"Unknown method {method}, it must be 'auto', 'bnb', 'dp' or 'lagrangian'")
+
+    greedy, lower_bound = solve_lagrangian(costs, values, budget)
+    if greedy is None: # Even the cheapest option of each layer does not fit
+        return None
+    if greedy[1] <= lower_bound + 1e-9 * max(1., abs(lower_bound)): # The LP relaxation is tight: greedy is optimal
+        return greedy
+    if E ** L <= max_combinations:
+        return solve_bnb(costs, values, budget, incumbent=greedy)
+    solution = solve_dp(costs, values, budget, num_bins=num_bins)
+    if solution is None or greedy[1] < solution[1]:
+        return greedy
+    return solution
+
+########################## Pareto frontier ##########################
+def pareto_frontier(costs, values, max_points=100000):
+    """
+    All the non-dominated (memory, perplexity) combinations, by merging the layers one at a time and pruning the dominated
+    partial sums. Returns (memory, perplexity, indices): memory increasing, perplexity strictly decreasing, indices (n, L).
+    If the frontier grows above max_points, it is thinned by keeping the best point of each memory bucket
+    (the kept points are still exact combinations, only some budgets get a slightly worse one).
+    """
+    costs, values = as_arrays(costs, values)
+    L, E = costs.shape
+    memory = np.zeros(1)
+    perplexity = np.zeros(1)
+    parents, options = [], []
+    for layer in range(L):
+        candidate_memory = (memory[:, None] + costs[layer][None, :]).ravel() # Candidate i * E + e: point i with option e
+        candidate_perplexity = (perplexity[:, None] + values[layer][None, :]).ravel()
+        order = np.lexsort((candidate_perplexity, candidate_memory))
+        candidate_memory, candidate_perplexity = candidate_memory[order], candidate_perplexity[order]
+        # A point is kept only if it is strictly better than all the cheaper ones
+        best_before = np.minimum.accumulate(np.concatenate([[np.inf], candidate_perplexity[:-1]]))
+        keep = candidate_perplexity < best_before
+        if keep.sum() > max_points:
+            bucket = np.floor((candidate_memory - candidate_memory[0]) / ((candidate_memory[-1] - candidate_memory[0]) / max_points))
+            kept_idx = np.flatnonzero(keep)
+            last_of_bucket = np.append(bucket[kept_idx][1:] != bucket[kept_idx][:-1], True)
+            keep = np.zeros_like(keep)
+            keep[kept_idx[last_of_bucket]] = True
+        memory, perplexity = candidate_memory[keep], candidate_perplexity[keep]
+        parents.append(order[keep] // E)
+        options.append(order[keep] % E)
+
+    # Assignment of every point, following the parents from the last layer
+    indices = np.zeros((len(memory), L), dtype=np.int64)
+    point = np.arange(len(memory))
+    for layer in range(L - 1, -1, -1):
+        indices[:, layer] = options[layer][point]
+        point = parents[layer][point]
+    return memory, perplexity, indices
+
+def query_frontier(frontier, budget):
+    # Best point within the budget by binary search (perplexity decreases with memory), None if nothing fits
+    memory, perplexity, indices = frontier
+    point = int(np.searchsorted(memory, budget, side='right')) - 1
+    if point < 0:
+        return None
+    return float(memory[point]), float(perplexity[point]), [int(i) for i in indices[point]]
+
+########################## Memory and FLOPs budgets ##########################
+def solve_two_budgets(costs, flops, values, budget, flops_budget, num_bins=200):
+    """
+    Two constraints, memory <= budget and FLOPs <= flops_budget. The partial combinations are merged layer by layer,
+    keeping the best one of each cell of a num_bins x num_bins (memory, FLOPs) grid. The kept combinations are exact,
+    so the solution always fits both budgets (optimal up to the grid).
+    """
+    costs, values = as_arrays(costs, values)
+    flops, _ = as_arrays(flops, values)
+    L, E = costs.shape
+    min_cost_suffix = np.append(np.cumsum(costs.min(axis=1)[::-1])[::-1], 0.)
+    min_flops_suffix = np.append(np.cumsum(flops.min(axis=1)[::-1])[::-1], 0.)
+
+    memory, total_flops, perplexity = np.zeros(1), np.zeros(1), np.zeros(1)
+    parents, options = [], []
+    for layer in range(L):
+        candidate_memory = (memory[:, None] + costs[layer][None, :]).ravel() # Candidate i * E + e: state i with option e
+        candidate_flops = (total_flops[:, None] + flops[layer][None, :]).ravel()
+        candidate_perplexity = (perplexity[:, None] + values[layer][None, :]).ravel()
+        # The next layers must still fit
+        feasible = np.flatnonzero((candidate_memory + min_cost_suffix[layer + 1] <= budget) &
+                                  (candidate_flops + min_flops_suffix[layer + 1] <= flops_budget))
+        if len(feasible) == 0:
+            return None
+        cell = (np.floor(candidate_memory[feasible] / max(budget, 1e-12) * num_bins) * (num_bins + 1)
+                + np.floor(candidate_flops[feasible] / max(flops_budget, 1e-12) * num_bins))
+        order = np.lexsort((candidate_perplexity[feasible], cell))
+        first_of_cell = np.append(True, cell[order][1:] != cell[order][:-1])
+        kept = feasible[order[first_of_cell]]
+        memory, total_flops, perplexity = candidate_memory[kept], candidate_flops[kept], candidate_perplexity[kept]
+        parents.append(kept // E)
+        options.append(kept % E)
+
+    point = int(np.argmin(perplexity))
+    indices = [0] * L
+    for layer in range(L - 1, -1, -1):
+        indices[layer] = int(options[layer][point])
+        point = parents[layer][point]
+    return summarize(costs, values, indices)
+
+########################## Check against exhaustive search: python shared/rank_allocation.py ##########################
+if __name__ == "__main__":
+    import itertools
+    import time
+    rng = np.random.default_rng(233)
+
+    def exhaustive(costs, values, budget):
+        best = None
+        for indices in itertools.product(range(costs.shape[1]), repeat=costs.shape[0]):
+            solution = summarize(costs, values, indices)
+            if solution[0] <= budget and (best is None or solution[1] < best[1]):
+                best = solution
+        return best
+
+    for trial in range(50):
+        L, E = rng.integers(2, 7), rng.integers(2, 6)
+        costs = np.sort(rng.uniform(0.1, 2., (L, E)), axis=1) # Like the tables: more memory for larger epsilons
+        values = np.sort(rng.uniform(0., 1., (L, E)), axis=1)[:, ::-1]
+        budget = rng.uniform(costs.min(axis=1).sum(), costs.max(axis=1).sum())
+        reference = exhaustive(costs, values, budget)
+        for method in ["auto", "bnb", "dp"]:
+            solution = allocate(costs, values, budget, method=method)
+            assert solution[0] <= budget + 1e-9
+            assert method == "dp" or abs(solution[1] - reference[1]) < 1e-9, (method, solution, reference)
+        solution = query_frontier(pareto_frontier(costs, values), budget)
+        assert abs(solution[1] - reference[1]) < 1e-9, ("frontier", solution, reference)
+
+        # Second budget on other costs: exhaustive search over the combinations fitting both
+        flops = rng.uniform(0.1, 2., (L, E))
+        flops_budget = rng.uniform(flops.min(axis=1).sum(), flops.max(axis=1).sum())
+        reference = None
+        for indices in itertools.product(range(E), repeat=L):
+            solution = summarize(costs, values, indices)
+            if solution[0] <= budget and summarize(flops, values, indices)[0] <= flops_budget and (reference is None or solution[1] < reference[1]):
+                reference = solution
+        solution = solve_two_budgets(costs, flops, values, budget, flops_budget, num_bins=10000)
+        assert (solution is None) == (reference is None), (solution, reference)
+        if solution is not None:
+            assert solution[0] <= budget + 1e-9 and summarize(flops, values, solution[2])[0] <= flops_budget + 1e-9
+            assert abs(solution[1] - reference[1]) < 1e-9, ("two budgets", solution, reference)
+
+    L, E = 40, 6
+    costs = np.sort(rng.uniform(0.1, 2., (L, E)), axis=1)
+    values = np.sort(rng.uniform(0., 1., (L, E)), axis=1)[:, ::-1]
+    budget = 0.5 * (costs.min(axis=1).sum() + costs.max(axis=1).sum())
+    for method in ["auto", "dp", "lagrangian"]:
+        start = time.perf_counter()
+        memory, perplexity, _ = allocate(costs, values, budget, method=method)
+        print(f"{L} layers, {E} options, {method}: memory {memory:.3f} / {budget:.3f}, perplexity {perplexity:.4f}, {time.perf_counter() - start:.3f} s")
+    start = time.perf_counter()
+    frontier = pareto_frontier(costs, values)
+    memory, perplexity, _ = query_frontier(frontier, budget)
+    print(f"{L} layers, {E} options, frontier of {len(frontier[0])} points: memory {memory:.3f} / {budget:.3f}, perplexity {perplexity:.4f}, {time.perf_counter() - start:.3f} s")
@@ -0,0 +1,105 @@
+import torch as th
+import torch.distributed as dist
+
+# Data parallel training with ASI layers: each replica warm starts the subspace iteration from its own u_list,
+# so the bases of the replicas drift apart and the weight gradients are compressed in different subspaces.
+# sync_subspaces makes the warm-start factors identical on every rank:
+#   - "broadcast": the factors of rank 0 are copied to all ranks
+#   - "average": the factors of each rank are aligned to the ones of rank 0 (Procrustes), averaged and orthonormalized
+# u0 (samples of the local batch) is not shared between ranks and is left untouched.
+# Shared by classification (SyncSubspaceCallback) and segmentation (SyncSubspaceHook): their entry points add this
+# directory (shared/) to sys.path.
+
+def align_basis(u, Q):
+    # Rotate u (N, K) so that it is the closest to Q (orthogonal Procrustes), otherwise the sign / rotation of u differs between ranks
+    U, _, Vh = th.linalg.svd(u.t() @ Q)
+    return u @ (U @ Vh)
+
+def get_device(model):
+    return next(model.parameters()).device
+
+def get_subspaces(model):
+    factors = []
+    for mod in model.modules():
+        if getattr(mod, 'pending', None) is not None: # Conv2d_ASI with async decomposition: take the latest factors
+            _, mod.u_list = mod.pending.result()
+            mod.pending = None
+        if getattr(mod, 'compile_friendly', False):
+            if mod.u0 is not None:
+                factors += [mod.u1, mod.u2, mod.u3]
+        elif isinstance(getattr(mod, 'u_list', None), (list, tuple)):
+            factors += list(mod.u_list[1:])
+    return factors
+
+@th.no_grad()
+def sync_subspaces(model, mode="broadcast"):
+    """
+    Synchronize in place the warm-start factors of all ASI layers of the model, must be called by every rank.
+    Returns the number of synchronized elements.
+    """
+    if not dist.is_available() or not dist.is_initialized() or dist.get_world_size() == 1:
+        return 0
+    if mode not in ["broadcast", "average"]:
+        raise ValueError(f"Unknown synchronization mode {mode}")
+    world_size = dist.get_world_size()
+    device = get_device(model)
+    factors = get_subspaces(model)
+
+    # All ranks must have run all the layers
+    count = th.tensor([len(factors)], device=device)
+    counts = [th.zeros_like(count) for _ in range(world_size)]
+    dist.all_gather(counts, count)
+    if any(c.item() != len(factors) for c in counts) or len(factors) == 0:
+        return 0
+
+    # Only the factors with the same shape on every rank (e.g. the number of tokens of a masked Linear_ASI can differ)
+    shapes = th.tensor([list(u.shape) for u in factors], device=device)
+    all_shapes = [th.zeros_like(shapes) for _ in range(world_size)]
+    dist.all_gather(all_shapes, shapes)
+    same = th.stack(all_shapes).eq(shapes).all(dim=2).all(dim=0).tolist()
+    factors = [u for u, keep in zip(factors, same) if keep]
+    if len(factors) == 0:
+        return 0
+
+    flat = th.cat([u.float().flatten() for u in factors]) # fp32 for the communication (gloo has no bf16 all-reduce)
+    if mode == "broadcast":
+        dist.broadcast(flat, src=0)
+    else:
+        reference = flat.clone()
+        dist.broadcast(reference, src=0)
+        aligned = []
+        offset = 0
+        for u in factors:
+            Q = reference[offset:offset + u.numel()].view(u.shape)
+            aligned.append(align_basis(u.float(), Q).flatten())
+            offset += u.numel()
+        flat = th.cat(aligned)
+        dist.all_reduce(flat)
+        flat.div_(world_size)
+
+    offset = 0
+    for u in factors:
+        new_u = flat[offset:offset + u.numel()].view(u.shape)
+        if mode == "average":
+            new_u = th.linalg.qr(new_u)[0]
+        u.copy_(new_u)
+        offset += u.numel()
+    return flat.numel()
+
+def get_decomposition_time(model, reset=False):
+    total = 0.
+    for mod in model.modules():
+        if hasattr(mod, 'decomposition_time'):
+            total += mod.decomposition_time
+            if reset:
+                mod.decomposition_time = 0.
+    return total
+
+def gather_decomposition_time(model, reset=True):
+    # Decomposition time (seconds) of every rank since the last reset
+    local = th.tensor([get_decomposition_time(model, reset)], dtype=th.float64, device=get_device(model))
+    if not dist.is_available() or not dist.is_initialized():
+        return [local.item()]
+    times = [th.zeros_like(local) for _ in range(dist.get_world_size())]
+    dist.all_gather(times, local)
+    return [t.item() for t in times]